@@ -5,24 +5,145 @@ from itertools import product
 import numpy as np
 from scipy.ndimage import convolve
 
-from .transformations import align_fourierLSQ, fourier_imshift
+from .transformations import FourierAligner, align_fourierLSQ, fourier_imshift
 
 def get_klip_basis(R, cutoff):
     '''
     Succinct KLIP implementation courtesy of N. Zimmerman
     '''
-    w, V = np.linalg.eig(np.dot(R, np.transpose(R)))
+    w, V = np.linalg.eigh(np.dot(R, np.transpose(R)))
     sort_ind = np.argsort(w)[::-1] #indices of eigenvals sorted in descending order
     sv = np.sqrt(w[sort_ind]).reshape(-1,1) #column of ranked singular values
     Z = np.dot(1./sv*np.transpose(V[:, sort_ind]), R)
     return Z[0:cutoff, :], sv
 
 def klip_projection(target,reflib,truncation=10):
-    refflat = reflib.reshape(reflib.shape[0],-1)
-    targflat = target.flatten()
-    Z, _ = get_klip_basis(refflat,truncation)
-    proj = targflat.dot(Z.T)
-    return Z.T.dot(proj).reshape(target.shape)
+    return KLIP(reflib).project(target, truncation)
+
+def klip_zones(shape, annuli=1, sectors=1, center=None):
+    '''
+    Split an image into annular sectors, for KLIP subtraction zone by zone.
+
+    Parameters:
+        shape : tuple
+            (Y, X) dimensions of the image
+        annuli : int or list, opt.
+            Number of equal-width annuli out to the corners of the
+            image, or a list of the radii (in pixels) between annuli
+        sectors : int, opt.
+            Number of equal sectors each annulus is divided into
+        center : tuple, opt.
+            (y, x) center of the annuli. Defaults to the center of the image.
+
+    Returns:
+        zones : list
+            Boolean Y x X masks, one per zone, that don't overlap
+    '''
+    if center is None:
+        center = ((shape[0] - 1) / 2., (shape[1] - 1) / 2.)
+    y, x = np.indices(shape)
+    radius = np.hypot(y - center[0], x - center[1])
+    angle = np.mod(np.arctan2(y - center[0], x - center[1]), 2 * np.pi)
+    if np.ndim(annuli) == 0:
+        edges = np.linspace(0., radius.max(), annuli + 1)[1:-1]
+    else:
+        edges = np.sort(annuli)
+    annulus = np.digitize(radius, edges)
+    sector = np.minimum((angle / (2 * np.pi) * sectors).astype(int), sectors - 1)
+    zones = []
+    for i, j in product(range(len(edges) + 1), range(sectors)):
+        zone = (annulus == i) & (sector == j)
+        if zone.any():
+            zones.append(zone)
+    return zones
+
+class KLIP(object):
+    '''
+    KLIP subtraction against a fixed reference library. The
+    Karhunen-Loeve basis of the references (of each zone, if
+    zones are given) is found once, with an SVD, so any number
+    of targets can be projected onto it for any number of
+    truncations without decomposing the library again:
+
+        klip = KLIP(references, zones=klip_zones(shape, annuli=4))
+        psfs = klip.project(targets, truncations=range(1, 11))
+
+    Parameters:
+        reflib : nd array
+            Z x Y x X stack of reference images
+        zones : list, opt.
+            Boolean Y x X masks of non-overlapping zones, each with
+            its own basis (see klip_zones). Defaults to the whole image.
+            Pixels outside every zone have a projection of 0.
+    '''
+    def __init__(self, reflib, zones=None):
+        reflib = np.asarray(reflib, dtype=float)
+        self.shape = reflib.shape[1:]
+        refflat = reflib.reshape(reflib.shape[0], -1)
+        if zones is None:
+            zones = [np.ones(self.shape, dtype=bool)]
+        self.zones = [np.asarray(zone, dtype=bool).ravel() for zone in zones]
+        self.bases = []
+        for zone in self.zones:
+            _, sv, Z = np.linalg.svd(refflat[:, zone], full_matrices=False)
+            # Drop the modes of a rank-deficient library
+            rank = np.sum(sv > sv[0] * max(Z.shape) * np.finfo(float).eps) if len(sv) > 0 else 0
+            self.bases.append(Z[:rank])
+
+    @property
+    def nmodes(self):
+        '''
+        Largest number of KL modes available in every zone
+        '''
+        return min(len(Z) for Z in self.bases)
+
+    def project(self, targets, truncations=10):
+        '''
+        Project targets onto the first KL modes of the references.
+
+        Parameters:
+            targets : nd array
+                Y x X target image, or N x Y x X stack of targets
+            truncations : int or list, opt.
+                Number of KL modes, or a list of them. Truncations
+                beyond the number of modes use all of them.
+
+        Returns:
+            projections : nd array
+                The projection of each target for each truncation,
+                as a T x N x Y x X array, without the T axis for a
+                single truncation, or the N axis for a single target
+        '''
+        targets = np.asarray(targets, dtype=float)
+        single_target = targets.ndim == len(self.shape)
+        single_truncation = np.ndim(truncations) == 0
+        targflat = targets.reshape(-1, int(np.prod(self.shape)))
+        truncations = np.atleast_1d(truncations).astype(int)
+
+        projections = np.zeros((len(truncations),) + targflat.shape)
+        for zone, Z in zip(self.zones, self.bases):
+            coeffs = targflat[:, zone].dot(Z.T)
+            # Add the modes between successive truncations to a running projection, so that every
+            # truncation costs no more than the largest one
+            running = np.zeros((len(targflat), Z.shape[1]))
+            start = 0
+            for i in np.argsort(truncations):
+                stop = min(max(truncations[i], 0), len(Z))
+                if stop > start:
+                    running += coeffs[:, start:stop].dot(Z[start:stop])
+                    start = stop
+                projections[i][:, zone] = running
+
+        projections = projections.reshape((len(truncations),) + targets.shape)
+        if single_truncation:
+            projections = projections[0]
+        return projections
+
+    def subtract(self, targets, truncations=10):
+        '''
+        Return targets minus their projections (see KLIP.project).
+        '''
+        return np.asarray(targets, dtype=float) - self.project(targets, truncations)
 
 def register_to_target(reference_image,target_image,mask=None,rescale_reference=True,return_fit=False):
     '''
@@ -65,6 +186,42 @@ def register_to_target(reference_image,target_image,mask=None,rescale_reference=
     else:
         return registered_ref
 
+def register_stack(references, target_image, mask=None, rescale_reference=True):
+    '''
+    Register every image of a stack of references to a target image
+    at once. Equivalent to calling register_to_target for each
+    reference, but the target's FFT is only computed once, the
+    references are fitted together (see FourierAligner.fit_stack),
+    and shifted in a single stacked FFT.
+
+    Parameters:
+        references : nd array
+            Z x Y x X stack of images to align to the target_image
+        target_image : nd array
+            2D image to which the references will be aligned
+        mask : nd array, optional
+            Mask to weight the fitting process, either one Y x X
+            mask for every reference or a Z x Y x X stack of them.
+        rescale_reference: bool, optional
+            Rescale the references as well as align them?
+
+    Returns:
+        registered_refs : nd array
+            Z x Y x X stack of the references shifted (and scaled,
+            if requested) onto the target_image frame
+        fits : nd array
+            Z x 3 array of the (offx, offy, scale) of each
+            reference. See register_to_target
+    '''
+    references = np.asarray(references, dtype=float)
+    centered_refs = references - np.nanmean(references, axis=(1, 2), keepdims=True)
+    centered_targ = target_image - np.nanmean(target_image)
+    fits = FourierAligner(centered_targ, mask).fit_stack(centered_refs)
+    registered_refs = FourierAligner(centered_refs).shift_stack(-fits[:, 0], -fits[:, 1])
+    if rescale_reference:
+        registered_refs = registered_refs / fits[:, 2, np.newaxis, np.newaxis]
+    return registered_refs, fits
+
 def compute_contrast(data_stack, offaxis_image, aperture):
     ''' Compute the contrast curve for a stack of data via
     a covariance matrix approach.
@@ -87,16 +244,9 @@ def compute_contrast(data_stack, offaxis_image, aperture):
         profile : nd array
             The contrast at the bin radii
     '''
-    image_dim = data_stack[0].shape
-
-    # Get the covariance
-    cov_matrix = covariance_matrix(data_stack)
-
-    # Get the aperture matrix
-    ap_matrix = aperture_matrix(aperture)
-
-    # Find correlated noise within the aperture
-    noise = noise_map(cov_matrix, ap_matrix, image_dim)
+    # Find correlated noise within the aperture, without the
+    # covariance and aperture matrices
+    noise = aperture_noise_map(data_stack, aperture)
 
     # Convolve off-axis source with aperture and take max
     convolved_offaxis = convolve(offaxis_image, aperture, mode='constant')
@@ -188,6 +338,132 @@ def noise_map(cov_matrix, ap_matrix, image_dim):
     noise = np.sqrt(np.diag(noise_matrix).reshape(image_dim))
     return noise
 
+def aperture_noise_map(data_stack, aperture, mean_subtract=False):
+    ''' Matrix-free equivalent of noise_map(covariance_matrix(data_stack),
+    aperture_matrix(aperture), image_dim). The aperture-integrated
+    variance at a pixel is the variance, over the stack, of each
+    image correlated with the aperture centered on that pixel, so
+    it can be found with FFTs of the images without building either
+    (Y*X) x (Y*X) matrix.
+
+    Parameters:
+        data_stack : nd array
+            Z x Y x X stack of images
+        aperture : nd array
+            The aperture kernel centered in an array of the same
+            dimensions as the images. See analysis.aperture_matrix
+        mean_subtract : bool, opt.
+            Remove the mean image first? See analysis.covariance_matrix
+
+    Returns:
+        noise : np array
+            Y x X array of the standard deviation at each pixel
+    '''
+    data_stack = np.asarray(data_stack, dtype=float)
+    nstack = data_stack.shape[0]
+    if mean_subtract:
+        data_stack = data_stack - data_stack.mean(axis=0)
+    correlated = _correlate_aperture(data_stack, aperture)
+    variance = np.sum(correlated**2, axis=0) / (nstack - 1)
+    return np.sqrt(variance)
+
+def _correlate_aperture(data_stack, aperture):
+    ''' Sum each image of a Z x Y x X stack within the aperture
+    centered on each pixel, as aperture_matrix does.
+    '''
+    aperture = np.asarray(aperture, dtype=float)
+    image_dim = data_stack.shape[1:]
+
+    # Pixel of the aperture that aperture_matrix centers on each image pixel, from the padding it
+    # adds along each axis. The padding is based on the longer axis, so along the shorter axis of
+    # a non-square aperture this pixel can fall before the start of the aperture: pad the
+    # aperture with zeros in front until it is inside.
+    dim = aperture.shape
+    desired = (max(dim) * 2 + 1) / 2
+    center = [dim[axis] - int(np.floor((desired - dim[axis] // 2))) for axis in range(2)]
+    front = [max(0, -c) for c in center]
+    aperture = np.pad(aperture, ((front[0], 0), (front[1], 0)), mode='constant')
+    center = (center[0] + front[0], center[1] + front[1])
+    dim = aperture.shape
+
+    # Correlate each image with the aperture, as a convolution with the flipped aperture
+    full = (image_dim[0] + dim[0] - 1, image_dim[1] + dim[1] - 1)
+    kernel = np.fft.rfft2(aperture[::-1, ::-1], s=full)
+    correlated = np.fft.irfft2(np.fft.rfft2(data_stack, s=full) * kernel, s=full)
+    start = (dim[0] - 1 - center[0], dim[1] - 1 - center[1])
+    return correlated[:, start[0]:start[0] + image_dim[0], start[1]:start[1] + image_dim[1]]
+
+class ContrastAccumulator(object):
+    ''' Running estimate of the aperture noise map and contrast
+    profile of a stack of images (e.g. reference-subtracted
+    targets), updated one image at a time, so that the stack
+    and its covariance matrix never have to be held in memory.
+
+    The aperture sums of each image are accumulated with Welford's
+    algorithm, and the noise map is always the one that
+    noise_map(covariance_matrix(stack, mean_subtract), aperture_matrix(aperture), image_dim)
+    would give for the images added so far.
+
+    Parameters:
+        aperture : nd array
+            The aperture kernel centered in an array of the same
+            dimensions as the images. See analysis.aperture_matrix
+        normalization : float, opt.
+            Peak of the off-axis source convolved with the aperture,
+            which the contrast profile is divided by
+        mean_subtract : bool, opt.
+            Remove the mean image? See analysis.covariance_matrix
+    '''
+    def __init__(self, aperture, normalization=1., mean_subtract=False):
+        self.aperture = np.asarray(aperture, dtype=float)
+        self.normalization = normalization
+        self.mean_subtract = mean_subtract
+        self.count = 0
+        self.change = None  # Largest relative change of the profile caused by the last image
+        self._mean = None
+        self._m2 = None
+        self._profile = None
+
+    def add(self, image):
+        ''' Add an image to the stack, and update the estimate.
+        '''
+        summed = _correlate_aperture(np.asarray(image, dtype=float)[np.newaxis], self.aperture)[0]
+        self.count += 1
+        if self._mean is None:
+            self._mean = np.zeros_like(summed)
+            self._m2 = np.zeros_like(summed)
+        delta = summed - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (summed - self._mean)
+        if self.count > 1:
+            profile = self.profile()[1]
+            if self._profile is not None:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    self.change = np.nanmax(np.abs(profile - self._profile) / np.abs(profile))
+            self._profile = profile
+
+    def noise_map(self):
+        ''' Return the Y x X array of the standard deviation within
+        the aperture at each pixel (needs at least two images).
+        '''
+        squares = self._m2
+        if not self.mean_subtract:
+            squares = squares + self.count * self._mean**2
+        return np.sqrt(squares / (self.count - 1))
+
+    def profile(self):
+        ''' Return the radial bins and the normalized contrast
+        profile. See analysis.radial_profile
+        '''
+        bins, profile = radial_profile(self.noise_map())
+        return bins, profile / self.normalization
+
+    def converged(self, tolerance):
+        ''' Did the last image change the normalized contrast
+        profile by less than a fraction tolerance at every radius?
+        '''
+        return self.change is not None and self.change < tolerance
+
 def radial_profile(image):
     ''' Find the radial profile of an image.
 
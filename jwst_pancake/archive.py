@@ -0,0 +1,236 @@
+from __future__ import absolute_import
+
+"""
+An on-disk archive of calculation results, written one result at a time as a batch runs.
+"""
+
+import json
+import numbers
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from .psf_cache import opd_key, psf_key
+from .taskgraph import calculation_key
+
+# Options that only change how results are calculated (how fast, or what is printed along the way),
+# not the results themselves, and so don't have to match when a batch is resumed
+_operational_options = ['verbose', 'cache_path', 'psf_cache_bytes', 'psf_cache_readonly', 'shared_psf_cache',
+                        'shared_psf_cache_bytes', 'psf_prefetch', 'psf_prefetch_workers', 'source_cache_bytes',
+                        'products']
+
+
+def _replace(source, destination):
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    else:
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+def _jsonable(value):
+    '''
+    Convert numpy scalars and arrays (other than those split out as FITS extensions) in a report
+    into plain python values.
+    '''
+    if isinstance(value, dict):
+        return dict((key, _jsonable(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return _jsonable(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def options_key(current_options):
+    '''
+    Return a content hash of the engine options (an options.current_options dictionary) that a
+    result depends on, leaving out _operational_options. The OPD is keyed on its contents.
+    '''
+    snapshot = dict((key, value) for key, value in current_options.items() if key not in _operational_options)
+    snapshot['on_the_fly_webbpsf_opd'] = opd_key(snapshot.get('on_the_fly_webbpsf_opd'))
+    return psf_key(snapshot)
+
+def _seed_key(seed):
+    '''
+    Return a JSON-serializable form of a batch seed (None, an int, or a SeedSequence).
+    '''
+    if seed is None or isinstance(seed, numbers.Integral):
+        return _jsonable(seed)
+    return {'entropy': _jsonable(seed.entropy), 'spawn_key': _jsonable(list(seed.spawn_key))}
+
+def _split_report(report, prefix=''):
+    '''
+    Split a report dictionary into its numeric arrays, keyed by dotted path (e.g. '2d.detector'),
+    and everything else.
+    '''
+    arrays = {}
+    rest = {}
+    for key, value in report.items():
+        path = prefix + str(key)
+        if isinstance(value, dict):
+            sub_arrays, rest[key] = _split_report(value, path + '.')
+            arrays.update(sub_arrays)
+        elif isinstance(value, np.ndarray) and value.ndim > 0 and value.dtype.kind in 'iuf':
+            arrays[path] = value
+        else:
+            rest[key] = _jsonable(value)
+    return arrays, rest
+
+
+class ResultArchive(object):
+    '''
+    An append-only directory of calculation results, keyed by task index (the position of each
+    calculation in its batch). The directory contains:
+        - index.jsonl: one JSON record per line for each stored result
+        - result-<index>.fits: the numeric arrays of a result, one FITS extension each
+        - result-<index>.json: the rest of the result (scalars, warnings, the input, etc.)
+
+    A result is written to temporary files which are then renamed, and its index record is appended
+    last, so a batch that crashes leaves only complete results in the archive. Running the same batch
+    into the archive again (see engine.calculate_batch) only runs the calculations that are missing,
+    after checking that the stored ones were run with the same engine options, products and seed.
+    Arrays are read back as memory maps, so a large archive can be analysed without loading it:
+
+        archive = ResultArchive('campaign')
+        for index in archive.indices:
+            detector = archive.get(index)['2d']['detector']
+    '''
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._index_file = os.path.join(self.path, 'index.jsonl')
+        self._index = {}
+        self._read_index()
+
+    def __contains__(self, index):
+        return index in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def indices(self):
+        '''
+        Sorted task indices of the stored results
+        '''
+        return sorted(self._index)
+
+    def matches(self, index, calcfile, current_options=None, seed=None):
+        '''
+        Is there a stored result for index, calculated from calcfile with the same engine options
+        (an options.current_options dictionary, see options_key), report products and batch seed?
+        '''
+        if index not in self._index:
+            return False
+        entry = self._index[index]
+        record = self._record(calcfile, current_options, seed)
+        return all(entry.get(key) == value for key, value in record.items())
+
+    def put(self, index, report, calcfile=None, current_options=None, seed=None):
+        '''
+        Store the report (a pandeia report dictionary, possibly with only some of its products) of
+        task index, replacing any earlier result for it. If calcfile is given, it is recorded (as a
+        hash) along with the engine options (as a hash, see options_key), the report products and
+        the batch seed, so that a resumed batch can check that it is running the same calculations.
+        '''
+        from .engine import save_calculation, save_to_fits
+        arrays, rest = _split_report(report)
+        products = sorted(arrays)
+        rest['_arrays'] = products
+        name = 'result-{:06d}'.format(index)
+        fits_file = os.path.join(self.path, name + '.fits')
+        json_file = os.path.join(self.path, name + '.json')
+        for filename in [fits_file + '.tmp', json_file + '.tmp']:
+            if os.path.exists(filename):
+                os.remove(filename)
+        save_to_fits(None, fits_file + '.tmp', extensions=[(product, arrays[product]) for product in products])
+        save_calculation(rest, json_file + '.tmp')
+        _replace(fits_file + '.tmp', fits_file)
+        _replace(json_file + '.tmp', json_file)
+
+        entry = self._record(calcfile, current_options, seed)
+        entry['index'] = index
+        entry['name'] = name
+        # Append the record in a single write, after the data is in place
+        line = (json.dumps(entry) + '\n').encode('utf-8')
+        fd = os.open(self._index_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self._index[index] = entry
+
+    def get(self, index, memmap=True):
+        '''
+        Return the stored report of task index, with its arrays memory-mapped from the FITS file
+        (unless memmap is False).
+        '''
+        from .engine import load_calculation
+        name = self._index[index]['name']
+        report = load_calculation(os.path.join(self.path, name + '.json'))
+        products = report.pop('_arrays')
+        hdulist = fits.open(os.path.join(self.path, name + '.fits'), memmap=memmap)
+        try:
+            arrays = [hdu.data for hdu in hdulist[1:]]
+        finally:
+            hdulist.close()
+        for product, array in zip(products, arrays):
+            keys = product.split('.')
+            target = report
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = array
+        return report
+
+    def get_product(self, product, indices=None):
+        '''
+        Return one product (e.g. '2d.detector') of each stored result (or of those in indices), as a
+        list in index order.
+        '''
+        if indices is None:
+            indices = self.indices
+        results = []
+        for index in indices:
+            value = self.get(index)
+            for key in product.split('.'):
+                value = value[key]
+            results.append(value)
+        return results
+
+    @staticmethod
+    def _record(calcfile, current_options, seed):
+        '''
+        The parts of an index record that identify how a result was calculated.
+        '''
+        if calcfile is None:
+            return {'calculation': None, 'options': None, 'products': None, 'seed': None}
+        products = None
+        if current_options is not None and current_options.get('products') is not None:
+            products = list(current_options['products'])
+        return {
+                    'calculation': calculation_key(calcfile, None),
+                    'options': None if current_options is None else options_key(current_options),
+                    'products': products,
+                    'seed': _seed_key(seed)
+               }
+
+    def _read_index(self):
+        '''
+        Read the index, dropping a partial record left by a crash in the middle of writing it.
+        '''
+        if not os.path.exists(self._index_file):
+            return
+        with open(self._index_file, 'rb') as inf:
+            records = inf.read()
+        end = records.rfind(b'\n') + 1
+        if end < len(records):
+            with open(self._index_file, 'r+b') as outf:
+                outf.truncate(end)
+        for line in records[:end].splitlines():
+            if line.strip():
+                entry = json.loads(line.decode('utf-8'))
+                self._index[entry['index']] = entry
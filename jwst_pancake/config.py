@@ -2,6 +2,8 @@ from __future__ import absolute_import
 
 import sys
 
+import numpy as np
+
 class EngineConfiguration(object):
     '''
     A class to consolidate the options for customizing
@@ -21,11 +23,21 @@ class EngineConfiguration(object):
         self.default_params = {'wave_sampling': None, 'on_the_fly_PSFs': False,
                                'on_the_fly_webbpsf_options': {}, 'on_the_fly_webbpsf_opd': None,
                                'on_the_fly_oversample': 3, 'pandeia_fixed_seed': False, 
-                               'cache': 'ram', 'noise': self.default_noise, 
+                               'noise_seed': None,
+                               'cache': 'ram', 'cache_path': None, 'psf_cache_bytes': 2**29,
+                               'psf_cache_readonly': True, 'shared_psf_cache': False,
+                               'shared_psf_cache_bytes': 2**30,
+                               'psf_offset_mode': 'exact', 'psf_offset_grid': 0.002,
+                               'psf_offset_tolerance': 0.001, 'psf_prefetch': 'none',
+                               'psf_prefetch_workers': None, 'broadband_psf': False,
+                               'source_cache': False, 'source_cache_bytes': 2**28,
+                               'wave_grid': None, 'wave_grid_resolution': 2000, 'products': None,
+                               'noise': self.default_noise, 
                                'effects': self.default_effects, 'verbose': False}
         for item in self.default_params.keys():
             setattr(self, "_"+item, kwargs.get(item, self.default_params[item]))
         self._config = None
+        self._psf_requests = None
         self._saved_options = None
     
     @property
@@ -42,6 +54,18 @@ class EngineConfiguration(object):
         """
         self._config = value
 
+    @property
+    def psf_requests(self):
+        """
+        While engine.prepare_psfs makes its dry run, a dictionary in which the PSFs that the
+        calculations ask for are recorded, by key, rather than generated. None otherwise.
+        """
+        return self._psf_requests
+    
+    @psf_requests.setter
+    def psf_requests(self, value):
+        self._psf_requests = value
+
     @property
     def verbose(self):
         return self._verbose
@@ -129,6 +153,309 @@ class EngineConfiguration(object):
         if value in ['none', 'disk', 'ram']:
             self._cache = value
     
+    @property
+    def cache_path(self):
+        '''
+        Directory holding the on-disk PSF store used when cache is 'disk'. PSFs are stored by a hash
+        of every input that affects them, so one directory can safely be shared between
+        instruments, filters and webbpsf options. Leaving it at None uses a 'pancake_psf_cache'
+        directory in the current working directory.
+        '''
+        return self._cache_path
+    
+    @cache_path.setter
+    def cache_path(self, value):
+        self._cache_path = value
+    
+    @property
+    def psf_cache_bytes(self):
+        '''
+        Size, in bytes, of the in-memory PSF cache used when cache is 'ram' or 'disk'. The least
+        recently used PSFs are dropped once the cached PSF images add up to more than this. The
+        default is 512 MiB.
+        '''
+        return self._psf_cache_bytes
+    
+    @psf_cache_bytes.setter
+    def psf_cache_bytes(self, value):
+        if sys.version_info[0] >= 3:
+            var_types = (int,)
+        else:
+            var_types = (int, long)
+        if isinstance(value, var_types) and value >= 0:
+            self._psf_cache_bytes = value
+    
+    @property
+    def psf_cache_readonly(self):
+        '''
+        If True (the default), PSFs handed out by the in-memory cache share their (read-only) image
+        arrays with the cache. Set this to False to get a private, writeable copy of every PSF.
+        '''
+        return self._psf_cache_readonly
+    
+    @psf_cache_readonly.setter
+    def psf_cache_readonly(self, value):
+        if isinstance(value, bool):
+            self._psf_cache_readonly = value
+    
+    @property
+    def shared_psf_cache(self):
+        '''
+        If True, and cache is 'ram', the worker processes started by calculate_batch share a
+        temporary PSF arena (in /dev/shm where available), so that a PSF computed by one worker is
+        read directly from shared memory by all of the others rather than being recomputed. The
+        arena holds at most shared_psf_cache_bytes of PSFs, and is deleted when the batch finishes.
+        With cache set to 'disk', the workers already share the on-disk PSF store, and this option
+        has no effect. The default is False.
+        '''
+        return self._shared_psf_cache
+    
+    @shared_psf_cache.setter
+    def shared_psf_cache(self, value):
+        if isinstance(value, bool):
+            self._shared_psf_cache = value
+    
+    @property
+    def shared_psf_cache_bytes(self):
+        '''
+        Size, in bytes, of the shared PSF arena (see shared_psf_cache). Once the arena is full, newly
+        computed PSFs are kept only in each worker's own RAM cache. Since the arena usually lives in
+        shared memory, this counts against system RAM. The default is 1 GiB.
+        '''
+        return self._shared_psf_cache_bytes
+    
+    @shared_psf_cache_bytes.setter
+    def shared_psf_cache_bytes(self, value):
+        if sys.version_info[0] >= 3:
+            var_types = (int,)
+        else:
+            var_types = (int, long)
+        if isinstance(value, var_types) and value >= 0:
+            self._shared_psf_cache_bytes = value
+    
+    @property
+    def psf_offset_mode(self):
+        '''
+        How on-the-fly PSFs are generated for a source offset. Random target acquisition and
+        small-grid dither errors give every calculation a slightly different offset, so by default
+        every calculation needs its own set of webbpsf PSFs. The options are:
+            - 'exact': generate the PSF for the exact offset (the default)
+            - 'snap': use the PSF for the nearest point of a polar grid of offsets, with grid
+              points spaced by psf_offset_grid arcseconds both radially and azimuthally
+            - 'interpolate': as 'snap', but Fourier-shift the grid PSF so that its sub-pixel
+              position matches that of the exact offset
+        In the 'snap' and 'interpolate' modes, offsets more than psf_offset_tolerance arcseconds
+        away from their nearest grid point still get an exact PSF.
+        '''
+        return self._psf_offset_mode
+    
+    @psf_offset_mode.setter
+    def psf_offset_mode(self, value):
+        if value in ['exact', 'snap', 'interpolate']:
+            self._psf_offset_mode = value
+    
+    @property
+    def psf_offset_grid(self):
+        '''
+        Spacing, in arcseconds, of the grid of source offsets used when psf_offset_mode is 'snap'
+        or 'interpolate'. The default is 2 mas.
+        '''
+        return self._psf_offset_grid
+    
+    @psf_offset_grid.setter
+    def psf_offset_grid(self, value):
+        if isinstance(value, (int, float)) and value > 0:
+            self._psf_offset_grid = value
+    
+    @property
+    def psf_offset_tolerance(self):
+        '''
+        Largest distance, in arcseconds, between a source offset and the grid point whose PSF is
+        used in its place when psf_offset_mode is 'snap' or 'interpolate'. This bounds the offset
+        error (the on-sky distance between the two positions) of every snapped PSF; offsets further
+        than this from their nearest grid point get an exact PSF. Since no offset is more than about
+        0.7 psf_offset_grid from a grid point, a tolerance at or above that snaps every offset. The
+        default is 1 mas.
+        '''
+        return self._psf_offset_tolerance
+    
+    @psf_offset_tolerance.setter
+    def psf_offset_tolerance(self, value):
+        if isinstance(value, (int, float)) and value >= 0:
+            self._psf_offset_tolerance = value
+    
+    @property
+    def psf_prefetch(self):
+        '''
+        How the on-the-fly PSFs needed for a scene are generated. Pandeia asks for PSFs one
+        wavelength at a time, so by default they are generated one after another on a single core.
+        The options are:
+            - 'none': generate each PSF when Pandeia asks for it (the default)
+            - 'thread': generate all of the PSFs up front in a pool of threads
+            - 'process': generate all of the PSFs up front in a pool of processes. Inside the
+              worker processes of calculate_batch, which can't start processes of their own, this
+              falls back to 'thread'.
+        Prefetched PSFs go into the PSF cache, so this has no effect when cache is 'none'. The
+        pools are kept for later calculations (see pandeia_subclasses.close_prefetch_pools).
+        '''
+        return self._psf_prefetch
+    
+    @psf_prefetch.setter
+    def psf_prefetch(self, value):
+        if value in ['none', 'thread', 'process']:
+            self._psf_prefetch = value
+    
+    @property
+    def psf_prefetch_workers(self):
+        '''
+        Number of threads or processes used when psf_prefetch is 'thread' or 'process'. None (the
+        default) uses one per CPU.
+        '''
+        return self._psf_prefetch_workers
+    
+    @psf_prefetch_workers.setter
+    def psf_prefetch_workers(self, value):
+        if value is None or (isinstance(value, int) and value > 0):
+            self._psf_prefetch_workers = value
+    
+    @property
+    def broadband_psf(self):
+        '''
+        If True, imaging calculations skip building a convolved flux cube with one plane per
+        wavelength. Instead, each source is convolved once with a broadband PSF: the monochromatic
+        PSFs weighted by its spectrum, the system throughput and the quantum yield. This gives the
+        same detector rates for a fraction of the convolutions, but the flux cubes in the report
+        only hold the total over the field at each wavelength. The default is False.
+        '''
+        return self._broadband_psf
+    
+    @broadband_psf.setter
+    def broadband_psf(self, value):
+        if isinstance(value, bool):
+            self._broadband_psf = value
+    
+    @property
+    def source_cache(self):
+        '''
+        If True, calculations taking the broadband_psf route keep the detector rate and variance
+        images of each source, normalized to unit flux, in memory. A later calculation with the same
+        source (position, shape and spectral shape), instrument configuration and wavelength grid
+        then scales the cached images by the source's flux instead of convolving it again, so
+        changing only the brightness of sources in a scene needs no convolutions at all. The
+        default is False.
+        '''
+        return self._source_cache
+    
+    @source_cache.setter
+    def source_cache(self, value):
+        if isinstance(value, bool):
+            self._source_cache = value
+    
+    @property
+    def source_cache_bytes(self):
+        '''
+        Size, in bytes, of the in-memory source cache (see source_cache). The default is 256 MiB.
+        '''
+        return self._source_cache_bytes
+    
+    @source_cache_bytes.setter
+    def source_cache_bytes(self, value):
+        if sys.version_info[0] >= 3:
+            var_types = (int,)
+        else:
+            var_types = (int, long)
+        if isinstance(value, var_types) and value >= 0:
+            self._source_cache_bytes = value
+    
+    @property
+    def wave_grid(self):
+        '''
+        Wavelengths at which imaging calculations sample the scene (and so generate PSFs). The
+        options are:
+            - None: use Pandeia's wavelengths, which depend on the source spectra (the default)
+            - 'canonical': use a global log-spaced grid (see wave_grid_resolution), thinned to
+              roughly wave_sampling points across the instrument's wavelength range
+            - a list of wavelengths, in microns: use the ones that fall within the instrument's
+              wavelength range
+        With a fixed grid, PSFs generated for one calculation can be reused for any other target
+        or spectrum observed with the same setup.
+        '''
+        return self._wave_grid
+    
+    @wave_grid.setter
+    def wave_grid(self, value):
+        if value is None or (isinstance(value, str) and value == 'canonical'):
+            self._wave_grid = value
+        elif isinstance(value, (list, tuple, np.ndarray)) and len(value) > 1:
+            self._wave_grid = [float(wave) for wave in value]
+    
+    @property
+    def wave_grid_resolution(self):
+        '''
+        Resolution (wave / delta wave) of the canonical wavelength grid used when wave_grid is
+        'canonical'. The default is 2000.
+        '''
+        return self._wave_grid_resolution
+    
+    @wave_grid_resolution.setter
+    def wave_grid_resolution(self, value):
+        if isinstance(value, (int, float)) and value > 0:
+            self._wave_grid_resolution = value
+    
+    @property
+    def products(self):
+        '''
+        Report products kept from each calculation, as a list of paths into the pandeia report
+        dictionary with keys separated by dots (e.g. ['2d.detector', 'scalar.sn']). Everything else
+        is dropped as soon as the calculation finishes, so batches in worker processes send back and
+        keep only what's needed. None (the default) keeps the full report.
+        '''
+        return self._products
+    
+    @products.setter
+    def products(self, value):
+        if value is None:
+            self._products = None
+        elif isinstance(value, str):
+            self._products = [value]
+        elif isinstance(value, (list, tuple)) and all(isinstance(product, str) for product in value):
+            self._products = list(value)
+    
+    @property
+    def psf_cache_stats(self):
+        '''
+        Runtime statistics for the in-memory PSF cache: hits, misses, evictions, number of entries,
+        bytes in use and the byte budget.
+        '''
+        from .psf_cache import ram_cache
+        return ram_cache.stats()
+    
+    def clear_psf_cache(self, reset_stats=True):
+        '''
+        Empty the in-memory PSF cache (and, by default, zero its statistics).
+        '''
+        from .psf_cache import ram_cache
+        ram_cache.clear()
+        if reset_stats:
+            ram_cache.reset_stats()
+    
+    @property
+    def source_cache_stats(self):
+        '''
+        Runtime statistics for the in-memory source cache, in the same form as psf_cache_stats.
+        '''
+        from .psf_cache import source_cache
+        return source_cache.stats()
+    
+    def clear_source_cache(self, reset_stats=True):
+        '''
+        Empty the in-memory source cache (and, by default, zero its statistics).
+        '''
+        from .psf_cache import source_cache
+        source_cache.clear()
+        if reset_stats:
+            source_cache.reset_stats()
+    
     @property
     def noise(self):
         '''
@@ -242,6 +569,25 @@ class EngineConfiguration(object):
     def pandeia_fixed_seed(self, value):
         self._pandeia_fixed_seed = value
     
+    @property
+    def noise_seed(self):
+        '''
+        Seed for the noise pandeia adds to a calculation, unless pandeia_fixed_seed is set. The
+        default (None) gives a new noise realization every time. Functions that run many
+        calculations (calculate_batch, calculate_subtracted, calculate_contrast_curve) take a seed
+        argument instead, and give each calculation its own seed derived from it (see rng.py).
+        '''
+        return self._noise_seed
+    
+    @noise_seed.setter
+    def noise_seed(self, value):
+        if sys.version_info[0] >= 3:
+            var_types = (int,)
+        else:
+            var_types = (int, long)
+        if value is None or (isinstance(value, var_types) and 0 <= value < 2**32):
+            self._noise_seed = value
+    
     @property
     def pandeia_noise(self):
         '''
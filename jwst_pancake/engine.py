@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 # Just build an actual subclass of the necessary JWST classes
 
+from contextlib import contextmanager
 from copy import deepcopy
 from glob import glob
 import json
@@ -14,10 +15,30 @@ import astropy.units as units
 import astropy.io.fits as fits
 from poppy import poppy_core
 
-if sys.version_info > (3, 2):
-    from functools import lru_cache
+if sys.version_info >= (3, 7):
+    from contextvars import ContextVar
 else:
-    from functools32 import lru_cache
+    import threading
+
+    class ContextVar(object):
+        '''
+        Minimal stand-in for contextvars.ContextVar (Python 3.7+), scoped to the current thread.
+        '''
+        def __init__(self, name, default=None):
+            self.name = name
+            self._default = default
+            self._local = threading.local()
+
+        def get(self):
+            return getattr(self._local, 'value', self._default)
+
+        def set(self, value):
+            token = self.get()
+            self._local.value = value
+            return token
+
+        def reset(self, token):
+            self._local.value = token
 
 import numpy as np
 
@@ -35,6 +56,8 @@ from pandeia.engine.constants import SPECTRAL_MAX_SAMPLES
 default_SPECTRAL_MAX_SAMPLES = SPECTRAL_MAX_SAMPLES
 from pandeia.engine.etc3D import DetectorSignal
 PandeiaDetectorSignal = DetectorSignal
+from pandeia.engine.report import ReportFactory
+PandeiaReportFactory = ReportFactory
 
 try:
     import webbpsf
@@ -42,7 +65,14 @@ except ImportError:
     pass
 
 from .pandeia_subclasses import CoronagraphyPSFLibrary, CoronagraphyConvolvedSceneCube, CoronagraphyDetectorSignal
+from .pandeia_subclasses import _store_psf_in_process
 from .config import EngineConfiguration
+from .pool import EnginePool
+from .rng import generator, global_random_lock, noise_seed, seed_sequence
+from .taskgraph import CalculationGraph
+from .psf_cache import get_store
+from .reexpose import ExposureScan
+from .archive import ResultArchive
 from . import templates
 from . import analysis
 # from .templates import templates
@@ -50,10 +80,13 @@ from . import analysis
 # Initialize the engine options
 options = EngineConfiguration()
 
+# The options in use by the calculation running in the current thread/context (see private_options)
+_scoped_options = ContextVar('pancake_options', default=None)
+# The noise seed pandeia asked for at the start of the calculation running in the current
+# thread/context (see _report_factory)
+_calculation_seed = ContextVar('pancake_calculation_seed', default=None)
+
 latest_on_the_fly_PSF = None
-cache_maxsize = 256     # Number of monochromatic PSFs stored in an LRU cache
-                        # Should speed up calculations that involve modifying things
-                        # like exposure time and don't actually require calculating new PSFs.
 
 
 def get_template(filename):
@@ -77,30 +110,223 @@ def save_calculation(calcfile,filename):
     with open(filename, 'w+') as f:
         json.dump(calcfile, f, indent=2)
 
-def save_to_fits(array,filename):
+def save_to_fits(array,filename,extensions=None):
+    '''
+    Save an array to a FITS file, with an optional list of (name, array) image extensions.
+    '''
     hdu = fits.PrimaryHDU(array)
-    hdulist = fits.HDUList([hdu])
+    hdulist = fits.HDUList([hdu] + [fits.ImageHDU(data, name=name) for name, data in (extensions or [])])
     hdulist.writeto(filename)
 
 def get_options():
     '''
     This returns the options object, and is used to let the various Pandeia-based subclasses get
-    the options object currently in use.
+    the options object currently in use. Inside a calculation (or a private_options block) that is
+    the private copy belonging to it, and otherwise the module-level options.
     '''
+    scoped = _scoped_options.get()
+    if scoped is not None:
+        return scoped
     return options
 
-def calculate_batch(calcfiles,nprocesses=None):
-    if nprocesses is None:
-        nprocesses = mp.cpu_count()
-    pool = mp.Pool(processes = nprocesses)
-    results = pool.map(perform_calculation, calcfiles)
-    pool.close()
-    pool.join()
+@contextmanager
+def using_options(scoped):
+    '''
+    Make an EngineConfiguration the options in use (as returned by get_options) for the enclosed
+    code in the current thread/context.
+    '''
+    token = _scoped_options.set(scoped)
+    try:
+        yield scoped
+    finally:
+        _scoped_options.reset(token)
+
+@contextmanager
+def private_options(current_options=None):
+    '''
+    Run the enclosed code with a private copy of the options currently in use, optionally updated
+    from a current_options dictionary. Changes made to the copy don't leak out of the block, or
+    into calculations running in other threads:
+
+        with private_options() as calc_options:
+            calc_options.set_saturation(False)
+            result = perform_calculation(config)
+    '''
+    outer = get_options()
+    scoped = EngineConfiguration()
+    scoped.current_options = _copy_options(outer.current_options)
+    if current_options is not None:
+        scoped.current_options = _copy_options(current_options)
+    scoped.current_config = outer.current_config
+    scoped.psf_requests = outer.psf_requests
+    with using_options(scoped):
+        yield scoped
+
+def _copy_options(current_options):
+    '''
+    Copy an options dictionary, giving it its own copy of the dictionary-valued options. Other
+    values (e.g. an OPD HDUList) are shared rather than copied, which is cheaper and keeps the OPD
+    digests of psf_cache.opd_key valid.
+    '''
+    return dict((key, dict(value) if isinstance(value, dict) else value) for key, value in current_options.items())
 
-    np.random.seed(None) # reset Pandeia seed
+def _psf_library(*args, **kwargs):
+    '''
+    Stands in for pandeia.engine.instrument.PSFLibrary, picking the PSF library class for the
+    calculation in progress.
+    '''
+    if _scoped_options.get() is not None and get_options().on_the_fly_PSFs:
+        return CoronagraphyPSFLibrary(*args, **kwargs)
+    return PandeiaPSFLibrary(*args, **kwargs)
+
+def _detector_signal(*args, **kwargs):
+    '''
+    Stands in for pandeia.engine.etc3D.DetectorSignal, picking the detector signal class for the
+    calculation in progress.
+    '''
+    if _scoped_options.get() is not None and get_options().on_the_fly_PSFs:
+        return CoronagraphyDetectorSignal(*args, **kwargs)
+    return PandeiaDetectorSignal(*args, **kwargs)
+
+def _get_random_seed(self):
+    '''
+    Stands in for pandeia's Observation.get_random_seed, giving pancake calculations
+    options.noise_seed (by default a new realization) unless options.pandeia_fixed_seed is set.
+    '''
+    if _scoped_options.get() is None:
+        return pandeia_seed(self)
+    if get_options().pandeia_fixed_seed:
+        seed = pandeia_seed(self)
+    else:
+        seed = random_seed(self)
+    # Pandeia seeds numpy's global random state with this, but only draws from it while building
+    # the report, so keep it for _report_factory
+    _calculation_seed.set(seed)
+    return seed
+
+def _report_factory(*args, **kwargs):
+    '''
+    Stands in for pandeia.engine.etc3D.ReportFactory, which draws the noise of a calculation. For
+    pancake calculations, numpy's global random state is seeded again (with the seed pandeia asked
+    for at the start of the calculation) and the report built while holding global_random_lock, so
+    that calculations running in other threads get the same noise as they would one at a time.
+    '''
+    if _scoped_options.get() is None:
+        return PandeiaReportFactory(*args, **kwargs)
+    with global_random_lock:
+        np.random.seed(seed=_calculation_seed.get())
+        return PandeiaReportFactory(*args, **kwargs)
+
+# Pandeia looks these up at call time. Outside of a pancake calculation, the stand-ins behave
+# exactly like pandeia's own versions.
+pandeia.engine.instrument.PSFLibrary = _psf_library
+pandeia.engine.etc3D.DetectorSignal = _detector_signal
+pandeia.engine.observation.Observation.get_random_seed = _get_random_seed
+pandeia.engine.etc3D.ReportFactory = _report_factory
+
+def calculate_batch(calcfiles,nprocesses=None,seed=None,products=None,archive=None):
+    """
+    Run a list of calculations in a temporary pool of worker processes. To keep the workers (and
+    their caches) between batches, or to stream results back as they finish, use an EnginePool.
+
+    If seed is given, each calculation gets its own noise seed derived from it and from the
+    calculation's position in the list, so the results don't depend on nprocesses. If products is
+    given, it replaces options.products for the batch, and the workers only send back those report
+    products (e.g. ['2d.detector']).
+
+    If archive (a directory name, or an archive.ResultArchive) is given, each result is written to
+    the archive as soon as it arrives, rather than kept in memory, and the archive is returned.
+    Calculations already in the archive are skipped, so a batch that was interrupted can be
+    resumed by running it again (with the same seed, if any).
+    """
+    with private_options() as batch_options:
+        if products is not None:
+            batch_options.products = products
+        if archive is not None:
+            return _calculate_batch_to_archive(calcfiles, nprocesses, seed, archive)
+        with EnginePool(nprocesses, warm=False) as pool:
+            results = pool.map(calcfiles, seed=seed)
 
     return results
 
+def _calculate_batch_to_archive(calcfiles, nprocesses, seed, archive):
+    """
+    Run the calculations of a batch that aren't in an archive yet, storing each result as it arrives.
+    """
+    if not isinstance(archive, ResultArchive):
+        archive = ResultArchive(archive)
+    calcfiles = list(calcfiles)
+    current_options = get_options().current_options
+    skip = set()
+    for index, calcfile in enumerate(calcfiles):
+        if index in archive:
+            if not archive.matches(index, calcfile, current_options, seed):
+                raise ValueError("Calculation {} in {} doesn't match the batch (its calculation, options, "
+                                 "products or seed differ)".format(index, archive.path))
+            skip.add(index)
+    if len(skip) < len(calcfiles):
+        with EnginePool(nprocesses, warm=False) as pool:
+            for index, result in pool.imap(calcfiles, seed=seed, skip=skip):
+                archive.put(index, result, calcfiles[index], current_options, seed)
+    return archive
+
+def prepare_psfs(calcfiles, nprocesses=None):
+    """
+    Generate, ahead of time and in parallel, every on-the-fly PSF that a list of calculations will
+    need, and add them to the on-disk PSF store (options.cache_path). Later runs of those
+    calculations with cache set to 'disk' then don't have to call webbpsf at all.
+
+    Each calculation is first run with placeholder PSFs to find out which PSFs it asks for, so
+    calculations that add random offsets (e.g. target acquisition errors) will only have the PSFs
+    for their particular draw prepared, unless psf_offset_mode is 'snap' or 'interpolate'.
+
+    Parameters
+    ----------
+    calcfiles: list
+        Calculations, in any of the forms accepted by process_config (JSON file name, pandeia
+        configuration dictionary, or instrument configuration dictionary)
+    nprocesses: int, default None
+        Number of processes to generate PSFs with. Defaults to one per CPU.
+
+    Returns
+    -------
+    counts: dict
+        Number of distinct PSFs needed ('psfs'), of those already in the store ('present') and of
+        those newly generated ('computed')
+    """
+    counts = {'psfs': 0, 'present': 0, 'computed': 0}
+    options = get_options()
+    if not options.on_the_fly_PSFs:
+        warnings.warn("prepare_psfs only applies to on-the-fly PSFs (options.on_the_fly_PSFs is False)")
+        return counts
+    if options.cache != 'disk':
+        warnings.warn("PSFs prepared in the on-disk store are only used when options.cache is 'disk'")
+
+    requests = {}
+    with private_options() as dry_run_options:
+        dry_run_options.psf_requests = requests
+        for calcfile in calcfiles:
+            perform_calculation(process_config(calcfile, None, None))
+
+    store_path = CoronagraphyPSFLibrary.default_cache_path()
+    store = get_store(store_path)
+    current_options = options.current_options
+    tasks = [((current_options, config), store_path, psf_hash, psf_args)
+             for psf_hash, (config, psf_args) in requests.items() if psf_hash not in store]
+    counts['psfs'] = len(requests)
+    counts['present'] = len(requests) - len(tasks)
+    counts['computed'] = len(tasks)
+
+    if len(tasks) > 0:
+        if nprocesses is None:
+            nprocesses = mp.cpu_count()
+        pool = mp.Pool(processes = min(nprocesses, len(tasks)))
+        pool.map(_store_psf_in_process, tasks)
+        pool.close()
+        pool.join()
+
+    return counts
+
 def calculate_all(raw_config):
     """
     Run a pandeia coronagraphy calculation. Output will be:
@@ -110,14 +336,20 @@ def calculate_all(raw_config):
     In pandeia 1.3, this can be done as a single calculation, with the results obtained from
     sub-reports. In pandeia 1.2, the sub-reports are not actually returned properly, so the overall
     calculation needs to be run 3 times.
+
+    If options.products is set, only those products of each report are kept.
     """
     output = {'target': {}, 'reference': {}, 'contrast': {}}
     pandeia_version = pkg_resources.get_distribution('pandeia.engine').version
     if pandeia_version >= "1.3":
-        result = perform_calculation(deepcopy(raw_config))
-        output['target'] = result['sub_reports'][0]
-        output['reference'] = result['sub_reports'][1]
-        output['contrast'] = result['sub_reports'][2]
+        # options.products refer to the products of each sub-report, so they are picked out below
+        with private_options() as calc_options:
+            products = calc_options.products
+            calc_options.products = None
+            result = perform_calculation(deepcopy(raw_config))
+        output['target'] = select_products(result['sub_reports'][0], products)
+        output['reference'] = select_products(result['sub_reports'][1], products)
+        output['contrast'] = select_products(result['sub_reports'][2], products)
     else:
         output['target'] = calculate_target(raw_config)
         output['reference'] = calculate_reference(raw_config)
@@ -128,91 +360,137 @@ def calculate_target(raw_config):
     """
     Run a pandeia coronagraphy calculation in target-only mode
     """
-    config = deepcopy(raw_config)
-    config['strategy']['psf_subtraction'] = 'target_only'
-    return perform_calculation(config)
+    return perform_calculation(_target_config(raw_config))
 
 def calculate_reference(raw_config):
     """
     Run a pandeia coronagraphy calculation in target-only mode, replacing the target scene with
     the scene stored in the coronagraphy strategy PSF subtraction source.
     """
-    config = deepcopy(raw_config)
-    config['strategy']['psf_subtraction'] = 'target_only'
-    config['scene'] = [deepcopy(config['strategy']['psf_subtraction_source'])]
-    return perform_calculation(config)
+    return perform_calculation(_reference_config(raw_config))
 
 def calculate_contrast(raw_config, offset_x=0.5, offset_y=0.5):
     """
     Run a pandeia coronagraphy calculation in target-only mode, with the target offset to be
     unocculted, and with saturation disabled.
     """
-    from .scene import offset_scene
+    config = _contrast_config(raw_config, offset_x, offset_y)
+    with private_options() as calc_options:
+        calc_options.set_saturation(False)
+        contrast_result = perform_calculation(config)
+    return contrast_result
 
+def _target_config(raw_config):
     config = deepcopy(raw_config)
     config['strategy']['psf_subtraction'] = 'target_only'
-    saturation_value = options.effects['saturation']
-    options.set_saturation(False)
+    return config
+
+def _reference_config(raw_config):
+    config = _target_config(raw_config)
+    config['scene'] = [deepcopy(config['strategy']['psf_subtraction_source'])]
+    return config
+
+def _contrast_config(raw_config, offset_x=0.5, offset_y=0.5):
+    from .scene import offset_scene
+
+    config = _target_config(raw_config)
     offset_scene(config['scene'], offset_x, offset_y)
-    contrast_result = perform_calculation(config)
-    options.set_saturation(saturation_value)
-    return contrast_result
+    return config
 
-def perform_calculation(calcfile):
+def perform_calculation(calcfile, products=None):
     '''
     Manually decorate pandeia.engine.perform_calculation to circumvent
     pandeia's tendency to modify the calcfile during the calculation.
 
+    The calculation runs with a private copy of the options in use (see private_options), which
+    also holds its configuration, and pandeia is pointed at the pancake PSF library, detector
+    signal and random seed through that copy rather than by swapping module globals. Calculations
+    can therefore run in several threads of one process at once, sharing the PSF caches. Pandeia
+    still draws its noise from numpy's global random state, but does so under global_random_lock
+    (see _report_factory), so that threads don't disturb one another's noise.
+
+    If products (or options.products) is a list of report products, such as ['2d.detector'], only
+    those are returned (see select_products).
+
     Updates to the saturation computation could go here as well.
     '''
-    existing_psf_library = pandeia.engine.psf_library.PSFLibrary
-    existing_scene_cube = pandeia.engine.astro_spectrum.ConvolvedSceneCube
-    existing_detector_signal = pandeia.engine.etc3D.DetectorSignal
-    
-    if options.on_the_fly_PSFs:
-        pandeia.engine.psf_library.PSFLibrary = CoronagraphyPSFLibrary
-        pandeia.engine.instrument.PSFLibrary = CoronagraphyPSFLibrary
-        pandeia.engine.astro_spectrum.ConvolvedSceneCube = CoronagraphyConvolvedSceneCube
-        pandeia.engine.etc3D.DetectorSignal = CoronagraphyDetectorSignal
-    else:
-        pandeia.engine.psf_library.PSFLibrary = PandeiaPSFLibrary
-        pandeia.engine.instrument.PSFLibrary = PandeiaPSFLibrary
-        pandeia.engine.astro_spectrum.ConvolvedSceneCube = PandeiaConvolvedSceneCube
-        pandeia.engine.etc3D.DetectorSignal = PandeiaDetectorSignal
-    if options.pandeia_fixed_seed:
-        pandeia.engine.observation.Observation.get_random_seed = pandeia_seed
-    else:
-        pandeia.engine.observation.Observation.get_random_seed = random_seed
-
-    config = deepcopy(calcfile)
-    config['calculation']['noise'] = options.noise
-    config['calculation']['effects'] = options.effects
-    options.current_config = deepcopy(config)
-    
-    with warnings.catch_warnings():
-        warnings.filterwarnings('ignore', category = np.VisibleDeprecationWarning) # Suppress float-indexing warnings
-        results = pandeia_calculation(config)
+    outer_options = get_options()
+    with private_options() as calc_options:
+        if products is not None:
+            calc_options.products = products
+        config = _calculation_config(calcfile, calc_options)
+        # Left where it has always been, for inspection after the calculation
+        outer_options.current_config = calc_options.current_config
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category = np.VisibleDeprecationWarning) # Suppress float-indexing warnings
+            results = pandeia_calculation(config)
+        results = select_products(results, calc_options.products)
 
     # Reset the fixed seed state set by the pandeia engine
     # to avoid unexpected results elsewhere
-    np.random.seed(None)
-
-    # Reset (potentially) overridden functions
-    pandeia.engine.psf_library.PSFLibrary = existing_psf_library
-    pandeia.engine.instrument.PSFLibrary = existing_psf_library
-    pandeia.engine.astro_spectrum.ConvolvedSceneCube = existing_scene_cube
-    pandeia.engine.etc3D.DetectorSignal = existing_detector_signal
+    with global_random_lock:
+        np.random.seed(None)
 
     return results
 
+def select_products(report, products):
+    '''
+    Return a report dictionary holding only the listed products of report, each given as a path of
+    keys separated by dots (e.g. '2d.detector' for report['2d']['detector']). If products is None,
+    report is returned as it is.
+    '''
+    if products is None:
+        return report
+    selected = {}
+    for product in products:
+        keys = product.split('.')
+        source, target = report, selected
+        try:
+            for key in keys[:-1]:
+                source = source[key]
+                target = target.setdefault(key, {})
+            target[keys[-1]] = source[keys[-1]]
+        except (KeyError, TypeError):
+            raise KeyError("The report has no product {}".format(product))
+    return selected
+
+def _calculation_config(calcfile, calc_options):
+    '''
+    Copy a calculation, applying the noise and effects options, and store it as the options'
+    current configuration.
+    '''
+    config = deepcopy(calcfile)
+    config['calculation']['noise'] = calc_options.noise
+    config['calculation']['effects'] = calc_options.effects
+    calc_options.current_config = deepcopy(config)
+    return config
+
+def calculate_exposures(calcfile, exposures, seed=None):
+    '''
+    Run a calculation once for each of a list of exposure configurations, which update
+    calcfile['configuration']['detector'] (e.g. [{'ngroup': 5}, {'ngroup': 10, 'nint': 2}]).
+    The scene, PSFs and detector count rates are only calculated once, and just the noise,
+    saturation and signal-to-noise are recalculated for each exposure (see reexpose.ExposureScan).
+    Returns the list of reports.
+    '''
+    return ExposureScan(calcfile).reports(exposures, seed=seed)
+
+def calculate_realizations(calcfile, n, exposure=None, seed=None):
+    '''
+    Run a calculation once, and return n noisy realizations of its detector image as an
+    (n, ny, nx) array, drawn all at once from its noiseless signal and noise (see
+    reexpose.noise_realizations). exposure optionally updates calcfile['configuration']['detector']
+    as in calculate_exposures.
+    '''
+    return ExposureScan(calcfile).realizations(n, exposure=exposure, seed=seed)
+
 def random_seed(self):
     '''
     The pandeia engine sets a fixed seed of 42.
-    Circumvent that here.
+    Circumvent that here, using options.noise_seed (None for a new realization every time).
     '''
-    #np.random.seed(None) # Reset the seed if already set
-    #return np.random.randint(0, 2**32 - 1) # Find a new one
-    return None
+    return get_options().noise_seed
 
 def process_config(raw_config, target_scene, reference_scene):
     """
@@ -250,7 +528,8 @@ def process_config(raw_config, target_scene, reference_scene):
             config['strategy']['psf_subtraction_source'] = deepcopy(reference_scene)
     return config
 
-def calculate_subtracted(raw_config, target=None, reference=None, ta_error=False, sgd=False, stepsize=20.e-3):
+def calculate_subtracted(raw_config, target=None, reference=None, ta_error=False, sgd=False, stepsize=20.e-3,
+                         parallel=None, nprocesses=None, seed=None):
     """
     This is a function to calculate subtracted images with an optional reference image 
     small-grid dither (SGD). It does the following:
@@ -268,6 +547,11 @@ def calculate_subtracted(raw_config, target=None, reference=None, ta_error=False
         - list of reference images
         - artificial PSF
         - subtracted image
+
+    Every reference, including the first, is observed at its own SGD position. (Before version 2.0,
+    the first reference was observed at the undithered position instead.) The target and
+    references are independent calculations, so they can run in parallel, with the same results
+    for the same seed.
     
     Parameters
     ----------
@@ -290,6 +574,15 @@ def calculate_subtracted(raw_config, target=None, reference=None, ta_error=False
         Whether to create a small-grid dither (SGD) for the reference scene.
     stepsize: float, default 0.02
         Size of the offsets in the SGD (if present), in arcseconds.
+    parallel: str, default None
+        How to run the target and reference calculations: None for one after the other, 'thread'
+        or 'process' to run them in a pool of threads or processes (see taskgraph.CalculationGraph).
+    nprocesses: int, default None
+        Number of threads or processes for a parallel run. Defaults to one per CPU.
+    seed: int or numpy.random.SeedSequence, default None
+        Seed for the TA and FSM errors and for the noise in each calculation (see rng.py). Runs
+        with the same seed give the same results, whether they are parallel or not. The default
+        draws a new seed, whose entropy is returned.
 
     Returns
     -------
@@ -297,43 +590,46 @@ def calculate_subtracted(raw_config, target=None, reference=None, ta_error=False
     references: list of numpy arrays containing <iterations> detector slopes of the reference
     psf: artificial PSF created with klip
     subtracted: numpy array containing <iterations> reference-subtracted target images
+    seed: entropy of the seed used, which reproduces the run when passed back in as seed
     """
     from .scene import create_SGD, get_ta_error, offset_scene
-    from .analysis import klip_projection, register_to_target
+    from .analysis import klip_projection
     
     config = process_config(raw_config, target, reference)
 
+    root_seed = seed_sequence(seed)
+    error_seed, calculation_seed = root_seed.spawn(2)
+    rng = generator(error_seed)
+
     if ta_error:
         # add a unique TA error for the target
-        errx, erry = get_ta_error()
+        errx, erry = get_ta_error(rng=rng)
         offset_scene(config['scene'], errx, erry)
     
     if sgd:
-        sgds = create_SGD(ta_error, stepsize=stepsize)
+        sgds = create_SGD(ta_error, stepsize=stepsize, rng=rng)
     else:
-        sgds = create_SGD(ta_error, stepsize=stepsize, pattern_name="SINGLE-POINT")
+        sgds = create_SGD(ta_error, stepsize=stepsize, pattern_name="SINGLE-POINT", rng=rng)
     
-    first_config = deepcopy(config)
-    offset_scene([first_config['strategy']['psf_subtraction_source']], *sgds[0])
-
-    first_result = calculate_all(config)
-    target_slope = first_result['target']['2d']['detector']
-    sgd_results = [first_result['reference']]
-    for sgd in sgds[1:]:
-        sgd_config = deepcopy(config)
-        offset_scene([sgd_config['strategy']['psf_subtraction_source']], *sgd)
-        sgd_results.append(calculate_reference(sgd_config))
-
-    sgd_reg = []
-    sgd_slopes = []
-    for r in sgd_results:
-        slope = r['2d']['detector']
-        sgd_slopes.append(slope)
-        mask = np.where(np.isnan(slope), 1., 0.)
-        reg = register_to_target(slope, target_slope, mask=mask, rescale_reference=True)
-        sgd_reg.append(reg)
-
-    sgd_reg = np.array(sgd_reg)
+    # Each reference position is independent of the others, and of the target, so they can all be
+    # calculated at the same time, and then registered to the target together.
+    calculation_seeds = calculation_seed.spawn(1 + len(sgds))
+    graph = CalculationGraph()
+    with private_options() as subtraction_options:
+        # Only the detector images are used
+        subtraction_options.products = ['2d.detector']
+        target_node = _add_calculation(graph, _target_config(config), calculation_seeds[0])
+        reference_nodes = []
+        for i, sgd in enumerate(sgds):
+            sgd_config = deepcopy(config)
+            offset_scene([sgd_config['strategy']['psf_subtraction_source']], *sgd)
+            reference_nodes.append(_add_calculation(graph, _reference_config(sgd_config), calculation_seeds[1 + i]))
+        registration_node = graph.add_function('registration', _register_references, target_node,
+                                               *reference_nodes)
+        results = graph.run(parallel=parallel, nprocesses=nprocesses)
+
+    target_slope = results[target_node]['2d']['detector']
+    sgd_slopes, sgd_reg = results[registration_node]
 
     centered_target = target_slope - np.nanmean(target_slope)
     artificialPSF = klip_projection(centered_target,sgd_reg)
@@ -344,12 +640,56 @@ def calculate_subtracted(raw_config, target=None, reference=None, ta_error=False
                     'target': target_slope,
                     'references': sgd_slopes,
                     'psf': artificialPSF,
-                    'subtracted': sgd_sub
+                    'subtracted': sgd_sub,
+                    'seed': root_seed.entropy
                 }
 
     return output
 
-def calculate_contrast_curve(raw_config, target=None, reference=None, ta_error=True, iterations=5, keep_options=False):
+def _add_calculation(graph, config, seed):
+    """
+    Add a calculation to a CalculationGraph, with its own noise seed (derived from seed), so that
+    calculations with different seeds are never merged. Only with options.pandeia_fixed_seed, where
+    pandeia ignores the noise seed, is every calculation deterministic (switching off every
+    options.noise source still leaves the photon noise), so that identical ones can be merged.
+    """
+    if get_options().pandeia_fixed_seed:
+        return graph.add_calculation(config)
+    with private_options() as calc_options:
+        calc_options.noise_seed = noise_seed(seed)
+        return graph.add_calculation(config)
+
+def _register_references(target_report, *reference_reports):
+    """
+    Align and scale a stack of reference images to a target image, with each reference weighted by
+    its own NaN mask. Returns the list of reference images and the stack of registered references.
+    """
+    from .analysis import register_stack
+
+    slopes = [reference_report['2d']['detector'] for reference_report in reference_reports]
+    masks = np.array([np.where(np.isnan(slope), 1., 0.) for slope in slopes])
+    reg, _ = register_stack(np.array(slopes), target_report['2d']['detector'], mask=masks, rescale_reference=True)
+    return slopes, reg
+
+def _subtract_reference(target_report, reference_report):
+    """
+    Align and scale a reference image to a target image, and subtract it from the mean-centred target
+    """
+    targ = target_report['2d']['detector']
+    aligned_ref = analysis.register_to_target(reference_report['2d']['detector'], targ) # Aligned, scaled, mean-centered reference
+    return targ - np.nanmean(targ) - aligned_ref # Mean-center target and subtract reference
+
+def _contrast_aperture(image_dim, radius=5):
+    """
+    Circular aperture image used for contrast curves, centred on an image of shape image_dim
+    """
+    from skimage import draw
+    aperture_image = np.zeros(image_dim)
+    aperture_image[draw.circle((image_dim[0] - 1) // 2, (image_dim[1] - 1) // 2, radius)] = 1
+    return aperture_image
+
+def calculate_contrast_curve(raw_config, target=None, reference=None, ta_error=True, iterations=5, keep_options=False,
+                             parallel=None, nprocesses=None, seed=None, tolerance=None, stream=False):
     """
     This is a replacement for the Pandeia calculate_contrast function. It is designed to use the
     various internal analysis functions to do the following:
@@ -361,11 +701,16 @@ def calculate_contrast_curve(raw_config, target=None, reference=None, ta_error=T
         - Generate an aperture image
         - Run the analysis contrast utility method
     It will return:
-        - list of target images
-        - list of reference images
+        - list of target images (unless stream is set)
+        - list of reference images (unless stream is set)
         - off-axis image
-        - list of subtracted images
+        - list of subtracted images (unless stream is set)
         - normalized contrast profile (with reference bins)
+
+    Each subtracted image is added to a running estimate of the noise map (see
+    analysis.ContrastAccumulator) as soon as it is ready. With stream set, it is then dropped along
+    with the images it was made from, and the covariance and aperture matrices are not built, so
+    memory use doesn't grow with the number of iterations or the square of the image size.
     
     Parameters
     ----------
@@ -387,19 +732,46 @@ def calculate_contrast_curve(raw_config, target=None, reference=None, ta_error=T
     iterations: int, default=1
         Number of times to iterate generating TA errors and observing the target and reference
         source
+    keep_options: bool, default False
+        Use the current options as they are, rather than on-the-fly PSFs with a wave_sampling of 6
+    parallel: str, default None
+        How to run the calculations: None for one after the other, 'thread' or 'process' to run
+        independent calculations in a pool of threads or processes (see taskgraph.CalculationGraph).
+        Identical calculations (e.g. every reference when there are no TA errors and
+        options.pandeia_fixed_seed is set) are only run once either way.
+    nprocesses: int, default None
+        Number of threads or processes for a parallel run. Defaults to one per CPU.
+    seed: int or numpy.random.SeedSequence, default None
+        Seed for the TA and FSM errors and for the noise in each calculation (see rng.py). Runs
+        with the same seed give the same results, whether they are parallel or not. The default
+        draws a new seed, whose entropy is returned.
+    tolerance: float, default None
+        If given, stop early once an iteration changes the normalized contrast profile by less
+        than this fraction at every radius. iterations is then the largest number of iterations.
+    stream: bool, default False
+        Drop the target, reference and subtracted images of each iteration once they have been
+        added to the noise map, and don't build the covariance and aperture matrices. Those outputs
+        are then None.
 
     Returns
     -------
-    targets: list of numpy arrays containing <iterations> detector slopes of the target
-    references: list of numpy arrays containing <iterations> detector slopes of the reference
+    targets: list of numpy arrays containing <iterations> detector slopes of the target (None
+        if stream is set)
+    references: list of numpy arrays containing <iterations> detector slopes of the reference (None
+        if stream is set)
     unocculted: numpy array of the detector slopes of the unocculted source
     subtractions: list of numpy arrays containing <iterations> reference-subtracted target images
+        (None if stream is set)
+    covariance_matrix: covariance matrix of the subtractions (None if stream is set)
+    aperture_matrix: aperture matrix of the aperture image (None if stream is set)
     contrast: list of numpy arrays containing:
         bins: bins used for the normalized contrast profile
         contrast: normalized contrast profile
+    iterations: number of iterations run
+    converged: whether the profile converged within tolerance (always False without a tolerance)
+    seed: entropy of the seed used, which reproduces the run when passed back in as seed
     """
     from .scene import get_ta_error, offset_scene
-    from skimage import draw
     from scipy.ndimage import convolve
     
     capitalized_instruments = {
@@ -411,82 +783,113 @@ def calculate_contrast_curve(raw_config, target=None, reference=None, ta_error=T
 
     config = process_config(raw_config, target, reference)
 
-    # Save existing options    
-    saved_options = options.current_options
-    if not keep_options:
-        options.on_the_fly_PSFs = True
-        options.wave_sampling = 6
-    target_slopes = []
-    reference_slopes = []
-    offaxis_slopes = []
-    print("Starting Iteration")
-    for n in range(iterations):
-        if options.verbose:
-            print("Iteration {} of {}".format(n+1, iterations))
-        current_config = deepcopy(config)
-        if ta_error:
-            # Add unique target acq error to the target
-            offset_scene(current_config['scene'], *get_ta_error() )
-            # Add unique target acq error to the reference
-            offset_scene([current_config['strategy']['psf_subtraction_source']], *get_ta_error())
-        # Adopt a new realization of the WFE.
-        # Note that we're using the same WFE for target and reference here.
-#         if not keep_options:
-#             ins = config['configuration']['instrument']['instrument'].lower()
-#             ote_name = 'OPD_RevW_ote_for_{}_predicted.fits.gz'.format(capitalized_instruments[ins])
-#             options.on_the_fly_webbpsf_opd = (ote_name, n)
-        # Calculate target and reference
-        results = calculate_all(current_config)
-        target_slopes.append(results['target']['2d']['detector'])
-        reference_slopes.append(results['reference']['2d']['detector'])
-        offaxis_slopes.append(results['contrast']['2d']['detector'])
-        print("Finished iteration {} of {}".format(n+1, iterations))
-
-    print("Creating Unocculted Image")
-    offaxis = deepcopy(config)
-    offset_scene(offaxis['scene'], 0.5, 0.5) #arsec
-
-    options.set_saturation(False)
-
-    offaxis_result = calculate_target(offaxis)
-    offaxis_slope = offaxis_result['2d']['detector']
-
-    # Restore original option configuration
-    options.current_options = saved_options
-    
-    print("Creating Subtraction Stack")
-    subtraction_stack = np.zeros((iterations,) + target_slopes[0].shape)
-    for i, (targ, ref) in enumerate(zip(target_slopes, reference_slopes)):
-        aligned_ref = analysis.register_to_target(ref, targ) # Aligned, scaled, mean-centered reference
-        subtraction_stack[i] = targ - np.nanmean(targ) - aligned_ref # Mean-center target and subtract reference
-
-    print("Creating Covariance Matrix")
-    cov_matrix = analysis.covariance_matrix(subtraction_stack)
-
-    print("Creating Aperture Image")
-    image_dim = subtraction_stack[0].shape
-    radius = 5
-    aperture_image = np.zeros(image_dim)
-    aperture_image[draw.circle((image_dim[0] - 1) // 2, (image_dim[1] - 1) // 2, radius)] = 1
-    
-    print("Computing Aperture Matrix")
-    aperture_matrix = analysis.aperture_matrix(aperture_image)
-
-    print("Computing Noise Map")
-    noise_map = analysis.noise_map(cov_matrix, aperture_matrix, image_dim)
-    
-    print("Convolving off-axis image")
+    with private_options() as curve_options:
+        if not keep_options:
+            curve_options.on_the_fly_PSFs = True
+            curve_options.wave_sampling = 6
+        # Only the detector images are used
+        curve_options.products = ['2d.detector']
+        root_seed = seed_sequence(seed)
+        error_seed, calculation_seed = root_seed.spawn(2)
+        rng = generator(error_seed)
+
+        graph = CalculationGraph()
+        iteration_nodes = []
+        for n in range(iterations):
+            current_config = deepcopy(config)
+            if ta_error:
+                # Add unique target acq error to the target
+                offset_scene(current_config['scene'], *get_ta_error(rng=rng) )
+                # Add unique target acq error to the reference
+                offset_scene([current_config['strategy']['psf_subtraction_source']], *get_ta_error(rng=rng))
+            # Adopt a new realization of the WFE.
+            # Note that we're using the same WFE for target and reference here.
+#             if not keep_options:
+#                 ins = config['configuration']['instrument']['instrument'].lower()
+#                 ote_name = 'OPD_RevW_ote_for_{}_predicted.fits.gz'.format(capitalized_instruments[ins])
+#                 options.on_the_fly_webbpsf_opd = (ote_name, n)
+            target_seed, reference_seed, contrast_seed = calculation_seed.spawn(3)
+            target_node = _add_calculation(graph, _target_config(current_config), target_seed)
+            reference_node = _add_calculation(graph, _reference_config(current_config), reference_seed)
+            if n == 0:
+                # Only the first iteration's unocculted image is returned, so later iterations don't
+                # calculate one (but still spawn its seed, so that the noise doesn't change)
+                with private_options() as contrast_options:
+                    contrast_options.set_saturation(False)
+                    contrast_node = _add_calculation(graph, _contrast_config(current_config), contrast_seed)
+                    # Without TA errors, this is the same calculation as the first iteration's unocculted image
+                    offaxis_node = _add_calculation(graph, _contrast_config(config), contrast_seed)
+            subtraction_node = graph.add_function('subtraction_{}'.format(n), _subtract_reference,
+                                                  target_node, reference_node)
+            iteration_nodes.append((target_node, reference_node, subtraction_node))
+
+        if curve_options.verbose:
+            print("Running {} distinct calculations of {}".format(graph.calculations, graph.requested))
+        subtraction_iterations = dict((nodes[2], n) for n, nodes in enumerate(iteration_nodes))
+        images = {}
+        if not stream:
+            images = dict((key, None) for nodes in iteration_nodes for key in nodes)
+        # Subtractions that finished before those of earlier iterations, waiting to be added in order
+        subtractions = {}
+        accumulator = None
+        converged = False
+        unocculted_slope = None
+        offaxis_slope = None
+        for key, result in graph.iterate(parallel=parallel, nprocesses=nprocesses):
+            if key == contrast_node:
+                unocculted_slope = result['2d']['detector']
+            if key == offaxis_node:
+                offaxis_slope = result['2d']['detector']
+            if key in images:
+                images[key] = result if key in subtraction_iterations else result['2d']['detector']
+            if key in subtraction_iterations and not converged:
+                subtractions[subtraction_iterations[key]] = result
+                # Add the subtractions in iteration order, so that the results (and where they
+                # converge) don't depend on the order in which parallel calculations finish
+                while not converged and (0 if accumulator is None else accumulator.count) in subtractions:
+                    if accumulator is None:
+                        accumulator = analysis.ContrastAccumulator(_contrast_aperture(result.shape))
+                    accumulator.add(subtractions.pop(accumulator.count))
+                    if tolerance is not None and accumulator.converged(tolerance):
+                        if curve_options.verbose:
+                            print("Contrast profile converged after {} iterations".format(accumulator.count))
+                        converged = True
+            if converged and unocculted_slope is not None and offaxis_slope is not None:
+                # The remaining iterations aren't needed
+                break
+
+    iterations_run = accumulator.count
+    aperture_image = accumulator.aperture
+    if stream:
+        target_slopes, reference_slopes, subtraction_stack = None, None, None
+        cov_matrix, aperture_matrix = None, None
+    else:
+        target_slopes = [images[nodes[0]] for nodes in iteration_nodes[:iterations_run]]
+        reference_slopes = [images[nodes[1]] for nodes in iteration_nodes[:iterations_run]]
+        subtraction_stack = np.array([images[nodes[2]] for nodes in iteration_nodes[:iterations_run]])
+        if curve_options.verbose:
+            print("Creating Covariance Matrix")
+        cov_matrix = analysis.covariance_matrix(subtraction_stack)
+        if curve_options.verbose:
+            print("Computing Aperture Matrix")
+        aperture_matrix = analysis.aperture_matrix(aperture_image)
+    # The same noise map as analysis.noise_map(cov_matrix, aperture_matrix, image_dim) gives
+    noise_map = accumulator.noise_map()
+
+    if curve_options.verbose:
+        print("Convolving off-axis image")
     convolved_offaxis = convolve(offaxis_slope, aperture_image, mode='constant')
     normalization = convolved_offaxis.max()
     
-    print("Creating Radial Profile")
+    if curve_options.verbose:
+        print("Creating Radial Profile")
     bins, profile = analysis.radial_profile(noise_map)
     normalized_profile = profile / normalization
 
     output =    {
                     'targets': target_slopes,
                     'references': reference_slopes,
-                    'unocculted': offaxis_slopes[0],
+                    'unocculted': unocculted_slope,
                     'subtractions': subtraction_stack,
                     'covariance_matrix': cov_matrix,
                     'aperture_image': aperture_image,
@@ -498,7 +901,10 @@ def calculate_contrast_curve(raw_config, target=None, reference=None, ta_error=T
                                     'bins': bins,
                                     'profile': profile,
                                     'normalized_profile': normalized_profile
-                                }
+                                },
+                    'iterations': iterations_run,
+                    'converged': converged,
+                    'seed': root_seed.entropy
                 }
 
     return output
@@ -2,27 +2,30 @@ from __future__ import absolute_import, print_function
 
 # Just build an actual subclass of the necessary JWST classes
 
-from copy import deepcopy
+import atexit
+from copy import copy, deepcopy
 from glob import glob
+import hashlib
 import json
 import logging
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 import os
 import pkg_resources
 import sys
+import threading
 import warnings
 import astropy.units as units
 import astropy.io.fits as fits
 import scipy.integrate as integrate
+import scipy.signal as sg
 import webbpsf
 from poppy import poppy_core
 from functools import wraps
 
 if sys.version_info[0] >= 3:
-    from functools import lru_cache
     from io import StringIO
 else:
-    from functools32 import lru_cache
     from cStringIO import StringIO
 
 import numpy as np
@@ -36,6 +39,7 @@ from pandeia.engine.config import DefaultConfig
 from pandeia.engine.report import Report
 from pandeia.engine.scene import Scene
 from pandeia.engine.calc_utils import build_empty_scene
+from pandeia.engine.profile import ProfileFactory
 from pandeia.engine.custom_exceptions import EngineInputError, EngineOutputError, RangeError, DataError
 from pandeia.engine.instrument_factory import InstrumentFactory
 from pandeia.engine.strategy import StrategyFactory
@@ -50,20 +54,18 @@ from pandeia.engine.etc3D import CalculationConfig, DetectorSignal
 PandeiaDetectorSignal = DetectorSignal
 
 from .config import EngineConfiguration
+from .psf_cache import get_arena, get_store, opd_key, psf_key, ram_cache, source_cache
+from .transformations import fourier_imshift
 from . import templates
 
-cache_maxsize = 256     # Number of monochromatic PSFs stored in an LRU cache
-                        # Should speed up calculations that involve modifying things
-                        # like exposure time and don't actually require calculating new PSFs.
-
-
 class CoronagraphyPSFLibrary(PSFLibrary, object):
     '''
     Subclass of the Pandeia PSFLibrary class, intended to allow PSFs to be generated on-the-fly
     via webbpsf rather than using cached PSFs
     '''
     def __init__(self, path=None, aperture='all', cache_path=None):
-        from .engine import options
+        from .engine import get_options
+        options = get_options()
         self._options = options
         self._log("debug", "CUSTOM PSF LIBRARY ACTIVATE!")
         if path is None:
@@ -75,7 +77,19 @@ class CoronagraphyPSFLibrary(PSFLibrary, object):
         self.latest_on_the_fly_PSF = None
         self._cache_path = cache_path
         if cache_path is None:
-            self._cache_path = os.getcwd()
+            self._cache_path = self.default_cache_path()
+
+    @staticmethod
+    def default_cache_path():
+        '''
+        The on-disk PSF store used unless a library is given its own: options.cache_path, or a
+        'pancake_psf_cache' directory in the current working directory.
+        '''
+        from .engine import get_options
+        options = get_options()
+        if options.cache_path is not None:
+            return options.cache_path
+        return os.path.join(os.getcwd(), 'pancake_psf_cache')
 
     def associate_offset_to_source(self, sources, instrument, aperture_name):
         '''
@@ -98,107 +112,252 @@ class CoronagraphyPSFLibrary(PSFLibrary, object):
         """
         if hasattr(super(CoronagraphyPSFLibrary, self), "get_pupil_throughput"):
             return super(CoronagraphyPSFLibrary, self).get_pupil_throughput(wave, instrument, aperture_name)
-        ins = CoronagraphyPSFLibrary._get_instrument(instrument, aperture_name)
-        return CoronagraphyPSFLibrary._pupil_throughput(ins)
+        return CoronagraphyPSFLibrary._instrument_optics(instrument, aperture_name)['pupil_throughput']
     
-    @staticmethod
-    @lru_cache(maxsize=cache_maxsize)
-    def get_cached_psf( wave, instrument, aperture_name, oversample=None, source_offset=(0, 0), otf_options=None, full_aperture=None):
-        from .engine import options
-        #Make the instrument and determine the mode
-        ins = CoronagraphyPSFLibrary._get_instrument(instrument, aperture_name, source_offset)
-        pix_scl = ins.pixelscale
-        fov_pixels = CoronagraphyPSFLibrary.fov_pixels[aperture_name]
-        trim_fov_pixels = CoronagraphyPSFLibrary.trim_fov_pixels[aperture_name]
-        
-        psf_result = CoronagraphyPSFLibrary.calc_psf(ins, wave, source_offset, oversample, pix_scl, 
-                                                     fov_pixels, trim_fov_pixels=trim_fov_pixels)
-
-        pupil_throughput = CoronagraphyPSFLibrary._pupil_throughput(ins)
-        pix_scl = psf_result[0].header['PIXELSCL']
-        upsamp = psf_result[0].header['OVERSAMP']
-        diff_limit = psf_result[0].header['DIFFLMT']
-        psf = psf_result[0].data
-        if len(psf) == 0:
-            psf = np.ones((1,1))
-
-        psf = {
-            'int': psf,
-            'wave': wave,
-            'pix_scl': pix_scl,
-            'diff_limit': diff_limit,
-            'upsamp': upsamp,
-            'instrument': instrument,
-            'aperture_name': aperture_name,
-            'source_offset': source_offset,
-            'pupil_throughput': pupil_throughput
-        }
-
-        return psf
-
     def get_psf(self, wave, instrument, aperture_name, oversample=None, source_offset=(0, 0), otf_options=None, full_aperture=None):
 
-        cache = self._options.cache
         if oversample is None:
             oversample = self._options.on_the_fly_oversample
 
         if source_offset[0] > 50.:
-            ins = CoronagraphyPSFLibrary._get_instrument(instrument, aperture_name, source_offset)
+            optics = self._instrument_optics(instrument, aperture_name)
             diff_limit = ((((wave*units.micron).to(units.meter).value)/6.5)*units.radian).to(units.arcsec).value
             psf = {
                 'int': np.ones((1,1)),
                 'wave': wave,
-                'pix_scl': ins.pixelscale/oversample,
+                'pix_scl': optics['ins'].pixelscale/oversample,
                 'diff_limit': diff_limit,
                 'upsamp': oversample,
                 'instrument': instrument,
                 'aperture_name': aperture_name,
                 'source_offset': source_offset,
-                'pupil_throughput': self._pupil_throughput(ins)
+                'pupil_throughput': optics['pupil_throughput']
             }
             return psf
 
+        grid_offset = self._grid_offset(source_offset)
+        psf = self._lookup_psf(wave, instrument, aperture_name, oversample, grid_offset)
+        if grid_offset == tuple(source_offset):
+            return psf
+
+        # Stand the grid PSF in for the requested offset
+        self._log("info", " Using PSF for offset {} in place of {}".format(grid_offset, source_offset))
+        psf['source_offset'] = source_offset
+        if self._options.psf_offset_mode == 'interpolate':
+            pix_scl = psf['pix_scl'] * psf['upsamp']
+            grid_x, grid_y = self._roll_residual(grid_offset, pix_scl, psf['upsamp'])
+            x, y = self._roll_residual(source_offset, pix_scl, psf['upsamp'])
+            psf['int'] = fourier_imshift(psf['int'], x - grid_x, -(y - grid_y))
+        return psf
+
+    def _lookup_psf(self, wave, instrument, aperture_name, oversample, source_offset):
+        '''
+        Return the PSF for an exact source offset from the cache selected by options.cache,
+        generating it with webbpsf (and adding it to the cache) if necessary.
+        '''
+        if self._options.psf_requests is not None:
+            return self._request_psf(wave, instrument, aperture_name, oversample, source_offset)
+
+        cache = self._options.cache
         self._log("info", "Getting {} {} {}... with caching {}".format(instrument, aperture_name, wave, cache))
-        if cache == 'disk':
-            psf_name = 'cached_{:.5f}_{}_{}_{:.3f}_{:.3f}_{}.fits'.format(wave, instrument, aperture_name, source_offset[0], source_offset[1], oversample)
-            if self._have_psf(psf_name):
-                self._log("info", " Found in cache")
-                psf_flux, pix_scl, diff_limit, pupil_throughput = self._get_psf(psf_name)
-                psf = {
-                    'int': psf_flux,
-                    'wave': wave,
-                    'pix_scl': pix_scl,
-                    'diff_limit': diff_limit,
-                    'upsamp': oversample,
-                    'instrument': instrument,
-                    'aperture_name': aperture_name,
-                    'source_offset': source_offset,
-                    'pupil_throughput': pupil_throughput
-                }
-                return psf
-        elif cache == 'ram':
-            # At this point, splice in the cache wrapper code, since we're testing moving the lru_cache out of the class to see what happens
-            # Include the on-the-fly override options in the hash key for the lru_cache
-            otf_options = tuple(sorted(self._options.on_the_fly_webbpsf_options.items()) + [self._options.on_the_fly_webbpsf_opd,])
-
-            # this may be needed in get_psf; extract it so we can avoid
-            # passing in 'self', which isn't hashable for the cache lookup
-            full_aperture = self._psfs[0]['aperture_name']
-
-            tmp = self.get_cached_psf(wave, instrument, aperture_name, oversample, source_offset, otf_options=otf_options, full_aperture=full_aperture)
-            self._log("info", " Cache Stats: {}".format(self.get_cached_psf.cache_info()))
-            return tmp
-
-        # Either disk cache miss or no caching
+        if cache == 'none':
+            return self._calculate_psf(wave, instrument, aperture_name, oversample, source_offset)
+
+        # Both the 'ram' and 'disk' caches keep recently used PSFs in memory
+        psf_hash = psf_key(self._psf_spec(wave, instrument, aperture_name, oversample, source_offset))
+        private_copy = not self._options.psf_cache_readonly
+        ram_cache.resize(self._options.psf_cache_bytes)
+        psf = ram_cache.get(psf_hash, copy=private_copy)
+        if psf is not None:
+            self._log("info", " Found in RAM cache. Cache Stats: {}".format(ram_cache.stats()))
+            return psf
+
+        store, store_name = self._psf_store()
+        stored = None
+        if store is not None:
+            stored = store.get(psf_hash)
+        if stored is not None:
+            self._log("info", " Found in {}".format(store_name))
+            psf_flux, meta = stored
+            psf = {
+                'int': psf_flux,
+                'wave': wave,
+                'pix_scl': meta['pix_scl'],
+                'diff_limit': meta['diff_limit'],
+                'upsamp': meta['upsamp'],
+                'instrument': instrument,
+                'aperture_name': aperture_name,
+                'source_offset': source_offset,
+                'pupil_throughput': meta['pupil_throughput']
+            }
+            psf = ram_cache.put(psf_hash, psf, copy=private_copy)
+        else:
+            psf = self._save_psf(psf_hash, self._calculate_psf(wave, instrument, aperture_name, oversample, source_offset))
+        self._log("info", " Cache Stats: {}".format(ram_cache.stats()))
+        return psf
+
+    def _request_psf(self, wave, instrument, aperture_name, oversample, source_offset):
+        '''
+        During a dry run (see engine.prepare_psfs), record the PSF that was asked for, along with
+        the calculation it belongs to, and return a placeholder with the right sampling.
+        '''
+        psf_hash = psf_key(self._psf_spec(wave, instrument, aperture_name, oversample, source_offset))
+        self._options.psf_requests[psf_hash] = (self._options.current_config,
+                                                (wave, instrument, aperture_name, oversample, source_offset))
+        optics = self._instrument_optics(instrument, aperture_name)
+        diff_limit = ((((wave*units.micron).to(units.meter).value)/6.5)*units.radian).to(units.arcsec).value
+        psf = {
+            'int': np.ones((1,1)),
+            'wave': wave,
+            'pix_scl': optics['ins'].pixelscale/oversample,
+            'diff_limit': diff_limit,
+            'upsamp': oversample,
+            'instrument': instrument,
+            'aperture_name': aperture_name,
+            'source_offset': source_offset,
+            'pupil_throughput': optics['pupil_throughput']
+        }
+        return psf
+
+    def _psf_store(self):
+        '''
+        Beyond RAM, PSFs live in the persistent on-disk store or, for 'ram' caching inside a
+        calculate_batch pool, in a temporary arena shared by all of the pool's workers. Return that
+        store (or None) and a name for it to use in log messages.
+        '''
+        if self._options.cache == 'disk':
+            return get_store(self._cache_path), "disk cache"
+        return get_arena(), "shared arena"
+
+    def _save_psf(self, psf_hash, psf):
+        '''
+        Add a newly generated PSF to the store (if any) and the RAM cache, and return the PSF that
+        should be handed to Pandeia.
+        '''
+        store, store_name = self._psf_store()
+        if store is not None:
+            if store.put(psf_hash, psf['int'], self._psf_meta(psf)):
+                # Hand back the stored copy (float32 on disk, float64 in the shared arena) so that
+                # cold and warm runs give identical results
+                psf['int'] = store.get(psf_hash)[0]
+                self._log("info", " Created and saved to {}.".format(store_name))
+        return ram_cache.put(psf_hash, psf, copy=not self._options.psf_cache_readonly)
+
+    @staticmethod
+    def _psf_meta(psf):
+        '''
+        The metadata kept alongside a PSF image in a PSF store
+        '''
+        meta = {
+            'pix_scl': float(psf['pix_scl']),
+            'diff_limit': float(psf['diff_limit']),
+            'upsamp': int(psf['upsamp']),
+            'pupil_throughput': float(psf['pupil_throughput'])
+        }
+        return meta
+
+    def prefetch_psfs(self, waves, instrument, aperture_name, source_offsets, oversample=None):
+        '''
+        Generate the PSFs for every combination of wavelength and source offset that isn't already
+        cached, in parallel as set by options.psf_prefetch and options.psf_prefetch_workers, and add
+        them to the cache. The get_psf calls that Pandeia later makes one wavelength at a time are
+        then all cache hits. Note that the RAM cache (options.psf_cache_bytes) must be large enough
+        to hold all of them when cache is 'ram'.
+        '''
+        prefetch = self._options.psf_prefetch
+        if prefetch == 'none' or self._options.cache == 'none' or self._options.psf_requests is not None:
+            return
+        if oversample is None:
+            oversample = self._options.on_the_fly_oversample
+        store, store_name = self._psf_store()
+
+        grid_offsets = set(self._grid_offset(offset) for offset in source_offsets if offset[0] <= 50.)
+        tasks, hashes, seen = [], [], set()
+        for offset in sorted(grid_offsets):
+            for wave in waves:
+                psf_hash = psf_key(self._psf_spec(wave, instrument, aperture_name, oversample, offset))
+                if psf_hash in seen or psf_hash in ram_cache or (store is not None and psf_hash in store):
+                    continue
+                tasks.append((wave, instrument, aperture_name, oversample, offset))
+                hashes.append(psf_hash)
+                seen.add(psf_hash)
+        if len(tasks) == 0:
+            return
+
+        nprocesses = self._options.psf_prefetch_workers
+        if nprocesses is None:
+            nprocesses = mp.cpu_count()
+        if prefetch == 'process' and mp.current_process().daemon:
+            # Daemonic processes (e.g. calculate_batch workers) can't start pools of their own
+            prefetch = 'thread'
+        self._log("info", "Prefetching {} PSFs with {} {}(s)".format(len(tasks), min(nprocesses, len(tasks)),
+                                                                      prefetch))
+        pool = _prefetch_pool(prefetch, nprocesses)
+        if prefetch == 'thread':
+            # Worker threads don't inherit the calculation's options, so they are sent along.
+            psfs = pool.map(_calculate_psf_in_thread, [(self._options, task) for task in tasks])
+        else:
+            context = (self._options.current_options, self._options.current_config)
+            psfs = pool.map(_calculate_psf_in_process, [(context, task) for task in tasks])
+        for psf_hash, psf in zip(hashes, psfs):
+            self._save_psf(psf_hash, psf)
+
+    def _grid_offset(self, source_offset):
+        '''
+        Return the offset whose PSF is used for source_offset: the nearest point of the polar grid
+        set by options.psf_offset_grid if options.psf_offset_mode allows it and that point is within
+        options.psf_offset_tolerance, and source_offset itself otherwise.
+
+        Grid points lie on rings spaced by psf_offset_grid, with the number of points on each ring
+        chosen so that they are (at most) psf_offset_grid apart along the ring too.
+        '''
+        offset_r, offset_theta = float(source_offset[0]), float(source_offset[1])
+        if self._options.psf_offset_mode == 'exact':
+            return (offset_r, offset_theta)
+        step = self._options.psf_offset_grid
+        ring = int(np.rint(offset_r / step))
+        if ring == 0:
+            grid_r, grid_theta = 0., 0.
+        else:
+            n_azimuth = int(np.ceil(2 * np.pi * ring))
+            azimuth_step = 360. / n_azimuth
+            grid_r = ring * step
+            grid_theta = (int(np.rint(offset_theta / azimuth_step)) % n_azimuth) * azimuth_step
+        distance = np.hypot(offset_r * np.sin(np.deg2rad(offset_theta)) - grid_r * np.sin(np.deg2rad(grid_theta)),
+                            offset_r * np.cos(np.deg2rad(offset_theta)) - grid_r * np.cos(np.deg2rad(grid_theta)))
+        if distance > self._options.psf_offset_tolerance:
+            return (offset_r, offset_theta)
+        return (grid_r, grid_theta)
+
+    @staticmethod
+    def _roll_residual(offset, pix_scale, oversample):
+        '''
+        calc_psf only rolls off-axis PSFs back to the centre by a whole number of detector pixels.
+        Return the (x, y) position, in oversampled pixels, at which that leaves the PSF for an offset.
+        '''
+        offset_r, offset_theta = offset
+        dx = offset_r * np.sin(np.deg2rad(offset_theta)) / pix_scale
+        dy = offset_r * np.cos(np.deg2rad(offset_theta)) / pix_scale
+        return -(dx - np.rint(dx)) * oversample, (dy - np.rint(dy)) * oversample
+
+    @staticmethod
+    def _calculate_psf(wave, instrument, aperture_name, oversample, source_offset):
+        """
+        Generate a PSF dictionary with webbpsf, bypassing all caches.
+        """
         #Make the instrument and determine the mode
         ins = CoronagraphyPSFLibrary._get_instrument(instrument, aperture_name, source_offset)
         pix_scl = ins.pixelscale
         fov_pixels = CoronagraphyPSFLibrary.fov_pixels[aperture_name]
         trim_fov_pixels = CoronagraphyPSFLibrary.trim_fov_pixels[aperture_name]
     
-        psf_result = self.calc_psf(ins, wave, source_offset, oversample, pix_scl, fov_pixels, trim_fov_pixels=trim_fov_pixels)
+        optics = CoronagraphyPSFLibrary._instrument_optics(instrument, aperture_name)
+    
+        psf_result = CoronagraphyPSFLibrary.calc_psf(ins, wave, source_offset, oversample, pix_scl, 
+                                                     fov_pixels, trim_fov_pixels=trim_fov_pixels,
+                                                     pupil_sf=optics['pupil_sf'])
 
-        pupil_throughput = self._pupil_throughput(ins)
+        pupil_throughput = optics['pupil_throughput']
         pix_scl = psf_result[0].header['PIXELSCL']
         upsamp = psf_result[0].header['OVERSAMP']
         diff_limit = psf_result[0].header['DIFFLMT']
@@ -217,14 +376,28 @@ class CoronagraphyPSFLibrary(PSFLibrary, object):
             'source_offset': source_offset,
             'pupil_throughput': pupil_throughput
         }
-        
-        if cache == 'disk':
-            psf_result[0].header['PUPTHR'] = pupil_throughput
-            psf_result.writeto(os.path.join(self._cache_path, psf_name))
-            self._log("info", " Created and saved to cache.")
 
         return psf
 
+    def _psf_spec(self, wave, instrument, aperture_name, oversample, source_offset):
+        '''
+        Collect every input that affects an on-the-fly PSF. This is hashed to give the key used by
+        the RAM cache and the on-disk PSF store.
+        '''
+        instrument_config = self._options.current_config['configuration']['instrument']
+        spec = {
+                    'wave': float(wave),
+                    'instrument': instrument.lower(),
+                    'aperture_name': aperture_name,
+                    'filter': instrument_config['filter'],
+                    'oversample': int(oversample),
+                    'source_offset': [float(source_offset[0]), float(source_offset[1])],
+                    'webbpsf_options': sorted(self._options.on_the_fly_webbpsf_options.items()),
+                    'webbpsf_opd': opd_key(self._options.on_the_fly_webbpsf_opd),
+                    'webbpsf_version': getattr(webbpsf, '__version__', None)
+               }
+        return spec
+
     def get_pix_scale(self, instrument, aperture_name):
         """
         Get PSF pixel scale for given instrument/aperture.
@@ -235,29 +408,14 @@ class CoronagraphyPSFLibrary(PSFLibrary, object):
         upsample = self.get_upsamp(instrument, aperture_name)
         return aperture_dict[4]/upsample
 
-    def _have_psf(self, psf_name):
-        '''
-        Determine whether a cached PSF exists for a given combination
-        '''
-        return os.path.exists(os.path.join(self._cache_path, psf_name))
-
-    def _get_psf(self, psf_name):
-        '''
-        Return a cached PSF exists for a given combination
-        '''
-        with fits.open(os.path.join(self._cache_path, psf_name)) as inf:
-            pix_scl = inf[0].header['PIXELSCL']
-            diff_limit = inf[0].header['DIFFLMT']
-            pupil_throughput = inf[0].header['PUPTHR']
-            psf = inf[0].data
-        return psf, pix_scl, diff_limit, pupil_throughput
-    
     @staticmethod
-    def _pupil_throughput(ins):
+    def _pupil_throughput(ins, optsys=None):
         """
-        Determines pupil throughput given a webbpsf instrument object
+        Determines pupil throughput given a webbpsf instrument object (and, optionally, an optical
+        system already built from it)
         """
-        optsys = ins._getOpticalSystem()
+        if optsys is None:
+            optsys = ins._getOpticalSystem()
         ote_pupil = optsys[0].amplitude
         coron_pupil = optsys[-2].amplitude
         pupil_throughput = coron_pupil.sum() / ote_pupil.sum()
@@ -265,8 +423,17 @@ class CoronagraphyPSFLibrary(PSFLibrary, object):
     
     @staticmethod
     def _get_instrument(instrument, aperture_name, source_offset=None):
-        from .engine import options as pancake_options
-        instrument_config = pancake_options.current_config['configuration']['instrument']
+        '''
+        Return a webbpsf instrument configured for the current calculation and source offset.
+
+        Building and configuring a webbpsf instrument is about as expensive as a MIRI PSF, so the
+        configured instrument is built once per (instrument, aperture, filter, webbpsf options, OPD)
+        and cached. webbpsf instruments keep state between calc_psf calls, so each thread (e.g. a
+        prefetch_psfs worker) has its own. Each call gets a shallow copy of this thread's instrument
+        with its own options dictionary, in which only the source offset is set.
+        '''
+        from .engine import get_options
+        pancake_options = get_options()
         scene_config = pancake_options.current_config['scene']
         ref_config = pancake_options.current_config['strategy']['psf_subtraction_source']
         if source_offset is None:
@@ -275,6 +442,73 @@ class CoronagraphyPSFLibrary(PSFLibrary, object):
             source_offset_radius = np.sqrt(offset_x**2. + offset_y**2.)
             source_offset_azimuth = 360*(np.pi+np.arctan2(offset_x, offset_y))/2/np.pi
             source_offset = [source_offset_radius, source_offset_azimuth]
+        optics = CoronagraphyPSFLibrary._instrument_optics(instrument, aperture_name)
+        thread_instruments = CoronagraphyPSFLibrary._own_instruments()
+        if optics['key'] not in thread_instruments:
+            thread_instruments[optics['key']] = CoronagraphyPSFLibrary._build_instrument(instrument, aperture_name)
+        ins = copy(thread_instruments[optics['key']])
+        ins.options = dict(ins.options)
+        #get offset
+        ins.options['source_offset_r'] = source_offset[0]
+        ins.options['source_offset_theta'] = source_offset[1]
+        return ins
+    
+    @staticmethod
+    def _instrument_optics(instrument, aperture_name):
+        '''
+        Return the cached entry for the webbpsf instrument used by the current calculation. This is a
+        dictionary holding the configured instrument ('ins', which must not be modified, or used to
+        calculate PSFs, see _get_instrument), the spatial frequency Nyquist-sampled by its entrance
+        pupil ('pupil_sf', in cycles per meter, used to find the critical angle), the coronagraphic
+        pupil throughput ('pupil_throughput') and the entry's cache key ('key').
+        '''
+        from .engine import get_options
+        pancake_options = get_options()
+        instrument_config = pancake_options.current_config['configuration']['instrument']
+        # The same content hash as PSF keys use, so that an OPD is identified by its data
+        key = psf_key({
+                        'instrument': instrument.upper(),
+                        'aperture_name': aperture_name,
+                        'filter': instrument_config['filter'],
+                        'webbpsf_options': sorted(pancake_options.on_the_fly_webbpsf_options.items()),
+                        'webbpsf_opd': opd_key(pancake_options.on_the_fly_webbpsf_opd)
+                     })
+        with CoronagraphyPSFLibrary._instruments_lock:
+            optics = CoronagraphyPSFLibrary._instruments.get(key)
+        if optics is not None:
+            return optics
+
+        ins = CoronagraphyPSFLibrary._build_instrument(instrument, aperture_name)
+        # Neither the pupil sampling nor the pupil throughput depends on the source offset or the
+        # field of view, so a single optical system serves for both.
+        optsys = ins._getOpticalSystem()
+        pupil_sf = (1./(optsys.planes[0].pixelscale * 2 * units.pixel)).to(1./units.meter).value
+        optics = {
+                    'ins': ins,
+                    'pupil_sf': pupil_sf,
+                    'pupil_throughput': CoronagraphyPSFLibrary._pupil_throughput(ins, optsys),
+                    'key': key
+                 }
+        # This thread can calculate PSFs with the instrument it has just built
+        CoronagraphyPSFLibrary._own_instruments().setdefault(key, ins)
+        with CoronagraphyPSFLibrary._instruments_lock:
+            return CoronagraphyPSFLibrary._instruments.setdefault(key, optics)
+
+    @staticmethod
+    def _own_instruments():
+        '''
+        Return the dictionary of this thread's own webbpsf instruments, by _instrument_optics key.
+        '''
+        return CoronagraphyPSFLibrary._thread_instruments.__dict__.setdefault('instruments', {})
+
+    @staticmethod
+    def _build_instrument(instrument, aperture_name):
+        '''
+        Build a webbpsf instrument configured for the current calculation.
+        '''
+        from .engine import get_options
+        pancake_options = get_options()
+        instrument_config = pancake_options.current_config['configuration']['instrument']
         if instrument.upper() == 'NIRCAM':
             ins = webbpsf.NIRCam()
             ins.filter = instrument_config['filter']
@@ -288,17 +522,30 @@ class CoronagraphyPSFLibrary(PSFLibrary, object):
             raise ValueError('Only NIRCam and MIRI are supported instruments!')
         ins.image_mask = CoronagraphyPSFLibrary.image_mask[aperture_name]
         ins.pupil_mask = CoronagraphyPSFLibrary.pupil_mask[aperture_name]
-        for key in pancake_options.on_the_fly_webbpsf_options:
-            ins.options[key] = pancake_options.on_the_fly_webbpsf_options[key]
+        for option in pancake_options.on_the_fly_webbpsf_options:
+            ins.options[option] = pancake_options.on_the_fly_webbpsf_options[option]
         if pancake_options.on_the_fly_webbpsf_opd is not None:
             ins.pupilopd = pancake_options.on_the_fly_webbpsf_opd
-        #get offset
-        ins.options['source_offset_r'] = source_offset[0]
-        ins.options['source_offset_theta'] = source_offset[1]
         ins.options['output_mode'] = 'oversampled'
         ins.options['parity'] = 'odd'
         return ins
     
+    @staticmethod
+    def _pixel_scales():
+        '''
+        Detector pixel scales, read from webbpsf the first time they are needed.
+        '''
+        with CoronagraphyPSFLibrary._instruments_lock:
+            if CoronagraphyPSFLibrary._pixel_scale_cache is None:
+                nc = webbpsf.NIRCam()
+                miri = webbpsf.MIRI()
+                CoronagraphyPSFLibrary._pixel_scale_cache = {
+                                                                'short': nc._pixelscale_short,
+                                                                'long': nc._pixelscale_long,
+                                                                'miri': miri.pixelscale
+                                                             }
+            return CoronagraphyPSFLibrary._pixel_scale_cache
+    
     @staticmethod
     def parse_aperture(aperture_name):
         '''
@@ -308,38 +555,42 @@ class CoronagraphyPSFLibrary(PSFLibrary, object):
         aperture_keys = ['mask210r','mask335r','mask430r','masklwb','maskswb','fqpm1065','fqpm1140','fqpm1550','lyot2300']
         assert aperture_name in aperture_keys, 'Aperture {} not recognized! Must be one of {}'.format(aperture_name, aperture_keys)
 
-        nc = webbpsf.NIRCam()
-        miri = webbpsf.MIRI()
+        pixel_scales = CoronagraphyPSFLibrary._pixel_scales()
 
         aperture_dict = {
-            'mask210r' : ['MASK210R','CIRCLYOT', 101, None, nc._pixelscale_short, 'sw_imaging'],
-            'mask335r' : ['MASK335R','CIRCLYOT', 101, None, nc._pixelscale_long, 'lw_imaging'],
-            'mask430r' : ['MASK430R','CIRCLYOT', 101, None, nc._pixelscale_long, 'lw_imaging'],
-            'masklwb' : ['MASKLWB','WEDGELYOT', 351, 101, nc._pixelscale_long, 'lw_imaging'],
-            'maskswb' : ['MASKSWB','WEDGELYOT', 351, 101, nc._pixelscale_short, 'sw_imaging'],
-            'fqpm1065' : ['FQPM1065','MASKFQPM', 81, None, miri.pixelscale, 'imaging'],
-            'fqpm1140' : ['FQPM1140','MASKFQPM', 81, None, miri.pixelscale, 'imaging'],
-            'fqpm1550' : ['FQPM1550','MASKFQPM', 81, None, miri.pixelscale, 'imaging'],
-            'lyot2300' : ['LYOT2300','MASKLYOT', 81, None, miri.pixelscale, 'imaging']
+            'mask210r' : ['MASK210R','CIRCLYOT', 101, None, pixel_scales['short'], 'sw_imaging'],
+            'mask335r' : ['MASK335R','CIRCLYOT', 101, None, pixel_scales['long'], 'lw_imaging'],
+            'mask430r' : ['MASK430R','CIRCLYOT', 101, None, pixel_scales['long'], 'lw_imaging'],
+            'masklwb' : ['MASKLWB','WEDGELYOT', 351, 101, pixel_scales['long'], 'lw_imaging'],
+            'maskswb' : ['MASKSWB','WEDGELYOT', 351, 101, pixel_scales['short'], 'sw_imaging'],
+            'fqpm1065' : ['FQPM1065','MASKFQPM', 81, None, pixel_scales['miri'], 'imaging'],
+            'fqpm1140' : ['FQPM1140','MASKFQPM', 81, None, pixel_scales['miri'], 'imaging'],
+            'fqpm1550' : ['FQPM1550','MASKFQPM', 81, None, pixel_scales['miri'], 'imaging'],
+            'lyot2300' : ['LYOT2300','MASKLYOT', 81, None, pixel_scales['miri'], 'imaging']
             }
     
         return aperture_dict[aperture_name]
 
     @staticmethod
-    def calc_psf(ins, wave, offset, oversample, pix_scale, fov_pixels, trim_fov_pixels=None):
+    def calc_psf(ins, wave, offset, oversample, pix_scale, fov_pixels, trim_fov_pixels=None, pupil_sf=None):
         '''
         Following the treatment in pandeia_data/dev/make_psf.py to handle
         off-center PSFs for use as a kernel in later convolutions.
+        
+        pupil_sf is the spatial frequency (in cycles per meter) Nyquist sampled by the instrument's
+        entrance pupil. If it isn't supplied, it is found from a freshly built optical system.
         '''
         # Split out offset
         offset_r, offset_theta = offset
-        # Create an optical system model. This is done because, in order to determine the critical angle, we need this model, and it otherwise
-        #    wouldn't be generated until the PSF itself is generated. In this case, we want to generate the model early because we want to make
-        #    sure that the observation *isn't* over the critical angle *before* generating the PSF
-        optsys = ins._getOpticalSystem(fft_oversample=3, detector_oversample=3, fov_arcsec=None, fov_pixels=fov_pixels)
-        # determine the spatial frequency which is Nyquist sampled by the input pupil.
-        # convert this to units of cycles per meter and make it not a Quantity
-        sf = (1./(optsys.planes[0].pixelscale * 2 * units.pixel)).to(1./units.meter).value
+        if pupil_sf is None:
+            # Create an optical system model. This is done because, in order to determine the critical angle, we need this model, and it otherwise
+            #    wouldn't be generated until the PSF itself is generated. In this case, we want to generate the model early because we want to make
+            #    sure that the observation *isn't* over the critical angle *before* generating the PSF
+            optsys = ins._getOpticalSystem(fft_oversample=3, detector_oversample=3, fov_arcsec=None, fov_pixels=fov_pixels)
+            # determine the spatial frequency which is Nyquist sampled by the input pupil.
+            # convert this to units of cycles per meter and make it not a Quantity
+            pupil_sf = (1./(optsys.planes[0].pixelscale * 2 * units.pixel)).to(1./units.meter).value
+        sf = pupil_sf
         critical_angle_arcsec = wave*1.e-6*sf*poppy_core._RADIANStoARCSEC
         critical_angle_pixels = int(np.floor(0.5 * critical_angle_arcsec / pix_scale))
 
@@ -382,6 +633,11 @@ class CoronagraphyPSFLibrary(PSFLibrary, object):
         logging_fn = getattr(logger, level.lower())
         logging_fn(message)
     
+    _instruments = {}
+    _instruments_lock = threading.RLock()
+    _thread_instruments = threading.local()  # Each thread's own instruments, by _instruments key
+    _pixel_scale_cache = None
+    
     nircam_mode = {
                     'mask210r': 'sw_imaging', 'mask335r': 'lw_imaging', 'mask430r': 'lw_imaging',
                     'masklwb': 'lw_imaging', 'maskswb': 'sw_imaging', 'fqpm1065': 'imaging',
@@ -413,6 +669,86 @@ class CoronagraphyPSFLibrary(PSFLibrary, object):
                       }
 
 
+# Pools used by prefetch_psfs, by (kind, pid, number of workers). They are kept between
+# calculations, so that each one doesn't start (and warm up) a new set of workers.
+_prefetch_pools = {}
+_prefetch_pools_lock = threading.Lock()
+
+def _prefetch_pool(kind, nprocesses):
+    '''
+    Return the pool of nprocesses threads (kind 'thread') or processes (kind 'process') used by
+    prefetch_psfs, starting it the first time it is asked for.
+    '''
+    key = (kind, os.getpid(), nprocesses)
+    with _prefetch_pools_lock:
+        pool = _prefetch_pools.get(key)
+        if pool is None:
+            if kind == 'thread':
+                pool = ThreadPool(processes=nprocesses)
+            else:
+                pool = mp.Pool(processes=nprocesses)
+            _prefetch_pools[key] = pool
+        return pool
+
+def close_prefetch_pools():
+    '''
+    Shut down the pools started by prefetch_psfs in this process. They are started again when
+    needed. This runs automatically at exit.
+    '''
+    with _prefetch_pools_lock:
+        keys = [key for key in _prefetch_pools if key[1] == os.getpid()]
+        pools = [_prefetch_pools.pop(key) for key in keys]
+    for pool in pools:
+        pool.close()
+        pool.join()
+
+atexit.register(close_prefetch_pools)
+
+def _calculate_psf_task(task):
+    '''
+    Pool worker for CoronagraphyPSFLibrary.prefetch_psfs.
+    '''
+    return CoronagraphyPSFLibrary._calculate_psf(*task)
+
+def _calculate_psf_in_thread(options_task):
+    '''
+    Thread pool worker for CoronagraphyPSFLibrary.prefetch_psfs, run with the options of the
+    calculation that asked for the PSFs.
+    '''
+    from .engine import using_options
+    options, task = options_task
+    with using_options(options):
+        return _calculate_psf_task(task)
+
+def _calculate_psf_in_process(context_task):
+    '''
+    Process pool worker for CoronagraphyPSFLibrary.prefetch_psfs. Worker processes don't necessarily
+    share the parent's engine options (e.g. with the 'spawn' start method), so they are sent along.
+    '''
+    from .engine import private_options
+    (current_options, current_config), task = context_task
+    with private_options(current_options) as options:
+        options.current_config = current_config
+        return _calculate_psf_task(task)
+
+def _store_psf_in_process(task):
+    '''
+    Process pool worker for engine.prepare_psfs: generate a PSF and add it to a PSF store.
+    '''
+    from .engine import private_options
+    (current_options, current_config), store_path, psf_hash, psf_args = task
+    with private_options(current_options) as options:
+        options.current_config = current_config
+        psf = CoronagraphyPSFLibrary._calculate_psf(*psf_args)
+    get_store(store_path).put(psf_hash, psf['int'], CoronagraphyPSFLibrary._psf_meta(psf))
+
+
+# Pandeia's ConvolvedSceneCube reads the SPECTRAL_MAX_SAMPLES module constant while it sets up its
+# wavelengths, so the constant is set and read while holding this lock (see
+# CoronagraphyConvolvedSceneCube.__init__)
+_max_samples_lock = threading.RLock()
+
+
 class CoronagraphyConvolvedSceneCube(pandeia.engine.astro_spectrum.ConvolvedSceneCube):
     '''
     This class overrides the ConvolvedSceneCube class, and instead of using SPECTRAL_MAX_SAMPLES it
@@ -421,14 +757,127 @@ class CoronagraphyConvolvedSceneCube(pandeia.engine.astro_spectrum.ConvolvedScen
     background=None, psf_library=None, webapp=False, empty_scene=False
     '''
     def __init__(self, scene, instrument, **kwargs):
-        from .engine import options
+        from .engine import get_options
+        options = get_options()
         self.coronagraphy_options = options
         self._options = options
         self._log("debug", "CORONAGRAPHY SCENE CUBE ACTIVATE!")
-        pandeia.engine.astro_spectrum.SPECTRAL_MAX_SAMPLES = self._max_samples
+        self._webapp = kwargs.get('webapp', False)
         if 'psf_library' in kwargs and not isinstance(kwargs['psf_library'], CoronagraphyPSFLibrary):
             kwargs['psf_library'] = CoronagraphyPSFLibrary()
-        super(CoronagraphyConvolvedSceneCube, self).__init__(scene, instrument, **kwargs)
+        # Pandeia is done with SPECTRAL_MAX_SAMPLES by the time it calls create_flux_cube, which
+        # releases the lock so that calculations in other threads can build their cubes meanwhile
+        _max_samples_lock.acquire()
+        self._max_samples_locked = True
+        try:
+            pandeia.engine.astro_spectrum.SPECTRAL_MAX_SAMPLES = self._max_samples
+            super(CoronagraphyConvolvedSceneCube, self).__init__(scene, instrument, **kwargs)
+        finally:
+            self._release_max_samples()
+
+    def _release_max_samples(self):
+        '''
+        Release _max_samples_lock, if this cube holds it.
+        '''
+        if getattr(self, '_max_samples_locked', False):
+            self._max_samples_locked = False
+            _max_samples_lock.release()
+
+    def create_flux_cube(self, background=None):
+        '''
+        Move to the wavelength grid set by options.wave_grid, generate every PSF the flux cube will
+        need up front (in parallel if options.psf_prefetch is set), then let Pandeia build the cube
+        one wavelength at a time from the cached PSFs.
+        '''
+        self._release_max_samples()
+        self.apply_wave_grid()
+        if isinstance(self.psf_library, CoronagraphyPSFLibrary):
+            instrument_name = self.instrument.get_name()
+            aperture_name = self.instrument.get_aperture()
+            psf_associations = self.psf_library.associate_offset_to_source(self.scene.sources, instrument_name, aperture_name)
+            self.psf_library.prefetch_psfs(self.wave, instrument_name, aperture_name, set(psf_associations))
+        return super(CoronagraphyConvolvedSceneCube, self).create_flux_cube(background=background)
+
+    def apply_wave_grid(self):
+        '''
+        Pandeia samples the scene at wavelengths taken from the source spectra, so two nearly
+        identical calculations generally ask for PSFs at slightly different wavelengths. If
+        options.wave_grid is set (for imaging modes only), re-sample the sources and the background
+        onto wavelengths taken from that grid, within the instrument's wavelength range, instead.
+        Since neither depends on the spectra, monochromatic PSFs can then be reused between targets,
+        spectra and runs.
+        '''
+        wave_grid = self._options.wave_grid
+        if wave_grid is None or self.instrument.projection_type != 'image':
+            return
+        wrange = self.instrument.get_wave_range()
+        wmin, wmax = wrange['wmin'], wrange['wmax']
+        if wave_grid == 'canonical':
+            wave = self.canonical_wavelengths(wmin, wmax, self._options.wave_grid_resolution, self._max_samples)
+        else:
+            wave = np.unique(np.asarray(wave_grid, dtype=np.float64))
+            wave = wave[(wave >= wmin) & (wave <= wmax)]
+        if wave.size < 2:
+            self._log("warning", "Fewer than two wavelengths of the wave_grid lie within [{}, {}]. Keeping "
+                                 "Pandeia's wavelengths.".format(wmin, wmax))
+            return
+        if np.array_equal(wave, self.wave):
+            return
+
+        # Start again from the original spectra, since re-sampling an already re-sampled spectrum
+        # would lose information. This repeats what Pandeia's ConvolvedSceneCube does.
+        self.source_spectra = []
+        self.total_flux = np.zeros(wave.size)
+        for src in self.scene.sources:
+            spectrum = astro.AstroSpectrum(src, webapp=self._webapp)
+            spectrum.trim(wrange['wmin'], wrange['wmax'])
+            spectrum = self.instrument.spectrometer_convolve(spectrum)
+            spectrum.resample(wave)
+            self.source_spectra.append(spectrum)
+            self.total_flux += spectrum.flux
+        if self.background is not None:
+            self.background.resample(wave)
+        self.wave = wave
+        self.nw = wave.size
+
+    @staticmethod
+    def canonical_wavelengths(wmin, wmax, resolution, max_samples):
+        '''
+        Return at most max_samples (at least 1) wavelengths covering [wmin, wmax], taken from the
+        global grid ln(wave) = k / resolution (k an integer).
+
+        The range is first snapped inwards onto the grid, and its two ends are always included so
+        that the integral over wavelength covers (all but at most 1 / resolution of) the full range.
+        In between, the grid is thinned to every step'th point (counting from k = 0, so that every
+        calculation using the same step samples the same wavelengths), with step the smallest that
+        gets down to max_samples. Points closer than half a step to the ends are dropped.
+
+        A range with fewer than two grid points is sampled at wmin and wmax themselves, and a single
+        sample is the grid point nearest the middle of the range (or the middle itself, if there is
+        no grid point in the range).
+        '''
+        max_samples = max(1, int(max_samples))
+        kmin = int(np.ceil(np.log(wmin) * resolution))
+        kmax = int(np.floor(np.log(wmax) * resolution))
+        if max_samples == 1:
+            middle = (np.log(wmin) + np.log(wmax)) / 2.
+            if kmax < kmin:
+                return np.array([np.exp(middle)])
+            k = min(max(int(np.round(middle * resolution)), kmin), kmax)
+            return np.array([np.exp(k / float(resolution))])
+        if kmax - kmin < 1:
+            return np.unique([wmin, wmax]).astype(np.float64)
+        if kmax - kmin < max_samples:
+            return np.exp(np.arange(kmin, kmax + 1) / float(resolution))
+        step = max(1, (kmax - kmin) // max(max_samples - 1, 1))
+        while True:
+            k = np.arange(int(np.ceil(kmin / float(step))) * step, kmax + 1, step)
+            k = k[(2 * (k - kmin) > step) & (2 * (kmax - k) > step)]
+            if k.size + 2 <= max_samples:
+                break
+            step += 1
+        k = np.concatenate(([kmin], k, [kmax]))
+        return np.exp(k / float(resolution))
 
     @property
     def _max_samples(self):
@@ -505,6 +954,9 @@ class CoronagraphyDetectorSignal(CoronagraphyConvolvedSceneCube):
         
         kwargs['background'] = self.background
 
+        # Filled in by create_flux_cube if it takes the broadband PSF route
+        self.broadband_rates = None
+
         # Then initialize the flux and wavelength grid
         CoronagraphyConvolvedSceneCube.__init__(
             self,
@@ -528,12 +980,16 @@ class CoronagraphyDetectorSignal(CoronagraphyConvolvedSceneCube):
         # Loop over all slices and calculate the photon and electron rates through the
         # observatory for each one. Note that many modes (imaging, etc.) will have just
         # a single slice.
-        for flux_cube, flux_plus_bg in zip(self.flux_cube_list, self.flux_plus_bg_list):
-            # Rates for the slice without the background
-            slice_rate = self.all_rates(flux_cube, add_extended_background=False)
+        for islice, (flux_cube, flux_plus_bg) in enumerate(zip(self.flux_cube_list, self.flux_plus_bg_list)):
+            if self.broadband_rates is not None:
+                # Already integrated over wavelength by the broadband PSF route
+                slice_rate, slice_rate_plus_bg = self.broadband_rates[islice]
+            else:
+                # Rates for the slice without the background
+                slice_rate = self.all_rates(flux_cube, add_extended_background=False)
 
-            # Rates for the slice with the background added
-            slice_rate_plus_bg = self.all_rates(flux_plus_bg, add_extended_background=True)
+                # Rates for the slice with the background added
+                slice_rate_plus_bg = self.all_rates(flux_plus_bg, add_extended_background=True)
 
             # Saturation map for the slice
             slice_saturation = self.get_saturation_mask(rate=slice_rate_plus_bg['fp_pix'])
@@ -594,6 +1050,248 @@ class CoronagraphyDetectorSignal(CoronagraphyConvolvedSceneCube):
         if self.det_pars['rn_correlation']:
             self.read_noise_correlation_matrix = self.current_instrument.get_readnoise_correlation_matrix(self.rate.shape)
     
+    def create_flux_cube(self, background=None):
+        """
+        For imaging modes with options.broadband_psf set, skip the (ny, nx, nwave) flux cube and
+        integrate over wavelength while convolving (see broadband_flux_cube). Otherwise, build the
+        flux cube as usual.
+        """
+        self._release_max_samples()
+        if self.use_broadband_psf():
+            self.apply_wave_grid()
+            return self.broadband_flux_cube(background=background)
+        return super(CoronagraphyDetectorSignal, self).create_flux_cube(background=background)
+
+    def use_broadband_psf(self):
+        """
+        Whether the broadband PSF route applies: it must be requested, and only works for an
+        unsliced imaging mode, where every wavelength plane ends up summed into a single image.
+        """
+        return (self._options.broadband_psf and self.projection_type == 'image' and self.nslice == 1
+                and (self.aper_width is None or self.aper_height is None)
+                and isinstance(self.psf_library, CoronagraphyPSFLibrary))
+
+    def broadband_flux_cube(self, background=None):
+        """
+        Imaging fast path for create_flux_cube.
+
+        The detector rate of an imaging mode is the wavelength integral of the flux cube, scaled by
+        the system throughput and quantum yield. Both that integral and the convolution of each plane
+        with its PSF are linear, so for each source the PSFs can instead be summed first, weighted
+        by the source spectrum, the throughput, the quantum yield and the Simpson's rule weights of
+        the wavelength grid. Convolving the source profile with that single broadband kernel gives
+        its detector rate directly. The rate variance, which has a different quantum yield
+        weighting, gets a second kernel.
+
+        The wavelength-integrated rates are left in self.broadband_rates. Since there is no
+        longer a per-wavelength cube, the flux cubes returned (and with them the 'ote' and 'fp'
+        rates) hold the total over the field at each wavelength, with shape (1, 1, nwave).
+        """
+        instrument_name = self.instrument.get_name()
+        aperture_name = self.instrument.get_aperture()
+        psf_pixsize = self.psf_library.get_pix_scale(instrument_name, aperture_name)
+        psf_upsamp = self.psf_library.get_upsamp(instrument_name, aperture_name)
+
+        detector_npix = int(np.round(self.fov_size / psf_pixsize / psf_upsamp))
+        if detector_npix % 2 == 0:
+            detector_npix += 1
+        scene_npix = detector_npix * psf_upsamp
+
+        if background is not None:
+            pupil_thru = self.psf_library.get_pupil_throughput(self.wave[0], instrument_name, aperture_name)
+            self.bg = background.mjy_pix * pupil_thru
+        else:
+            self.bg = self.wave * 0.0
+
+        # Per-wavelength weights turning flux in mJy into the integrated electron rate and variance
+        throughput = self.focal_plane_rate(self.ote_rate(np.ones_like(self.wave)))
+        q_yield, fano_factor = self.current_instrument.get_quantum_yield(self.wave)
+        var_fudge = self.current_instrument.get_variance_fudge(self.wave)
+        simpson = integrate.simpson(np.eye(self.nw), x=self.wave)
+        rate_weights = simpson * throughput * q_yield
+        variance_weights = simpson * throughput * q_yield * (q_yield + fano_factor) * var_fudge
+
+        scene_grid = coords.Grid(psf_pixsize, psf_pixsize, scene_npix, scene_npix)
+        psf_associations = self.psf_library.associate_offset_to_source(self.scene.sources, instrument_name, aperture_name)
+        unique_offsets = list(set(psf_associations))
+        self.psf_library.prefetch_psfs(self.wave, instrument_name, aperture_name, unique_offsets)
+
+        self.single_point_source = True
+        for src in self.scene.sources:
+            if np.abs(src.position['x_offset']) > psf_pixsize*10:
+                self.single_point_source = False
+            elif np.abs(src.position['y_offset']) > psf_pixsize*10:
+                self.single_point_source = False
+            elif src.shape['geometry'] != 'point':
+                self.single_point_source = False
+
+        # The placeholder PSFs of a prepare_psfs dry run must not end up in the cache
+        use_cache = self._options.source_cache and not self.empty_scene and self._options.psf_requests is None
+        if use_cache:
+            source_cache.resize(self._options.source_cache_bytes)
+            weights_digest = self._digest(np.concatenate([self.wave, rate_weights, variance_weights]))
+
+        intensity = np.zeros((scene_npix, scene_npix))
+        variance = np.zeros((scene_npix, scene_npix))
+        flux_total = np.zeros(self.nw)
+        for unique_offset in unique_offsets:
+            spectra = [self.source_spectra[i] for (i, v) in enumerate(psf_associations) if v == unique_offset]
+            # Each source's contribution is linear in its spectrum, so it can be worked out for a
+            # unit-normalized spectrum (when cached) and scaled.
+            scales = []
+            components = []
+            keys = []
+            for spectrum in spectra:
+                if not np.all(np.isfinite(spectrum.flux)):
+                    raise EngineInputError(value="Calculation error: at least one source is too bright to be computed "
+                                                 "correctly. Check your sources and source normalizations.")
+                scale = 1.
+                key = None
+                component = None
+                if use_cache:
+                    scale = np.sum(np.abs(spectrum.flux))
+                    if scale == 0:
+                        scale = 1.
+                    key = self._source_key(spectrum, scale, unique_offset, scene_grid, weights_digest)
+                    component = source_cache.get(key)
+                scales.append(scale)
+                keys.append(key)
+                components.append(component)
+
+            todo = [i for i, component in enumerate(components) if component is None]
+            planes = {}
+            for i in todo:
+                src = spectra[i].src
+                src.grid = scene_grid
+                planes[i] = ProfileFactory(config=src).normalized()
+                if not np.all(np.isfinite(planes[i])):
+                    raise EngineInputError(value="Calculation error: at least one source is too bright to be computed "
+                                                 "correctly. Check your sources and source normalizations.")
+            rate_kernels = dict((i, None) for i in todo)
+            variance_kernels = dict((i, None) for i in todo)
+            fluxes = dict((i, np.zeros(self.nw)) for i in todo)
+            for iw in range(self.nw if len(todo) > 0 else 0):
+                psf = self.psf_library.get_psf(self.wave[iw], instrument_name, aperture_name, source_offset=unique_offset)
+                if np.abs(psf['pix_scl'] / psf_pixsize - 1) > 1e-10:
+                    raise ValueError("scene sampling must be the same as PSF sampling")
+                psf_sum = psf['int'].sum()
+                for i in todo:
+                    flux = spectra[i].flux[iw] / scales[i]
+                    rate_kernels[i] = self._add_centred(rate_kernels[i], psf['int'], rate_weights[iw] * flux)
+                    variance_kernels[i] = self._add_centred(variance_kernels[i], psf['int'], variance_weights[iw] * flux)
+                    fluxes[i][iw] = flux * planes[i].sum() * psf_sum
+            for i in todo:
+                if self.empty_scene:
+                    images = np.zeros((2, scene_npix, scene_npix))
+                else:
+                    images = np.array([self._convolve(planes[i], rate_kernels[i]),
+                                       self._convolve(planes[i], variance_kernels[i])])
+                components[i] = {'int': images, 'flux': fluxes[i]}
+                if keys[i] is not None:
+                    components[i] = source_cache.put(keys[i], components[i])
+
+            for scale, component in zip(scales, components):
+                intensity += scale * component['int'][0]
+                variance += scale * component['int'][1]
+                flux_total += scale * component['flux']
+
+        grid = coords.Grid(psf_pixsize * psf_upsamp, psf_pixsize * psf_upsamp, detector_npix, detector_npix)
+        shape = (detector_npix, psf_upsamp, detector_npix, psf_upsamp)
+        fp_pix_rate = intensity.reshape(shape).sum(-1).sum(1)
+        fp_pix_variance = variance.reshape(shape).sum(-1).sum(1)
+        bg_rate = np.sum(rate_weights * self.bg)
+        bg_variance = np.sum(variance_weights * self.bg)
+
+        flux_cube = flux_total.reshape((1, 1, self.nw))
+        flux_plus_bg = (flux_total + self.bg * detector_npix**2).reshape((1, 1, self.nw))
+        self.broadband_rates = [(self._broadband_products(fp_pix_rate, fp_pix_variance, flux_cube),
+                                 self._broadband_products(fp_pix_rate + bg_rate, fp_pix_variance + bg_variance,
+                                                          flux_plus_bg))]
+
+        return grid, [grid.get_aperture()], [flux_cube], [flux_plus_bg]
+
+    def _source_key(self, spectrum, scale, source_offset, scene_grid, weights_digest):
+        """
+        Key for the source cache: everything that determines a source's unit-flux detector rates.
+        The spectral shape is rounded to single precision, so that renormalizing a spectrum (which
+        may not exactly preserve its shape) still finds the cached source.
+        """
+        src = spectrum.src
+        instrument_name = self.instrument.get_name()
+        aperture_name = self.instrument.get_aperture()
+        psf_spec = self.psf_library._psf_spec(0., instrument_name, aperture_name, self._options.on_the_fly_oversample,
+                                              source_offset)
+        del psf_spec['wave']
+        spec = {
+                    'psf': psf_spec,
+                    'psf_offset': [self._options.psf_offset_mode, self._options.psf_offset_grid,
+                                   self._options.psf_offset_tolerance],
+                    'instrument': self._options.current_config['configuration']['instrument'],
+                    'shape': src.shape,
+                    'position': src.position,
+                    'grid': [float(scene_grid.xsamp), int(scene_grid.nx)],
+                    'single_point_source': self.single_point_source,
+                    'weights': weights_digest,
+                    'sed': self._digest((spectrum.flux / scale).astype(np.float32))
+               }
+        return psf_key(spec)
+
+    @staticmethod
+    def _digest(array):
+        return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+    def _broadband_products(self, fp_pix_rate, fp_pix_variance, flux):
+        """
+        Package wavelength-integrated rates in the same form as all_rates
+        """
+        ote_rate = self.ote_rate(flux)
+        fp_rate = self.focal_plane_rate(ote_rate)
+        if self.det_pars['ipc'] and self.calculation_config.effects['ipc']:
+            kernel = self.current_instrument.get_ipc_kernel()
+            fp_pix_rate_ipc = self.ipc_convolve(fp_pix_rate, kernel)
+        else:
+            fp_pix_rate_ipc = fp_pix_rate
+        products = {
+            'wave_pix': self.wave_eff(fp_rate),
+            'ote': ote_rate,
+            'fp': fp_rate,
+            'fp_pix': fp_pix_rate_ipc,
+            'fp_pix_no_ipc': fp_pix_rate,
+            'fp_pix_variance': fp_pix_variance
+        }
+        return products
+
+    def _convolve(self, plane, kernel):
+        """
+        Convolve a source profile with a PSF kernel the way Pandeia's AdvancedPSF does, including
+        only convolving the central, kernel-sized part of the field for a single central point source.
+        """
+        scene_npix = plane.shape[0]
+        kernel_npix = kernel.shape[0]
+        if self.single_point_source and kernel_npix <= scene_npix:
+            mini = int((scene_npix - kernel_npix)/2)
+            maxi = int((scene_npix + kernel_npix)/2)
+            intensity = np.zeros((scene_npix, scene_npix))
+            intensity[mini:maxi, mini:maxi] = sg.fftconvolve(plane[mini:maxi, mini:maxi], kernel, mode='same')
+            return intensity
+        return sg.fftconvolve(plane, kernel, mode='same')
+
+    @staticmethod
+    def _add_centred(kernel, psf, weight):
+        """
+        Return kernel + weight * psf. PSFs may change size with wavelength (they are clipped at the
+        critical angle), so the smaller array is zero-padded about the pixel that fftconvolve
+        treats as its centre.
+        """
+        psf = weight * np.asarray(psf, dtype=np.float64)
+        if kernel is None:
+            return psf
+        if psf.shape[0] > kernel.shape[0]:
+            kernel, psf = psf, kernel
+        lo = (kernel.shape[0] - 1)//2 - (psf.shape[0] - 1)//2
+        kernel[lo:lo + psf.shape[0], lo:lo + psf.shape[1]] += psf
+        return kernel
+
     def spectral_detector_transform(self):
         """
         Create engine API format dict section containing properties of wavelength coordinates
@@ -954,7 +1652,7 @@ class CoronagraphyDetectorSignal(CoronagraphyConvolvedSceneCube):
         q_yield, fano_factor = self.current_instrument.get_quantum_yield(self.wave)
 
         # convert the photon rate to electron rate by multiplying by the quantum yield which is a function of wavelength
-        electron_rate_pix = integrate.simps(rate * q_yield, self.wave)
+        electron_rate_pix = integrate.simpson(rate * q_yield, x=self.wave)
 
         # to meet IDT expectations, some instruments require a possibly chromatic fudge factor to be applied
         # to the per-pixel electron rate variance.
@@ -963,7 +1661,7 @@ class CoronagraphyDetectorSignal(CoronagraphyConvolvedSceneCube):
         # the variance in the electron rate, Ve, is also scaled by the quantum yield plus a fano factor which is
         # analytic in the simple 1 or 2 electron case: Ve = (qy + fano) * Re.  since Re is the photon rate
         # scaled by the quantum yield, Re = qy * Rp, we get: Ve = qy * (qy + fano) * Rp
-        electron_variance_pix = integrate.simps(rate * q_yield * (q_yield + fano_factor) * var_fudge, self.wave)
+        electron_variance_pix = integrate.simpson(rate * q_yield * (q_yield + fano_factor) * var_fudge, x=self.wave)
 
         products = electron_rate_pix, electron_variance_pix
 
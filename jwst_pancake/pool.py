@@ -0,0 +1,249 @@
+from __future__ import absolute_import
+
+"""
+A long-lived pool of worker processes for running batches of pandeia calculations.
+"""
+
+from copy import deepcopy
+import multiprocessing as mp
+import sys
+import traceback
+import warnings
+
+if sys.version_info[0] >= 3:
+    import queue
+else:
+    import Queue as queue
+
+import numpy as np
+
+from .psf_cache import attach_arena, create_arena, remove_arena
+from .rng import noise_seed, seed_sequence
+
+
+def _init_worker(arena, warm, arena_bytes=None):
+    '''
+    Pool initializer. Attach to the shared PSF arena (holding at most arena_bytes of PSFs) and, if
+    requested, pay the one-off costs of a first calculation (importing pandeia and webbpsf, reading
+    the pandeia reference data) before any calculation is submitted.
+    '''
+    attach_arena(arena, arena_bytes)
+    if not warm:
+        return
+    try:
+        from pandeia.engine.calc_utils import build_default_calc
+        from pandeia.engine.instrument_factory import InstrumentFactory
+        import webbpsf
+        for instrument in ['nircam', 'miri']:
+            calc = build_default_calc('jwst', instrument, 'coronagraphy')
+            InstrumentFactory(config=calc['configuration'])
+        webbpsf.NIRCam()
+        webbpsf.MIRI()
+    except Exception as e:
+        warnings.warn("Unable to pre-warm pancake worker: {}".format(e))
+
+def _run_chunk(task):
+    '''
+    Run a chunk of (index, calcfile, noise_seed) tasks in a worker, returning (index, result, error)
+    for each. A noise_seed other than None replaces options.noise_seed for that calculation.
+    The chunk comes with a snapshot of the engine options in the parent, which is applied only for
+    the duration of the chunk. Errors are sent back as formatted tracebacks, since not every
+    exception raised by pandeia can be pickled.
+    '''
+    from .engine import perform_calculation, private_options
+    current_options, chunk = task
+    results = []
+    with private_options(current_options):
+        for index, calcfile, calc_seed in chunk:
+            try:
+                with private_options() as calc_options:
+                    if calc_seed is not None:
+                        calc_options.noise_seed = calc_seed
+                    results.append((index, perform_calculation(calcfile), None))
+            except Exception:
+                results.append((index, None, traceback.format_exc()))
+    return results
+
+def _chunks(calcfiles, chunksize, seed=None, skip=()):
+    '''
+    Lazily group calculations into lists of (index, calcfile, noise_seed) tuples, where the noise
+    seed for each calculation is spawned from seed in order (or is None if seed is None). Indices in
+    skip are left out, without changing the noise seeds of the others.
+    '''
+    if seed is not None:
+        seed = seed_sequence(seed)
+    chunk = []
+    for index, calcfile in enumerate(calcfiles):
+        calc_seed = None
+        if seed is not None:
+            calc_seed = noise_seed(seed.spawn(1)[0])
+        if index in skip:
+            continue
+        chunk.append((index, calcfile, calc_seed))
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+class EnginePool(object):
+    '''
+    A reusable pool of worker processes for pandeia calculations.
+
+    Unlike calculate_batch, which starts a new pool for every batch and returns nothing until the
+    whole batch is done, an EnginePool keeps its workers (and whatever they have cached, such as
+    PSFs, webbpsf instruments and pandeia reference data) between batches, and can stream results
+    back as they finish, with only a bounded number of calculations submitted at any time.
+
+    Parameters
+    ----------
+    nprocesses: int, default None
+        Number of worker processes. Defaults to one per CPU.
+    warm: bool, default True
+        Import pandeia and webbpsf and load reference data in each worker as it starts.
+    maxtasksperchild: int, default None
+        Passed on to multiprocessing.Pool.
+
+    If the options.cache is 'ram' and options.shared_psf_cache is set, the workers share a PSF arena
+    (of at most options.shared_psf_cache_bytes) for the lifetime of the pool.
+
+    Use as a context manager, or call close() when done:
+
+        with EnginePool(8) as pool:
+            for index, report in pool.imap(calcfiles, callback=progress):
+                ...
+    '''
+    def __init__(self, nprocesses=None, warm=True, maxtasksperchild=None):
+        from .engine import get_options
+        options = get_options()
+        if nprocesses is None:
+            nprocesses = mp.cpu_count()
+        self.nprocesses = nprocesses
+        self._arena = None
+        if options.cache == 'ram' and options.shared_psf_cache:
+            self._arena = create_arena()
+        try:
+            initargs = (self._arena, warm, options.shared_psf_cache_bytes)
+            self._pool = mp.Pool(processes=nprocesses, initializer=_init_worker, initargs=initargs,
+                                 maxtasksperchild=maxtasksperchild)
+        except Exception:
+            self._remove_arena()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def imap(self, calcfiles, chunksize=1, max_in_flight=None, callback=None, seed=None, skip=None):
+        '''
+        Run calculations, yielding (index, report) tuples in the order in which they finish, where
+        index is the position of the calculation in calcfiles. The calculations use the engine
+        options as they are when imap is called.
+
+        Parameters
+        ----------
+        calcfiles: iterable
+            Pandeia calculation dictionaries. This is consumed lazily, so it can be a generator.
+        chunksize: int, default 1
+            Number of calculations sent to a worker at a time
+        max_in_flight: int, default None
+            Largest number of calculations submitted but not yet yielded. Defaults to twice the
+            number of calculations that the workers can hold at once.
+        callback: function, default None
+            Called as callback(index, report, ncompleted) in the parent process as each result
+            arrives, e.g. to report progress.
+        seed: int or numpy.random.SeedSequence, default None
+            If given, each calculation gets its own noise seed, derived from seed and from its
+            position in calcfiles (see rng.py), so results don't depend on the number of workers
+            or on chunksize. By default, options.noise_seed applies to every calculation.
+        skip: set, default None
+            Indices of calculations not to run (e.g. those already done by an interrupted batch)
+        '''
+        if max_in_flight is None:
+            max_in_flight = 2 * self.nprocesses * chunksize
+        max_chunks = max(1, max_in_flight // chunksize)
+        done = queue.Queue()
+        kwargs = {}
+        if sys.version_info[0] >= 3:
+            # Report results that can't be sent back (e.g. unpicklable) rather than waiting forever
+            kwargs['error_callback'] = lambda e: done.put([(None, None, repr(e))])
+
+        # Workers may not share the parent's options (e.g. under the 'spawn' start method, or if
+        # the options have changed since the pool started), so every chunk carries a copy of them.
+        from .engine import get_options
+        options = get_options()
+        current_options = deepcopy(options.current_options)
+
+        chunks = _chunks(calcfiles, chunksize, seed, skip or ())
+        exhausted = False
+        in_flight = 0
+        ncompleted = 0
+        while True:
+            while not exhausted and in_flight < max_chunks:
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                self._pool.apply_async(_run_chunk, ((current_options, chunk),), callback=done.put, **kwargs)
+                in_flight += 1
+            if in_flight == 0:
+                break
+            results = done.get()
+            in_flight -= 1
+            for index, result, error in results:
+                if error is not None:
+                    raise RuntimeError("Calculation {} failed in worker:\n{}".format(index, error))
+                ncompleted += 1
+                if callback is not None:
+                    callback(index, result, ncompleted)
+                yield index, result
+
+    def map(self, calcfiles, chunksize=1, max_in_flight=None, callback=None, seed=None):
+        '''
+        Run calculations and return the list of reports, in the same order as calcfiles.
+        '''
+        calcfiles = list(calcfiles)
+        results = [None for calcfile in calcfiles]
+        for index, result in self.imap(calcfiles, chunksize=chunksize, max_in_flight=max_in_flight,
+                                       callback=callback, seed=seed):
+            results[index] = result
+        return results
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        '''
+        Run func(*args) in a worker, as multiprocessing.Pool.apply_async. The error_callback is
+        ignored on Python 2.
+        '''
+        kwargs = {}
+        if error_callback is not None and sys.version_info[0] >= 3:
+            kwargs['error_callback'] = error_callback
+        return self._pool.apply_async(func, args, callback=callback, **kwargs)
+
+    def close(self):
+        '''
+        Wait for the workers to finish and shut down the pool.
+        '''
+        self._pool.close()
+        self._pool.join()
+        self._remove_arena()
+        np.random.seed(None) # reset Pandeia seed
+
+    def terminate(self):
+        '''
+        Stop the workers immediately.
+        '''
+        self._pool.terminate()
+        self._pool.join()
+        self._remove_arena()
+
+    def _remove_arena(self):
+        if self._arena is not None:
+            remove_arena(self._arena)
+            self._arena = None
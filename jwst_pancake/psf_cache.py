@@ -0,0 +1,446 @@
+from __future__ import absolute_import
+
+"""
+Storage back-ends for monochromatic PSFs generated on-the-fly with webbpsf.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+store_version = 1       # Bump this if the layout of stored PSFs changes, so that old stores are ignored
+shard_maxbytes = 2**28  # Start a new shard file once the current one exceeds this many bytes
+default_cache_bytes = 2**29 # Default size of the in-memory PSF cache (512 MiB)
+
+
+def psf_key(spec):
+    '''
+    Return a content hash for a PSF specification.
+
+    The specification is a dictionary holding every input that affects the generated PSF (wavelength,
+    instrument, aperture, filter, offset, oversampling, webbpsf options, OPD, etc.). Two PSFs share a
+    key if, and only if, all of those inputs are the same. Arrays are hashed by content, and values
+    that can't be described by their content (see opd_key) raise a TypeError rather than being keyed
+    by something that changes from one process to the next.
+    '''
+    contents = json.dumps([store_version, spec], sort_keys=True, default=_key_value)
+    return hashlib.sha1(contents.encode('utf-8')).hexdigest()
+
+def _key_value(value):
+    '''
+    JSON encoding of the non-JSON values allowed in a PSF specification
+    '''
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return {'sha1': array_digest(value)}
+    raise TypeError("Can't build a PSF key from a {}".format(type(value).__name__))
+
+def array_digest(array):
+    '''
+    Return a sha1 hash of the contents, dtype and shape of an array.
+    '''
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(repr((array.dtype.str, array.shape)).encode('utf-8'))
+    digest.update(array.tobytes())
+    return digest.hexdigest()
+
+_opd_digests = OrderedDict()
+_opd_digests_lock = threading.Lock()
+
+def opd_key(opd):
+    '''
+    Return a description of a webbpsf OPD (options.on_the_fly_webbpsf_opd) that only depends on its
+    contents, for use in PSF and instrument keys: the file name (and slice) for an OPD given by name,
+    or a sha1 of the data for an OPD given as an array, a FITS HDU or an HDUList (one per HDU).
+
+    Hashing a large OPD for every PSF would be slow, so the digests of the last few OPD objects are
+    kept, along with the objects themselves (so that their ids can't be reused by different OPDs).
+    An OPD array modified in place should therefore be passed as a new object.
+    '''
+    if opd is None or isinstance(opd, (str, int, float)):
+        return opd
+    if isinstance(opd, (tuple, list)):
+        # Including an HDUList, which is a list of HDUs
+        return [opd_key(item) for item in opd]
+    if hasattr(opd, 'data') and hasattr(opd, 'header') and opd.data is None:
+        return None
+    with _opd_digests_lock:
+        cached = _opd_digests.get(id(opd))
+        if cached is not None and cached[0] is opd:
+            return cached[1]
+    if isinstance(opd, np.ndarray):
+        digest = array_digest(opd)
+    elif hasattr(opd, 'data') and hasattr(opd, 'header'):
+        digest = array_digest(np.asarray(opd.data))
+    else:
+        raise TypeError("Can't build a PSF key from an OPD given as a {}".format(type(opd).__name__))
+    key = {'sha1': digest}
+    with _opd_digests_lock:
+        _opd_digests[id(opd)] = (opd, key)
+        while len(_opd_digests) > 8:
+            _opd_digests.popitem(last=False)
+    return key
+
+
+class PSFCache(object):
+    '''
+    An in-memory, least-recently-used cache of PSF dictionaries whose size is bounded by the number
+    of bytes in the PSF images rather than by the number of entries. A single oversampled bar-mask
+    PSF costs several times as much memory as a MIRI PSF, so counting entries gives a very different
+    footprint from one mode to the next.
+
+    Cached PSF images are marked read-only. By default they are shared with the caller rather than
+    copied; pass copy=True to get() or put() to receive a private, writeable copy instead.
+
+    Users aren't expected to interact with this class directly. Use the psf_cache_bytes,
+    psf_cache_readonly and psf_cache_stats options on the engine.options object instead.
+    '''
+    def __init__(self, max_bytes=default_cache_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.nbytes = 0
+        self.reset_stats()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, copy=False):
+        '''
+        Return the cached PSF dictionary for key (marking it as most recently used), or None.
+        '''
+        with self._lock:
+            psf = self._entries.get(key)
+            if psf is None:
+                self.misses += 1
+                return None
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+            return self._share(psf, copy)
+
+    def put(self, key, psf, copy=False):
+        '''
+        Add a PSF dictionary to the cache, evicting least recently used entries until it fits, and
+        return the dictionary that should be handed to the caller. PSFs larger than the whole
+        cache are passed straight through without being stored.
+        '''
+        psf = dict(psf)
+        image = np.asarray(psf['int'])
+        if image.flags.writeable:
+            if not image.flags.owndata:
+                image = image.copy()
+            image.flags.writeable = False
+        psf['int'] = image
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)['int'].nbytes
+            if image.nbytes <= self.max_bytes:
+                self._entries[key] = psf
+                self.nbytes += image.nbytes
+                self._evict()
+        return self._share(psf, copy)
+
+    def resize(self, max_bytes):
+        '''
+        Change the byte budget, evicting entries if the cache no longer fits.
+        '''
+        with self._lock:
+            if max_bytes != self.max_bytes:
+                self.max_bytes = max_bytes
+                self._evict()
+
+    def clear(self):
+        '''
+        Drop every cached PSF. The statistics are left alone.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def reset_stats(self):
+        '''
+        Zero the hit, miss and eviction counters.
+        '''
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        '''
+        Return a dictionary of cache statistics.
+        '''
+        with self._lock:
+            return {
+                        'hits': self.hits,
+                        'misses': self.misses,
+                        'evictions': self.evictions,
+                        'entries': len(self._entries),
+                        'bytes': self.nbytes,
+                        'max_bytes': self.max_bytes
+                   }
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._entries) > 0:
+            _, psf = self._entries.popitem(last=False)
+            self.nbytes -= psf['int'].nbytes
+            self.evictions += 1
+
+    @staticmethod
+    def _share(psf, copy):
+        psf = dict(psf)
+        if copy:
+            psf['int'] = np.array(psf['int'])
+        return psf
+
+
+ram_cache = PSFCache()
+
+# Per-source detector rate images, normalized to unit flux, for the broadband PSF route. Entries
+# hold the rate and variance images stacked as 'int', so they are budgeted like PSFs. Like
+# ram_cache, it is resized to the options in use (options.source_cache_bytes) wherever it is used.
+source_cache = PSFCache(2**28)
+
+
+class PSFStore(object):
+    '''
+    A content-addressed, on-disk PSF store.
+
+    All PSFs live in a single directory, which contains:
+        - index.jsonl: an append-only index, one JSON record per line, mapping a PSF key to its
+          location and metadata
+        - psfs-<pid>-<n>.f32 (or .f64): packed shards holding the PSF images back to back
+
+    Lookups are a dictionary access into the in-memory copy of the index, and PSF images are returned
+    as read-only views into memory-mapped shards, so that a cold start only has to read the index
+    file. Each process appends to its own shard, so several processes (e.g. calculate_batch workers)
+    can share a store. Newly-added index records are picked up whenever a lookup misses.
+
+    Images are stored as dtype (float32 by default). If max_bytes is set, put() stops adding images
+    once the images in the store (from all processes sharing it) would exceed that many bytes.
+
+    Users aren't expected to create these directly. Use get_store() to obtain the store for a path.
+    '''
+    def __init__(self, path, dtype=np.float32, max_bytes=None):
+        self.path = os.path.abspath(path)
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._index_file = os.path.join(self.path, 'index.jsonl')
+        self._index = {}
+        self._index_pos = 0
+        self._maps = {}
+        self._writer = None
+        self._writer_name = None
+        self._writer_pid = None
+        self._nshards = 0
+        self._lock = threading.RLock()
+        self._refresh()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._index:
+                self._refresh()
+            return key in self._index
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+    def get(self, key):
+        '''
+        Return (image, metadata) for a stored PSF, or None if the key is not present. The image is
+        a read-only view into the memory-mapped shard.
+        '''
+        with self._lock:
+            if key not in self._index:
+                self._refresh()
+                if key not in self._index:
+                    return None
+            entry = self._index[key]
+            shape = tuple(entry['shape'])
+            size = int(np.prod(shape))
+            shard = self._map_shard(entry['shard'], entry.get('dtype', 'float32'), entry['offset'] + size)
+            image = shard[entry['offset']:entry['offset'] + size].reshape(shape)
+            return image, entry['meta']
+
+    def put(self, key, image, meta):
+        '''
+        Add a PSF image (stored as the store's dtype) and its metadata to the store. Metadata must be
+        JSON-serializable. Returns True if the PSF is in the store afterwards, and False if it was not
+        added because the store is full.
+        '''
+        image = np.ascontiguousarray(image, dtype=self.dtype)
+        with self._lock:
+            if key in self:
+                return True
+            if self.max_bytes is not None and self.nbytes + image.nbytes > self.max_bytes:
+                return False
+            writer = self._get_writer(image.nbytes)
+            offset = writer.tell() // image.itemsize
+            writer.write(image.tobytes())
+            writer.flush()
+            entry = {
+                        'key': key,
+                        'shard': self._writer_name,
+                        'offset': offset,
+                        'shape': list(image.shape),
+                        'dtype': self.dtype.name,
+                        'meta': meta
+                    }
+            # The shard data is written before the index record, so other processes never see a
+            # record for data that isn't there yet. Append the record in a single write.
+            line = (json.dumps(entry) + '\n').encode('utf-8')
+            fd = os.open(self._index_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            self._add_entry(entry)
+            return True
+
+    def close(self):
+        '''
+        Close the shard writer and drop all memory maps.
+        '''
+        with self._lock:
+            if self._writer is not None and self._writer_pid == os.getpid():
+                self._writer.close()
+            self._writer = None
+            self._maps = {}
+
+    def _refresh(self):
+        '''
+        Read any index records appended since the last refresh. Only complete lines are consumed.
+        '''
+        if not os.path.exists(self._index_file):
+            return
+        with open(self._index_file, 'rb') as inf:
+            inf.seek(self._index_pos)
+            new_records = inf.read()
+        end = new_records.rfind(b'\n') + 1
+        for line in new_records[:end].splitlines():
+            if line.strip():
+                self._add_entry(json.loads(line.decode('utf-8')))
+        self._index_pos += end
+
+    def _add_entry(self, entry):
+        '''
+        Add an index record, keeping track of the total size of the stored images.
+        '''
+        if entry['key'] not in self._index:
+            itemsize = np.dtype(entry.get('dtype', 'float32')).itemsize
+            self.nbytes += int(np.prod(entry['shape'])) * itemsize
+        self._index[entry['key']] = entry
+
+    def _map_shard(self, name, dtype, min_size):
+        '''
+        Return a memory map of a shard, re-mapping it if it has grown since it was mapped.
+        '''
+        shard = self._maps.get(name)
+        if shard is None or shard.size < min_size:
+            shard = np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r')
+            self._maps[name] = shard
+        return shard
+
+    def _get_writer(self, nbytes):
+        '''
+        Return the shard file this process appends to, starting a new shard if there isn't one yet,
+        if the current one is full, or if we are in a forked child of the process that opened it.
+        '''
+        pid = os.getpid()
+        if self._writer is not None and self._writer_pid != pid:
+            # Inherited across a fork. Leave the parent's file alone and start our own.
+            self._writer = None
+        if self._writer is not None and self._writer.tell() + nbytes > shard_maxbytes:
+            self._writer.close()
+            self._writer = None
+        if self._writer is None:
+            while True:
+                name = 'psfs-{}-{}.f{}'.format(pid, self._nshards, 8 * self.dtype.itemsize)
+                self._nshards += 1
+                if not os.path.exists(os.path.join(self.path, name)):
+                    break
+            self._writer = open(os.path.join(self.path, name), 'ab')
+            self._writer_name = name
+            self._writer_pid = pid
+        return self._writer
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(path, dtype=np.float32, max_bytes=None):
+    '''
+    Return the PSFStore for a directory, creating it (with dtype and max_bytes, see PSFStore) if
+    necessary. There is one store object per directory per process, so the index is only read from
+    disk once.
+    '''
+    path = os.path.abspath(path)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = PSFStore(path, dtype=dtype, max_bytes=max_bytes)
+        return _stores[path]
+
+
+_arena_path = None
+_arena_bytes = None
+
+def create_arena():
+    '''
+    Create a temporary PSF store to be shared by a group of worker processes (e.g. the pool started
+    by calculate_batch), and return its path. The store lives in shared memory (/dev/shm) where that
+    is available, so PSF images written by one worker are read zero-copy, through memory maps, by
+    all of the others. Since shared memory counts against RAM, the arena is bounded (see
+    attach_arena) and stops taking new PSFs once it is full.
+    '''
+    parent = None
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        parent = '/dev/shm'
+    return tempfile.mkdtemp(prefix='pancake_psfs_', dir=parent)
+
+def attach_arena(path, max_bytes=None):
+    '''
+    Use the shared PSF arena at path in this process (None to stop using one), holding at most
+    max_bytes of PSF images (no limit if None). This is intended as a multiprocessing.Pool
+    initializer.
+    '''
+    global _arena_path, _arena_bytes
+    _arena_path = path
+    _arena_bytes = max_bytes
+
+def get_arena():
+    '''
+    Return the PSFStore for the shared arena attached to this process, or None. Arena PSFs are
+    stored as float64, so that they are identical to the ones a serial calculation uses.
+    '''
+    if _arena_path is None:
+        return None
+    return get_store(_arena_path, dtype=np.float64, max_bytes=_arena_bytes)
+
+def remove_arena(path):
+    '''
+    Detach from and delete a shared PSF arena.
+    '''
+    path = os.path.abspath(path)
+    if _arena_path is not None and os.path.abspath(_arena_path) == path:
+        attach_arena(None)
+    with _stores_lock:
+        store = _stores.pop(path, None)
+    if store is not None:
+        store.close()
+    shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,225 @@
+from __future__ import absolute_import
+
+"""
+Recalculate the noise, saturation and signal-to-noise of a pandeia calculation for new exposure
+parameters, without recalculating its scene, PSFs or detector count rates.
+"""
+
+from copy import deepcopy
+import warnings
+
+import numpy as np
+
+import pandeia
+from pandeia.engine import observation
+from pandeia.engine.calc_utils import build_empty_scene
+from pandeia.engine.etc3D import CalculationConfig, DetectorNoise
+from pandeia.engine.instrument_factory import InstrumentFactory
+from pandeia.engine.report import ReportFactory
+from pandeia.engine.scene import Scene
+from pandeia.engine.strategy import StrategyFactory
+
+from .rng import generator, global_random_lock, noise_seed, seed_sequence
+
+# Detector parameters that only change how the count rates are read out
+exposure_keys = ('ngroup', 'nint', 'nexp', 'readout_pattern')
+
+
+def update_exposure(signal):
+    '''
+    Recalculate the products of a pandeia DetectorSignal that depend on its instrument's exposure
+    specification (saturation and number of groups before saturation), reusing its count rates.
+    '''
+    exposure_spec = signal.current_instrument.exposure_spec
+    fullwell = signal.det_pars['fullwell']
+    signal.saturation_list = [signal.get_saturation_mask(rate=rate['fp_pix']) for rate in signal.rate_plus_bg_list]
+    signal.groups_list = [exposure_spec.get_groups_before_sat(rate['fp_pix'], fullwell) for rate in signal.rate_plus_bg_list]
+    signal.ngroup_map = exposure_spec.get_groups_before_sat(signal.rate_plus_bg, fullwell)
+    signal.fraction_saturation = np.max(exposure_spec.get_saturation_fraction(signal.rate_plus_bg, fullwell))
+    bgsat = signal.get_saturation_mask(rate=signal.bg_pix_rate)
+    if (np.sum(bgsat) > 0) or (np.isnan(np.sum(bgsat))):
+        signal.warnings['background_saturated'] = pandeia.engine.etc3D.warning_messages['background_saturated']
+    else:
+        signal.warnings.pop('background_saturated', None)
+
+
+def noise_realizations(signal, noise, n, saturation=None, seed=None):
+    '''
+    Draw n noise realizations of a detector image at once, returning an (n, ny, nx) array.
+
+    Pandeia's noisy detector image is signal + noise * N(0, 1), where signal is the noiseless
+    detector rate and noise its standard deviation, which includes whichever of read noise, dark
+    current, flat-field noise and cosmic rays are turned on in options.noise. Fully saturated
+    pixels (saturation == 2) have an undefined noise, and come out as NaN, as in pandeia.
+
+    Parameters
+    ----------
+    signal, noise: numpy arrays
+        Noiseless detector image and its standard deviation, e.g. the 'detector_signal' and
+        'detector_noise' products extracted by a pandeia strategy
+    n: int
+        Number of realizations
+    saturation: numpy array, default None
+        Saturation map (0, 1 or 2 for each pixel)
+    seed: int or numpy.random.SeedSequence, default None
+        Seed for the random draws (see rng.py)
+    '''
+    noise = np.array(noise, dtype=np.float64)
+    if saturation is not None:
+        noise[np.asarray(saturation) == 2] = np.nan
+    rng = generator(seed)
+    return signal + noise * rng.standard_normal((n,) + noise.shape)
+
+
+class ExposureScan(object):
+    '''
+    A pandeia calculation whose detector signal (the scene, the PSFs and the noiseless count rates:
+    rate, rate_plus_bg, fp_pix_variance, the background) is calculated once, and from which reports
+    can then be produced for any number of exposure configurations. Each report only recalculates
+    the detector noise, saturation and extracted signal-to-noise, so a scan over many exposures
+    costs about as much as a single calculation:
+
+        scan = ExposureScan(calcfile)
+        reports = scan.reports([{'ngroup': n} for n in range(2, 11)])
+
+    An exposure configuration is a dictionary that updates calcfile['configuration']['detector'],
+    and may set ngroup, nint, nexp and readout_pattern. Anything else (e.g. the subarray) changes
+    the count rates, and needs a new calculation.
+
+    The calculation runs with the engine options in use when the scan is created, and with pandeia's
+    webapp checks off (unless webapp is True), as with engine.perform_calculation. Coronagraphic
+    contrast calculations and dispersed (slitless or multi-order) modes aren't supported.
+    '''
+    def __init__(self, calcfile, webapp=False):
+        from .engine import _calculation_config, private_options
+        with private_options() as calc_options:
+            config = _calculation_config(calcfile, calc_options)
+            self._options = calc_options
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', category = np.VisibleDeprecationWarning) # Suppress float-indexing warnings
+                self._calculate_signal(config, webapp)
+        # Reset the fixed seed state set by the pandeia engine
+        with global_random_lock:
+            np.random.seed(None)
+
+    def _calculate_signal(self, config, webapp):
+        '''
+        The part of pandeia's calculate_sn that doesn't depend on the exposure configuration.
+        '''
+        scene_configuration = config['scene']
+        if len(scene_configuration) == 0:
+            scene_configuration = build_empty_scene()
+        scene = Scene(input=scene_configuration, webapp=webapp)
+        instrument = InstrumentFactory(config=config['configuration'], webapp=webapp)
+        strategy = StrategyFactory(instrument, config=config['strategy'], webapp=webapp)
+        if hasattr(strategy, "calc_type"):
+            raise ValueError("ExposureScan doesn't support {} calculations".format(strategy.calc_type))
+        if instrument.projection_type in ['slitless', 'multiorder']:
+            raise ValueError("ExposureScan doesn't support {} modes".format(instrument.projection_type))
+
+        obs = observation.Observation(scene=scene, instrument=instrument, strategy=strategy,
+                                      background=config['background'],
+                                      background_level=config.get('background_level', 'medium'),
+                                      webapp=webapp)
+        # Pandeia seeds numpy's global random state here, although it only draws from it for the
+        # report (see report()). Hold the lock, so as not to reseed it under another thread's draws.
+        with global_random_lock:
+            np.random.seed(seed=obs.get_random_seed())
+
+        self.config = config
+        self.warnings = {}
+        self.warnings.update(scene.warnings)
+        self.warnings.update(instrument.warnings)
+        self.observations = []
+        self.signals = []
+        if hasattr(strategy, 'dithers'):
+            dither_list = strategy.dithers
+        else:
+            dither_list = [{'x': 0.0, 'y': 0.0}]
+        calc_config = CalculationConfig(config=config['calculation'])
+        for dither in dither_list:
+            o = deepcopy(obs)
+            o.scene.offset(dither)
+            # Looked up at call time, so that pancake's detector signal is used if it's configured
+            signal = pandeia.engine.etc3D.DetectorSignal(o, calc_config=calc_config, webapp=webapp, order=None)
+            self.observations.append(o)
+            self.signals.append(signal)
+        self._strategy = strategy
+        self._signal_warnings = [dict(signal.warnings) for signal in self.signals]
+
+    def report(self, exposure=None, noise_seed=None):
+        '''
+        Return the pandeia report (as a dictionary) for an exposure configuration (None for the
+        exposure in the original calculation). If noise_seed is given, it replaces options.noise_seed
+        for this report. Only options.products are kept, as in engine.perform_calculation.
+        '''
+        from .engine import private_options, select_products, using_options
+        with using_options(self._options), private_options() as report_options:
+            if noise_seed is not None:
+                report_options.noise_seed = noise_seed
+            config, noise_list, saturation_list, extracted_sn_list = self._extract(exposure)
+            with global_random_lock, warnings.catch_warnings():
+                warnings.filterwarnings('ignore', category = np.VisibleDeprecationWarning) # Suppress float-indexing warnings
+                np.random.seed(seed=self.observations[0].get_random_seed())
+                report_warnings = dict(self.warnings)
+                report_warnings.update(extracted_sn_list[0]['warnings'])
+                report = ReportFactory(config, self.signals, noise_list, saturation_list, extracted_sn_list,
+                                       report_warnings)
+                np.random.seed(None)
+        return select_products(report.as_dict(), report_options.products)
+
+    def realizations(self, n, exposure=None, seed=None):
+        '''
+        Return n noisy detector images for an exposure configuration (None for the exposure in the
+        original calculation), as an (n, ny, nx) array. Each one is equivalent to the '2d'
+        'detector' image of a new report (see noise_realizations), but they are all drawn at once.
+        '''
+        from .engine import using_options
+        with using_options(self._options):
+            config, noise_list, saturation_list, extracted_sn_list = self._extract(exposure)
+        products = extracted_sn_list[0]
+        return noise_realizations(products['detector_signal'], products['detector_noise'], n,
+                                  saturation=products['detector_saturation'], seed=seed)
+
+    def _extract(self, exposure):
+        '''
+        Set up the exposure configuration, and return the calculation config, the noise and
+        saturation for each dither, and the products extracted by the strategy.
+        '''
+        exposure = dict(exposure or {})
+        for key in exposure:
+            if key not in exposure_keys:
+                raise ValueError("Can't change {} without a new calculation (only {} can be "
+                                 "changed)".format(key, ", ".join(exposure_keys)))
+        config = deepcopy(self.config)
+        config['configuration']['detector'].update(exposure)
+
+        # The strategy was built with the original instrument, and each dither has its own copy
+        instruments = [self._strategy.instrument] + [o.instrument for o in self.observations]
+        for instrument in instruments:
+            instrument.detector.update(config['configuration']['detector'])
+            instrument.exposure_spec = instrument.get_exposure_pars()
+
+        noise_list = []
+        saturation_list = []
+        for o, signal, signal_warnings in zip(self.observations, self.signals, self._signal_warnings):
+            # Extracting products adds to the signal warnings, so start from the originals
+            signal.warnings = dict(signal_warnings)
+            update_exposure(signal)
+            noise_list.append(DetectorNoise(signal, o))
+            saturation_list.append(signal.get_saturation_mask())
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category = np.VisibleDeprecationWarning) # Suppress float-indexing warnings
+            extracted_sn_list = deepcopy(self._strategy).extract(self.signals, noise_list)
+        return config, noise_list, saturation_list, extracted_sn_list
+
+    def reports(self, exposures, seed=None):
+        '''
+        Return the pandeia reports (as dictionaries) for a list of exposure configurations. If seed
+        is given, each report gets its own noise seed derived from it (see rng.py).
+        '''
+        if seed is None:
+            return [self.report(exposure) for exposure in exposures]
+        seeds = seed_sequence(seed).spawn(len(exposures))
+        return [self.report(exposure, noise_seed(s)) for exposure, s in zip(exposures, seeds)]
@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+
+"""
+Reproducible random streams for calculations run in parallel.
+
+A run (e.g. calculate_contrast_curve) is given a single seed, from which a tree of independent
+seeds is spawned: one for the run's own random draws (TA and FSM errors), and one per calculation
+for the noise that pandeia adds. Seeds are spawned in the order in which calculations are set up,
+not the order in which they run, so the results don't depend on the number of workers or on
+scheduling. The entropy of the root seed is returned with the results, so a run started with
+seed=None can be repeated exactly.
+"""
+
+import binascii
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+
+class _SeedSequence(object):
+    '''
+    Minimal stand-in for numpy.random.SeedSequence (numpy 1.17+): a seed identified by its root
+    entropy and its position in the tree of spawned seeds.
+    '''
+    def __init__(self, entropy=None, spawn_key=()):
+        if entropy is None:
+            entropy = int(binascii.hexlify(os.urandom(16)), 16)
+        self.entropy = entropy
+        self.spawn_key = tuple(spawn_key)
+        self.n_children_spawned = 0
+
+    def spawn(self, n_children):
+        start = self.n_children_spawned
+        self.n_children_spawned += n_children
+        return [_SeedSequence(self.entropy, self.spawn_key + (i,)) for i in range(start, start + n_children)]
+
+    def generate_state(self, n_words, dtype=np.uint32):
+        state = b''
+        counter = 0
+        while len(state) < 4 * n_words:
+            contents = repr((int(self.entropy), [int(k) for k in self.spawn_key], counter))
+            state += hashlib.sha256(contents.encode('utf-8')).digest()
+            counter += 1
+        return np.frombuffer(state[:4 * n_words], dtype=np.uint32).astype(dtype)
+
+# Pandeia seeds numpy's global random state at the start of a calculation, and draws its noise from
+# it later on. Code that seeds the global state and then draws from it holds this lock, so that
+# calculations running in other threads can't reseed it in between.
+global_random_lock = threading.RLock()
+
+if hasattr(np.random, 'SeedSequence'):
+    SeedSequence = np.random.SeedSequence
+else:
+    SeedSequence = _SeedSequence
+
+
+def seed_sequence(seed=None):
+    '''
+    Return a SeedSequence for seed, which may be None (fresh entropy), an int, or a SeedSequence.
+    A SeedSequence is copied (as it was before spawning any children), so that spawning from the
+    result gives the same seeds every time it is passed in.
+    '''
+    if isinstance(seed, SeedSequence):
+        return SeedSequence(seed.entropy, spawn_key=seed.spawn_key)
+    if isinstance(seed, _SeedSequence):
+        return _SeedSequence(seed.entropy, spawn_key=seed.spawn_key)
+    return SeedSequence(seed)
+
+def generator(seed=None):
+    '''
+    Return a random generator (numpy.random.Generator, or RandomState for numpy < 1.17) seeded from
+    seed. Both provide the normal() method used for TA and FSM errors.
+    '''
+    seed = seed_sequence(seed)
+    if hasattr(np.random, 'default_rng') and isinstance(seed, SeedSequence):
+        return np.random.default_rng(seed)
+    return np.random.RandomState(seed.generate_state(4))
+
+def noise_seed(seed):
+    '''
+    Return the integer that pandeia seeds its noise with (options.noise_seed) for a seed.
+    '''
+    return int(seed_sequence(seed).generate_state(1)[0])
@@ -10,7 +10,7 @@ from astropy.io import fits
 from .transformations import cart_to_polar, rotate
 from .engine import perform_calculation
 
-def create_SGD(ta_error=False, stepsize=20.e-3, pattern_name=None):
+def create_SGD(ta_error=False, stepsize=20.e-3, pattern_name=None, rng=None):
     '''
     Create small grid dither pointing set. There are two
     ways to specify dither patterns:
@@ -22,6 +22,9 @@ def create_SGD(ta_error=False, stepsize=20.e-3, pattern_name=None):
         pattern_name : string name of a pattern corresponding to
                   one of the named dither patterns in APT.
 
+        rng : random generator (e.g. from rng.generator) for the TA and
+              FSM errors. Defaults to numpy's global random state.
+
     If you specify pattern_name, then stepsize is ignored.
 
     See https://jwst-docs-stage.stsci.edu/display/JTI/NIRCam+Small-Grid+Dithers
@@ -73,13 +76,13 @@ def create_SGD(ta_error=False, stepsize=20.e-3, pattern_name=None):
     sgds = []
     
     if ta_error:
-        ta_x, ta_y = get_ta_error()
+        ta_x, ta_y = get_ta_error(rng=rng)
     else:
         ta_x, ta_y = 0., 0.
 
     for i, (sx, sy) in enumerate(pointings):
         if i > 0:
-            errx, erry = get_fsm_error()
+            errx, erry = get_fsm_error(rng=rng)
             offset_x = sx + errx + ta_x
             offset_y = sy + erry + ta_y
         else:
@@ -88,13 +91,17 @@ def create_SGD(ta_error=False, stepsize=20.e-3, pattern_name=None):
         sgds.append([offset_x, offset_y])
     return sgds
 
-def get_ta_error(error=5.0e-3):
+def get_ta_error(error=5.0e-3, rng=None):
     ''' 5mas 1-sigma/axis error (~7mas radial)
     '''
-    return np.random.normal(loc=0.,scale=error,size=2)
+    if rng is None:
+        rng = np.random
+    return rng.normal(loc=0.,scale=error,size=2)
 
-def get_fsm_error(error=2.0e-3):
-    return np.random.normal(loc=0.,scale=error,size=2)
+def get_fsm_error(error=2.0e-3, rng=None):
+    if rng is None:
+        rng = np.random
+    return rng.normal(loc=0.,scale=error,size=2)
 
 def rotate_scene(scene,theta,center=[0.,0.]):
     for source in scene:
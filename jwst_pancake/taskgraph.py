@@ -0,0 +1,229 @@
+from __future__ import absolute_import
+
+"""
+A small task graph for workflows made of many pandeia calculations (e.g. contrast curves), in which
+identical calculations are only run once and independent ones can run in parallel.
+"""
+
+from collections import OrderedDict
+from copy import deepcopy
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
+import multiprocessing as mp
+import sys
+import traceback
+
+if sys.version_info[0] >= 3:
+    import queue
+else:
+    import Queue as queue
+
+
+def calculation_key(config, current_options, realization=None):
+    '''
+    Return a canonical key for a pandeia calculation: a content hash of its configuration, the
+    engine options it runs with, and a realization label that keeps otherwise identical calculations
+    apart when each one should get its own noise realization.
+    '''
+    contents = json.dumps([config, current_options, realization], sort_keys=True, default=repr)
+    return hashlib.sha1(contents.encode('utf-8')).hexdigest()
+
+def _run_node(task):
+    '''
+    Run a single graph node, returning (key, result, error). Calculation nodes carry the options they
+    run with, applied privately for the duration of the calculation. Function nodes are called with
+    the results of the nodes they depend on.
+    '''
+    from .engine import perform_calculation, private_options
+    key, node, args = task
+    try:
+        if node['function'] is None:
+            with private_options(node['options']):
+                result = perform_calculation(node['config'])
+        else:
+            result = node['function'](*args)
+        return key, result, None
+    except Exception:
+        return key, None, traceback.format_exc()
+
+
+class CalculationGraph(object):
+    '''
+    A directed acyclic graph of pandeia calculations, and of functions of their results.
+
+    Calculation nodes are keyed by calculation_key(), so adding a calculation that is already in the
+    graph (same configuration, same options, same realization) returns the existing node rather than
+    adding a new one. Function nodes (e.g. registering and subtracting a reference from a target) are
+    keyed by name, and depend on other nodes. Nodes can only depend on nodes already in the graph, so
+    the graph can't contain cycles.
+
+        graph = CalculationGraph()
+        target = graph.add_calculation(target_config)
+        reference = graph.add_calculation(reference_config)
+        difference = graph.add_function('difference', subtract, target, reference)
+        results = graph.run(parallel='thread')
+        results[difference]
+    '''
+    def __init__(self):
+        self._nodes = OrderedDict()
+        self.requested = 0  # Number of calculations added, including duplicates
+
+    def __contains__(self, key):
+        return key in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    @property
+    def calculations(self):
+        '''
+        Number of distinct calculations in the graph
+        '''
+        return len([node for node in self._nodes.values() if node['function'] is None])
+
+    def add_calculation(self, config, realization=None):
+        '''
+        Add a calculation of config with the engine options currently in use (so a calculation with
+        different options can be added from within an engine.private_options block), and return its
+        key. Duplicate calculations are merged.
+        '''
+        from .engine import get_options
+        self.requested += 1
+        current_options = deepcopy(get_options().current_options)
+        key = calculation_key(config, current_options, realization)
+        if key not in self._nodes:
+            self._nodes[key] = {
+                                    'config': deepcopy(config),
+                                    'options': current_options,
+                                    'function': None,
+                                    'depends': []
+                               }
+        return key
+
+    def add_function(self, key, function, *depends):
+        '''
+        Add a node, called key, whose result is function(*results of depends), and return its key.
+        For parallel='process', function must be importable by the workers (i.e. a module-level
+        function).
+        '''
+        for depend in depends:
+            if depend not in self._nodes:
+                raise ValueError("Node {} depends on {}, which is not in the graph".format(key, depend))
+        if key in self._nodes:
+            raise ValueError("Node {} is already in the graph".format(key))
+        self._nodes[key] = {'config': None, 'options': None, 'function': function, 'depends': list(depends)}
+        return key
+
+    def run(self, parallel=None, nprocesses=None, results=None):
+        '''
+        Run every node, as soon as the nodes it depends on have finished, and return a dictionary of
+        results keyed by node.
+
+        Parameters
+        ----------
+        parallel: str, default None
+            None to run the nodes one after the other, 'thread' to run independent nodes in a pool of
+            threads, or 'process' to run them in an engine.EnginePool.
+        nprocesses: int, default None
+            Number of threads or processes. Defaults to one per CPU.
+        results: dict, default None
+            Results of nodes that have already run (e.g. returned by an earlier run, before more
+            nodes were added), which are not run again
+        '''
+        results = dict(results or {})
+        for key, result in self.iterate(parallel=parallel, nprocesses=nprocesses, results=results):
+            results[key] = result
+        return results
+
+    def iterate(self, parallel=None, nprocesses=None, results=None):
+        '''
+        Run every node, as run() does, but yield (key, result) for each node as soon as it finishes
+        instead of returning all of the results at the end. The graph only holds on to a result until
+        every node that depends on it has started, so a caller that uses each result as it arrives
+        and then drops it never has all of them in memory at once. Closing the generator (e.g. by
+        breaking out of a loop over it) stops the run.
+
+            for key, result in graph.iterate(parallel='process'):
+                ...
+
+        The parameters are those of run(). Nodes in results are not run, or yielded, again.
+        '''
+        available = dict(results or {})
+        waiting = OrderedDict((key, set(node['depends']) - set(available)) for key, node in self._nodes.items()
+                              if key not in available)
+        # Number of waiting nodes that need each result
+        users = {}
+        for key in waiting:
+            for depend in self._nodes[key]['depends']:
+                users[depend] = users.get(depend, 0) + 1
+        if len(waiting) == 0:
+            return
+        if parallel is None:
+            for key in waiting:
+                node = self._nodes[key]
+                task = (key, node, [available[d] for d in node['depends']])
+                self._release(node, available, users)
+                key, result, error = _run_node(task)
+                if error is not None:
+                    raise RuntimeError("Node {} failed:\n{}".format(key, error))
+                if users.get(key, 0) > 0:
+                    available[key] = result
+                yield key, result
+            return
+
+        if nprocesses is None:
+            nprocesses = mp.cpu_count()
+        if parallel == 'thread':
+            pool = ThreadPool(processes=nprocesses)
+        elif parallel == 'process':
+            from .pool import EnginePool
+            pool = EnginePool(nprocesses, warm=False)
+        else:
+            raise ValueError("Unknown parallel mode {}".format(parallel))
+        finished = False
+        try:
+            for item in self._iterate_pool(pool, waiting, available, users):
+                yield item
+            finished = True
+        finally:
+            if finished:
+                pool.close()
+                if parallel == 'thread':
+                    pool.join()
+            else:
+                pool.terminate()
+
+    def _iterate_pool(self, pool, waiting, available, users):
+        done = queue.Queue()
+        kwargs = {}
+        if sys.version_info[0] >= 3:
+            kwargs['error_callback'] = lambda e: done.put((None, None, repr(e)))
+        in_flight = 0
+        while len(waiting) > 0 or in_flight > 0:
+            for key in [key for key in waiting if len(waiting[key]) == 0]:
+                node = self._nodes[key]
+                task = (key, node, [available[d] for d in node['depends']])
+                self._release(node, available, users)
+                pool.apply_async(_run_node, (task,), callback=done.put, **kwargs)
+                del waiting[key]
+                in_flight += 1
+            key, result, error = done.get()
+            in_flight -= 1
+            if error is not None:
+                raise RuntimeError("Node {} failed:\n{}".format(key, error))
+            if users.get(key, 0) > 0:
+                available[key] = result
+            for depends in waiting.values():
+                depends.discard(key)
+            yield key, result
+
+    @staticmethod
+    def _release(node, available, users):
+        '''
+        A node has started: drop the results it depends on that no other waiting node needs.
+        '''
+        for depend in node['depends']:
+            users[depend] -= 1
+            if users[depend] == 0:
+                available.pop(depend, None)
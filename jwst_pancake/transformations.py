@@ -1,7 +1,6 @@
 
 import numpy as np
 from scipy import optimize
-from scipy.ndimage import fourier_shift
 
 def cart_to_polar(xy):
     '''convert separations into offset, theta'''
@@ -54,12 +53,205 @@ def align_fourierLSQ(reference,target,mask=None):
             are the misalignment of target from reference and beta
             is the fraction by which the target intensity must be
             reduced to match the intensity of the reference.
+
+    See FourierAligner, which does the work, to align several
+    targets to the same reference.
     '''
+    return FourierAligner(reference,mask).fit(target)
+
+class FourierAligner(object):
+    '''Fourier shift alignment to a fixed reference image.
+
+    The FFT of the reference is computed once, and each fit
+    supplies leastsq with the analytic derivatives of the
+    residual with respect to (x, y, beta), starting from a
+    phase-correlation estimate of the shift. Shifts are the real
+    part of scipy.ndimage.fourier_shift's, computed with real FFTs.
+
+    fit_stack fits a whole stack of images at once, with stacked
+    FFTs and a Levenberg-Marquardt solver that steps every image
+    in lockstep.
+
+    Parameters:
+        reference : nd array
+            N x K image to be aligned to (or a stack of them, to be
+            shifted with shift_stack)
+        mask : nd array, optional
+            See align_fourierLSQ. For fit_stack, this may also be a
+            stack of one mask per image.
+    '''
+    def __init__(self,reference,mask=None):
+        self.shape = reference.shape[-2:]
+        self.mask = mask
+        self._spectrum = np.fft.rfft2(reference)
+        # Frequencies of the half spectrum, and of the matching negative frequencies, as
+        # scipy.ndimage.fourier_shift uses them
+        ny, nx = self.shape
+        fy = np.fft.fftfreq(ny)
+        fx = np.fft.fftfreq(nx)[:nx // 2 + 1]
+        self._fy = (fy.reshape(-1, 1), fy[-np.arange(ny) % ny].reshape(-1, 1))
+        self._fx = (fx, np.fft.fftfreq(nx)[-np.arange(nx // 2 + 1) % nx])
+        self._last_shift = None
+
+    def _phases(self,xshift,yshift):
+        '''Phase terms of a shift, made Hermitian (as taking the
+        real part of the complex shifted image does) so that they
+        apply to the half spectrum.
+        '''
+        # Shifts may be arrays, for a stack of shifts
+        xshift = np.reshape(xshift, np.shape(xshift) + (1, 1))
+        yshift = np.reshape(yshift, np.shape(yshift) + (1, 1))
+        # Both are separable, so only 1D exponentials are needed
+        positive = np.exp(2j * np.pi * yshift * self._fy[0]) * np.exp(-2j * np.pi * xshift * self._fx[0])
+        negative = np.exp(-2j * np.pi * yshift * self._fy[1]) * np.exp(2j * np.pi * xshift * self._fx[1])
+        return positive, negative
+
+    def shift(self,xshift,yshift):
+        '''Return the reference shifted as fourier_imshift does.'''
+        # leastsq asks for the Jacobian at the parameters of the last residual, so keep the last shift
+        if self._last_shift is None or self._last_shift[0] != (xshift, yshift):
+            self._last_shift = ((xshift, yshift), self._shifted(xshift, yshift))
+        return self._last_shift[1]
+
+    def shift_stack(self,xshifts,yshifts):
+        '''Return the reference shifted by each of a list of shifts,
+        or, for a stack of references, each one by its own shift.'''
+        return self._shifted(np.asarray(xshifts, dtype=float), np.asarray(yshifts, dtype=float))
+
+    def _shifted(self,xshift,yshift):
+        positive, negative = self._phases(xshift,yshift)
+        return np.fft.irfft2(self._spectrum * (positive + negative) / 2., s=self.shape)
+
+    def _gradient(self,xshift,yshift):
+        '''Derivatives of the shifted reference with respect to
+        xshift and yshift.'''
+        positive, negative = self._phases(xshift,yshift)
+        dx = np.pi * 1j * (-self._fx[0] * positive + self._fx[1] * negative)
+        dy = np.pi * 1j * (self._fy[0] * positive - self._fy[1] * negative)
+        return np.fft.irfft2(self._spectrum * np.array([dx, dy]), s=self.shape)
+
+    def initial_guess(self,target):
+        '''Estimate [x, y, beta] with phase correlation for the
+        shift, to the nearest pixel, and linear least squares for
+        beta.'''
+        return list(self._initial_guesses(target[np.newaxis], self.mask)[0])
+
+    def _initial_guesses(self,targets,mask):
+        '''initial_guess for each of a stack of targets, as an
+        array of [x, y, beta] rows.'''
+        cross_power = np.fft.rfft2(targets) * np.conj(self._spectrum)
+        correlation = np.fft.irfft2(cross_power / np.maximum(np.abs(cross_power), 1e-300), s=self.shape)
+        correlation = correlation.reshape(len(targets), -1)
+        peak_y, peak_x = np.unravel_index(np.argmax(correlation, axis=1), self.shape)
+        dy = np.where(peak_y > self.shape[0] // 2, peak_y - self.shape[0], peak_y)
+        dx = np.where(peak_x > self.shape[1] // 2, peak_x - self.shape[1], peak_x)
+        finite = np.all(np.isfinite(correlation), axis=1)
+        xshift = np.where(finite, dx, 0.).astype(float)
+        yshift = np.where(finite, -dy, 0.).astype(float)
+        weight = 1. if mask is None else mask
+        offset = self._shifted(xshift, yshift) * weight
+        norm = np.sum(offset**2, axis=(-2, -1))
+        beta = np.sum(targets * weight * offset, axis=(-2, -1)) / np.where(norm > 0, norm, 1.)
+        beta = np.where(finite & (norm > 0), beta, 1.)
+        return np.array([xshift, yshift, beta]).T
+
+    def residual(self,params,target):
+        '''As shift_subtract.'''
+        xshift, yshift, beta = params
+        residual = target - beta * self.shift(xshift, yshift)
+        if self.mask is not None:
+            residual = residual * self.mask
+        return residual.flatten()
+
+    def jacobian(self,params,target):
+        '''Derivatives of the residual with respect to x, y and
+        beta, one column each.'''
+        xshift, yshift, beta = params
+        dx, dy = -beta * self._gradient(xshift, yshift)
+        dbeta = -self.shift(xshift, yshift)
+        jacobian = np.array([dx, dy, dbeta])
+        if self.mask is not None:
+            jacobian = jacobian * self.mask
+        return jacobian.reshape(3, -1).T
+
+    def fit(self,target,init_pars=None):
+        '''Return the [x, y, beta] of target, as align_fourierLSQ.'''
+        if init_pars is None:
+            init_pars = self.initial_guess(target)
+        out,_ = optimize.leastsq(self.residual, init_pars, args=(target,), Dfun=self.jacobian)
+        results = [out[0],out[1],out[2]] #x,y,beta
+        return results
+
+    def fit_stack(self,targets,maxiter=100,tol=1.49012e-8):
+        '''Return the [x, y, beta] of each of a Z x N x K stack of
+        targets, as a Z x 3 array, fitting them all together.
+
+        Each iteration shifts the reference for every image that
+        hasn't converged yet in one stacked FFT, and solves their
+        3 x 3 damped normal equations together. An image has
+        converged once a step changes its cost or its parameters by
+        less than a fraction tol (leastsq's default tolerance).
+
+        Images that already fit exactly (e.g. all zeros, or fully
+        masked) keep their initial guess, and degenerate equations
+        (e.g. for beta = 0, where x and y have no effect) are solved
+        with a pseudo-inverse, so no image can stop the others.
+        '''
+        targets = np.asarray(targets, dtype=float)
+        nstack = len(targets)
+        masks = None
+        if self.mask is not None:
+            masks = np.broadcast_to(self.mask, targets.shape)
+        params = self._initial_guesses(targets, masks)
+        damping = np.full(nstack, 1e-3)
+
+        def residuals(params, shifted, index):
+            residual = (targets[index] - params[:, 2, np.newaxis, np.newaxis] * shifted)
+            if masks is not None:
+                residual = residual * masks[index]
+            return residual, np.sum(residual**2, axis=(-2, -1))
+
+        # Shifted reference, residual and cost of each image at its current parameters
+        active = np.arange(nstack)
+        shifted = self._shifted(params[:, 0], params[:, 1])
+        residual, costs = residuals(params, shifted, active)
+        fitting = costs > 0
+        active, shifted, residual = active[fitting], shifted[fitting], residual[fitting]
+        for iteration in range(maxiter):
+            if len(active) == 0:
+                break
+            p = params[active]
+            dx, dy = -p[:, 2, np.newaxis, np.newaxis] * self._gradient(p[:, 0], p[:, 1])
+            jacobian = np.array([dx, dy, -shifted])
+            if masks is not None:
+                jacobian = jacobian * masks[active]
+            jacobian = jacobian.reshape(3, len(active), -1).transpose(1, 0, 2)
+            jtj = np.einsum('nij,nkj->nik', jacobian, jacobian)
+            jtr = np.einsum('nij,nj->ni', jacobian, residual.reshape(len(active), -1))
+            diagonal = np.einsum('nii->ni', jtj)
+            damped = jtj + (damping[active, np.newaxis] * diagonal)[:, :, np.newaxis] * np.eye(3)
+            step = np.einsum('nij,nj->ni', np.linalg.pinv(damped), -jtr)
+
+            trial = p + step
+            trial_shifted = self._shifted(trial[:, 0], trial[:, 1])
+            trial_residual, trial_cost = residuals(trial, trial_shifted, active)
+            current = costs[active]
+            better = trial_cost < current
+            params[active[better]] = trial[better]
+            costs[active[better]] = trial_cost[better]
+            damping[active[better]] /= 10.
+            damping[active[~better]] *= 10.
+            shifted[better] = trial_shifted[better]
+            residual[better] = trial_residual[better]
 
-    init_pars = [0.,0.,1.]
-    out,_ = optimize.leastsq(shift_subtract, init_pars, args=(reference,target,mask))
-    results = [out[0],out[1],out[2]] #x,y,beta
-    return results
+            small_cost = np.abs(current - trial_cost) <= tol * current
+            small_step = np.sqrt(np.sum(step**2, axis=1)) <= tol * (np.sqrt(np.sum(p**2, axis=1)) + tol)
+            stuck = damping[active] > 1e16
+            done = (better & (small_cost | small_step)) | stuck | (current == 0)
+            active = active[~done]
+            shifted = shifted[~done]
+            residual = residual[~done]
+        return params
 
 def shift_subtract(params,reference,target,mask=None):
     '''Use Fourier Shift theorem for subpixel shifts.
@@ -103,6 +295,4 @@ def fourier_imshift(image,xshift,yshift):
             Shifted image
 
     '''
-    offset = fourier_shift( np.fft.fftn(image), (-yshift,xshift) )
-    offset = np.fft.ifftn(offset).real
-    return offset
\ No newline at end of file
+    return FourierAligner(image).shift(xshift,yshift)
\ No newline at end of file
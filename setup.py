@@ -18,11 +18,11 @@ python_major = version_info[0]
 if python_major >= 3:
     required=['numpy>=1.15','matplotlib>=2.2','pandeia.engine>=1.2', 'webbpsf>0.7', 
               'scikit-image>=0.14', 'pysynphot>=0.9', 'astropy>=2', 'photutils>=0.5', 
-              'cython>=0.29', 'scipy>=1', 'poppy>0.7'],
+              'cython>=0.29', 'scipy>=1.6', 'poppy>0.7'],
 else:
     required=['numpy>=1.15','matplotlib>=2.2','pandeia.engine>=1.2', 'webbpsf<0.7', 
               'scikit-image>=0.14', 'pysynphot>=0.9', 'astropy<3', 'photutils>=0.4', 
-              'functools32>=3', 'cython>=0.29', 'scipy>=1', 'poppy<0.7'],
+              'functools32>=3', 'cython>=0.29', 'scipy>=1.6', 'poppy<0.7'],
 
 # Get the long description from the README file
 with open(path.join(here, 'README.rst'), encoding='utf-8') as f:
@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pandeia.engine')
+
+from jwst_pancake import analysis
+from jwst_pancake.transformations import fourier_imshift
+
+
+@pytest.fixture
+def target():
+    rng = np.random.RandomState(3)
+    return np.pad(np.outer(np.hanning(16), np.hanning(16)), 8, mode='constant') + 0.01 * rng.normal(size=(32, 32))
+
+
+def test_register_stack_matches_register_to_target(target):
+    rng = np.random.RandomState(4)
+    references = np.array([beta * fourier_imshift(target, xshift, yshift) + 0.001 * rng.normal(size=target.shape)
+                           for xshift, yshift, beta in [(0.3, 0.2, 1.1), (-1.4, 0.7, 0.9)]])
+    registered, fits = analysis.register_stack(references, target)
+    for reference, image in zip(references, registered):
+        assert np.allclose(image, analysis.register_to_target(reference, target), atol=1e-8)
+    assert fits.shape == (2, 3)
+
+
+@pytest.fixture
+def references():
+    return np.random.RandomState(5).normal(size=(6, 10, 12))
+
+
+def test_klip_matches_eigenvector_basis(references, target):
+    target = target[:10, :12]
+    Z, _ = analysis.get_klip_basis(references.reshape(6, -1), 3)
+    expected = Z.T.dot(Z.dot(target.ravel())).reshape(target.shape)
+    klip = analysis.KLIP(references)
+    assert klip.nmodes == 6
+    assert np.allclose(klip.project(target, 3), expected)
+    assert np.allclose(analysis.klip_projection(target, references, 3), expected)
+    assert np.allclose(klip.subtract(target, 3), target - expected)
+
+
+def test_klip_truncations_and_stacks(references):
+    targets = np.random.RandomState(6).normal(size=(2, 10, 12))
+    klip = analysis.KLIP(references)
+    projections = klip.project(targets, [4, 1, 10])
+    assert projections.shape == (3, 2, 10, 12)
+    for i, truncation in enumerate([4, 1, 10]):
+        for j in range(2):
+            assert np.allclose(projections[i, j], klip.project(targets[j], truncation))
+    # Truncations beyond the number of modes use all of them, which span the references
+    assert np.allclose(klip.project(references, 10), references)
+
+
+def test_klip_zones(references):
+    zones = analysis.klip_zones((10, 12), annuli=2, sectors=3)
+    assert len(zones) == 6
+    assert np.array_equal(np.sum(zones, axis=0), np.ones((10, 12)))
+    klip = analysis.KLIP(references, zones=zones)
+    target = np.random.RandomState(7).normal(size=(10, 12))
+    projection = klip.project(target, 2)
+    for zone in zones:
+        assert np.allclose(projection[zone], analysis.KLIP(references[:, zone][:, np.newaxis]).project(
+            target[zone][np.newaxis], 2)[0])
+
+
+def test_klip_rank_deficient_library(references):
+    library = np.concatenate([references, references[:2] + references[2:4]])
+    klip = analysis.KLIP(library)
+    assert klip.nmodes == 6
+    assert np.all(np.isfinite(klip.project(references[0], 8)))
+
+
+@pytest.fixture
+def stack():
+    return np.random.RandomState(8).normal(size=(5, 9, 11))
+
+
+@pytest.fixture
+def aperture():
+    y, x = np.indices((9, 11))
+    return (np.hypot(y - 4, x - 5) <= 1.5).astype(float)
+
+
+@pytest.mark.parametrize('mean_subtract', [False, True])
+def test_aperture_noise_map_matches_covariance(stack, aperture, mean_subtract):
+    expected = analysis.noise_map(analysis.covariance_matrix(stack.copy(), mean_subtract),
+                                  analysis.aperture_matrix(aperture), (9, 11))
+    assert np.allclose(analysis.aperture_noise_map(stack, aperture, mean_subtract), expected)
+
+
+def test_aperture_noise_map_asymmetric_aperture():
+    stack = np.random.RandomState(9).normal(size=(4, 8, 10))
+    aperture = np.zeros((8, 10))
+    aperture[3:5, 4:7] = 1.
+    aperture[2, 6] = 0.5
+    expected = analysis.noise_map(analysis.covariance_matrix(stack), analysis.aperture_matrix(aperture), (8, 10))
+    assert np.allclose(analysis.aperture_noise_map(stack, aperture), expected)
+
+
+@pytest.mark.parametrize('shape', [(9, 14), (14, 9), (10, 16), (20, 11)])
+def test_aperture_noise_map_non_square(shape):
+    stack = np.random.RandomState(11).normal(size=(4,) + shape)
+    y, x = np.indices(shape)
+    aperture = (np.hypot(y - shape[0] // 2, x - shape[1] // 2) <= 2).astype(float)
+    expected = analysis.noise_map(analysis.covariance_matrix(stack), analysis.aperture_matrix(aperture), shape)
+    assert np.allclose(analysis.aperture_noise_map(stack, aperture), expected)
+    accumulator = analysis.ContrastAccumulator(aperture)
+    for image in stack:
+        accumulator.add(image)
+    assert np.allclose(accumulator.noise_map(), expected)
+
+
+@pytest.mark.parametrize('mean_subtract', [False, True])
+def test_contrast_accumulator_matches_stack(stack, aperture, mean_subtract):
+    accumulator = analysis.ContrastAccumulator(aperture, normalization=2., mean_subtract=mean_subtract)
+    for count, image in enumerate(stack, 1):
+        accumulator.add(image)
+        if count > 1:
+            assert np.allclose(accumulator.noise_map(),
+                               analysis.aperture_noise_map(stack[:count], aperture, mean_subtract))
+    assert accumulator.count == 5
+    bins, profile = accumulator.profile()
+    expected_bins, expected = analysis.radial_profile(analysis.aperture_noise_map(stack, aperture, mean_subtract))
+    assert np.array_equal(bins, expected_bins)
+    assert np.allclose(profile, expected / 2.)
+
+
+def test_contrast_accumulator_convergence(aperture):
+    accumulator = analysis.ContrastAccumulator(aperture)
+    image = np.random.RandomState(10).normal(size=aperture.shape)
+    accumulator.add(image)
+    accumulator.add(-image)
+    assert accumulator.change is None and not accumulator.converged(1.)
+    # Repeating the same images leaves the profile almost unchanged
+    for i in range(10):
+        accumulator.add(image if i % 2 else -image)
+    assert accumulator.converged(0.1)
+    assert not accumulator.converged(0.)
@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pandeia.engine')
+
+from jwst_pancake.archive import ResultArchive
+from jwst_pancake.rng import seed_sequence
+
+
+@pytest.fixture
+def current_options():
+    return {'noise': {'crs': True, 'readnoise': True}, 'verbose': False, 'products': ['2d.detector'],
+            'on_the_fly_webbpsf_opd': None}
+
+
+@pytest.fixture
+def report():
+    return {'2d': {'detector': np.arange(12.).reshape(3, 4)}, 'scalar': {'sn': 2.5}, 'warnings': {}}
+
+
+def test_put_and_get(tmp_path, report):
+    archive = ResultArchive(str(tmp_path))
+    archive.put(3, report)
+    assert 3 in archive
+    assert archive.indices == [3]
+    stored = archive.get(3)
+    assert np.array_equal(stored['2d']['detector'], report['2d']['detector'])
+    assert stored['scalar']['sn'] == 2.5
+    assert np.array_equal(archive.get_product('2d.detector')[0], report['2d']['detector'])
+
+
+def test_index_survives_reopening(tmp_path, report, current_options):
+    archive = ResultArchive(str(tmp_path))
+    archive.put(0, report, {'calc': 0}, current_options, 7)
+    archive.put(1, report, {'calc': 1}, current_options, 7)
+    reopened = ResultArchive(str(tmp_path))
+    assert reopened.indices == [0, 1]
+    assert reopened.matches(1, {'calc': 1}, current_options, 7)
+
+
+def test_partial_index_record_is_dropped(tmp_path, report):
+    archive = ResultArchive(str(tmp_path))
+    archive.put(0, report)
+    with open(archive._index_file, 'ab') as outf:
+        outf.write(b'{"index": 1, "na')
+    assert ResultArchive(str(tmp_path)).indices == [0]
+
+
+def test_matches_checks_calculation_options_products_and_seed(tmp_path, report, current_options):
+    archive = ResultArchive(str(tmp_path))
+    seed = seed_sequence(5)
+    archive.put(0, report, {'calc': 0}, current_options, seed)
+    assert archive.matches(0, {'calc': 0}, current_options, seed_sequence(5))
+    # Options that don't change the results don't matter
+    assert archive.matches(0, {'calc': 0}, dict(current_options, verbose=True), seed)
+
+    assert not archive.matches(1, {'calc': 0}, current_options, seed)
+    assert not archive.matches(0, {'calc': 1}, current_options, seed)
+    assert not archive.matches(0, {'calc': 0}, dict(current_options, noise={'crs': False}), seed)
+    assert not archive.matches(0, {'calc': 0}, dict(current_options, products=None), seed)
+    assert not archive.matches(0, {'calc': 0}, current_options, seed_sequence(6))
+    assert not archive.matches(0, {'calc': 0}, current_options, None)
@@ -0,0 +1,190 @@
+from __future__ import absolute_import
+
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pandeia.engine')
+pytest.importorskip('webbpsf')
+if 'pandeia_refdata' not in os.environ:
+    pytest.skip("pandeia_refdata is not set", allow_module_level=True)
+
+from jwst_pancake import engine
+from jwst_pancake.psf_cache import get_store, psf_key
+from jwst_pancake.rng import noise_seed, seed_sequence
+from jwst_pancake.taskgraph import CalculationGraph
+
+
+@pytest.fixture
+def nircam_config():
+    return engine.load_calculation(engine.get_template('nircam_coronagraphy_template.json'))
+
+
+def test_source_cache_skipped_during_dry_run(nircam_config, tmp_path):
+    with engine.private_options() as options:
+        options.on_the_fly_PSFs = True
+        options.broadband_psf = True
+        options.source_cache = True
+        options.cache = 'disk'
+        options.cache_path = str(tmp_path)
+        options.noise_seed = 1
+        options.clear_source_cache()
+
+        engine.prepare_psfs([nircam_config], nprocesses=1)
+        assert options.source_cache_stats['entries'] == 0
+
+        cached = engine.calculate_target(nircam_config)['2d']['detector']
+        options.source_cache = False
+        uncached = engine.calculate_target(nircam_config)['2d']['detector']
+
+    assert cached.shape == uncached.shape
+    assert np.allclose(cached, uncached, rtol=1e-6)
+
+
+def test_select_products():
+    report = {'2d': {'detector': np.ones((2, 2)), 'snr': np.zeros((2, 2))}, 'scalar': {'sn': 3.}}
+    selected = engine.select_products(report, ['2d.detector', 'scalar.sn'])
+    assert sorted(selected) == ['2d', 'scalar']
+    assert list(selected['2d']) == ['detector']
+    assert selected['2d']['detector'] is report['2d']['detector']
+    assert selected['scalar'] == {'sn': 3.}
+    assert engine.select_products(report, None) is report
+    with pytest.raises(KeyError):
+        engine.select_products(report, ['2d.saturation'])
+
+
+def test_calculate_all_selects_products_of_each_report(nircam_config):
+    with engine.private_options() as options:
+        options.products = ['2d.detector']
+        output = engine.calculate_all(nircam_config)
+    for name in ['target', 'reference', 'contrast']:
+        assert list(output[name]) == ['2d']
+        assert list(output[name]['2d']) == ['detector']
+
+
+def test_calculations_keep_their_seeds_without_detector_noise():
+    config = {'scene': [{'id': 1}]}
+    seeds = seed_sequence(3).spawn(2)
+    with engine.private_options() as options:
+        # Photon noise is still random with every detector noise source off
+        options.noise = dict((key, False) for key in options.noise)
+        graph = CalculationGraph()
+        first = engine._add_calculation(graph, config, seeds[0])
+        second = engine._add_calculation(graph, config, seeds[1])
+        assert first != second
+        assert graph._nodes[first]['options']['noise_seed'] == noise_seed(seeds[0])
+
+        options.pandeia_fixed_seed = True
+        assert engine._add_calculation(graph, config, seeds[0]) == engine._add_calculation(graph, config, seeds[1])
+
+
+def test_broadband_route_matches_wavelength_cube(nircam_config):
+    with engine.private_options() as options:
+        options.on_the_fly_PSFs = True
+        options.wave_sampling = 5
+        options.pandeia_fixed_seed = True
+        options.products = ['2d.detector']
+        options.broadband_psf = False
+        per_wavelength = engine.calculate_target(nircam_config)['2d']['detector']
+        options.broadband_psf = True
+        broadband = engine.calculate_target(nircam_config)['2d']['detector']
+    assert broadband.shape == per_wavelength.shape
+    assert np.allclose(broadband, per_wavelength, rtol=1e-6, atol=1e-10 * np.nanmax(per_wavelength))
+
+
+@pytest.mark.parametrize('parallel', ['thread', 'process'])
+def test_calculate_subtracted_parallel_matches_serial(nircam_config, parallel):
+    with engine.private_options() as options:
+        options.on_the_fly_PSFs = True
+        options.wave_sampling = 3
+        serial = engine.calculate_subtracted(nircam_config, ta_error=True, sgd=True, seed=11)
+        run = engine.calculate_subtracted(nircam_config, ta_error=True, sgd=True, seed=11, parallel=parallel,
+                                          nprocesses=2)
+    assert run['seed'] == serial['seed']
+    for name in ['target', 'psf', 'subtracted']:
+        assert np.array_equal(run[name], serial[name], equal_nan=True)
+    assert len(run['references']) == 9
+    for reference, serial_reference in zip(run['references'], serial['references']):
+        assert np.array_equal(reference, serial_reference, equal_nan=True)
+
+
+@pytest.fixture
+def psf_store(tmp_path, monkeypatch):
+    from jwst_pancake.pandeia_subclasses import CoronagraphyPSFLibrary
+
+    def dry_run(config):
+        # What the PSF library does during a dry run: record each PSF the calculation asks for
+        options = engine.get_options()
+        for wave in config['waves']:
+            args = (wave, 'nircam', 'mask210r', 2, (0., 0.))
+            options.psf_requests[psf_key({'wave': wave})] = (options.current_config, args)
+
+    def calculate_psf(wave, instrument, aperture_name, oversample, source_offset):
+        return {'int': np.full((4, 4), wave), 'pix_scl': 0.01, 'diff_limit': 0.1, 'upsamp': oversample,
+                'pupil_throughput': 0.5}
+    monkeypatch.setattr(engine, 'perform_calculation', dry_run)
+    monkeypatch.setattr(engine, 'process_config', lambda config, target, reference: config)
+    monkeypatch.setattr(CoronagraphyPSFLibrary, '_calculate_psf', staticmethod(calculate_psf))
+    with engine.private_options() as options:
+        options.on_the_fly_PSFs = True
+        options.cache = 'disk'
+        options.cache_path = str(tmp_path)
+        yield get_store(str(tmp_path))
+
+
+def test_prepare_psfs_fills_the_store(psf_store):
+    psf_store.put(psf_key({'wave': 2.}), np.zeros((4, 4)), {})
+    calcfiles = [{'waves': [2., 2.1]}, {'waves': [2.1, 2.2, 2.3]}]
+    counts = engine.prepare_psfs(calcfiles, nprocesses=2)
+    assert counts == {'psfs': 4, 'present': 1, 'computed': 3}
+    for wave in [2.1, 2.2, 2.3]:
+        image, meta = psf_store.get(psf_key({'wave': wave}))
+        assert np.all(image == np.float32(wave)) and meta['upsamp'] == 2
+    # The PSF that was already there is left alone
+    assert np.all(psf_store.get(psf_key({'wave': 2.}))[0] == 0)
+    assert engine.prepare_psfs(calcfiles, nprocesses=2) == {'psfs': 4, 'present': 4, 'computed': 0}
+
+
+def test_prepare_psfs_needs_on_the_fly_psfs(psf_store):
+    engine.get_options().on_the_fly_PSFs = False
+    with pytest.warns(UserWarning):
+        assert engine.prepare_psfs([{'waves': [2.]}]) == {'psfs': 0, 'present': 0, 'computed': 0}
+    assert len(psf_store) == 0
+
+
+def test_threads_calculate_with_their_own_options(monkeypatch):
+    import threading
+    import pandeia.engine.instrument
+    barrier = threading.Barrier(2, timeout=10)
+
+    def calculation(config):
+        # Both calculations are in progress at once
+        barrier.wait()
+        options = engine.get_options()
+        seed = pandeia.engine.observation.Observation.get_random_seed(None)
+        barrier.wait()
+        return {'id': options.current_config['scene'][0]['id'], 'wave_sampling': options.wave_sampling,
+                'noise': options.current_config['calculation']['noise'], 'seed': seed,
+                'psf_library': pandeia.engine.instrument.PSFLibrary}
+    monkeypatch.setattr(engine, 'pandeia_calculation', calculation)
+
+    results = {}
+
+    def run(n):
+        with engine.private_options() as options:
+            options.wave_sampling = 10 * n
+            options.noise_seed = n
+            options.noise = dict((key, bool(n % 2)) for key in options.noise)
+            results[n] = engine.perform_calculation({'scene': [{'id': n}], 'calculation': {}})
+    threads = [threading.Thread(target=run, args=(n,)) for n in [1, 2]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for n in [1, 2]:
+        assert results[n]['id'] == n and results[n]['wave_sampling'] == 10 * n and results[n]['seed'] == n
+        assert all(value == bool(n % 2) for value in results[n]['noise'].values())
+        # Pandeia's own globals aren't swapped during calculations
+        assert results[n]['psf_library'] is engine._psf_library
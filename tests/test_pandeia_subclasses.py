@@ -0,0 +1,204 @@
+from __future__ import absolute_import
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pandeia.engine')
+pytest.importorskip('webbpsf')
+
+from jwst_pancake.pandeia_subclasses import CoronagraphyConvolvedSceneCube
+
+canonical_wavelengths = CoronagraphyConvolvedSceneCube.canonical_wavelengths
+
+
+@pytest.mark.parametrize('max_samples', [2, 3, 10, 50, 150, 300])
+def test_canonical_wavelengths_sample_count_and_ends(max_samples):
+    wave = canonical_wavelengths(1.7, 2.3, 2000, max_samples)
+    # The grid is thinned by a whole number of points, so it can't always reach max_samples exactly
+    assert max_samples // 2 < wave.size <= max_samples
+    if max_samples <= 20:
+        assert wave.size == max_samples
+    assert np.all(np.diff(wave) > 0)
+    # The ends are the grid points just inside the range
+    assert np.isclose(wave[0], np.exp(np.ceil(np.log(1.7) * 2000) / 2000.))
+    assert np.isclose(wave[-1], np.exp(np.floor(np.log(2.3) * 2000) / 2000.))
+    assert wave[0] >= 1.7 and wave[-1] <= 2.3
+
+
+def test_canonical_wavelengths_are_shared():
+    # Interior points are every step'th point of the global grid, whatever the range
+    for wmin, wmax in [(1.7, 2.3), (1.65, 2.35)]:
+        k = np.log(canonical_wavelengths(wmin, wmax, 2000, 20)) * 2000
+        assert np.allclose(k, np.round(k))
+        interior = np.round(k[1:-1]).astype(int)
+        step = interior[1] - interior[0]
+        assert np.all(np.diff(interior) == step)
+        assert np.all(interior % step == 0)
+
+
+def test_canonical_wavelengths_small_ranges():
+    # Fewer grid points than samples: all of them
+    assert canonical_wavelengths(1., 1.0015, 2000, 10).size == 3
+    # Fewer than two grid points: the ends of the range
+    assert np.array_equal(canonical_wavelengths(1.0001, 1.0002, 2000, 10), [1.0001, 1.0002])
+
+
+@pytest.mark.parametrize('max_samples', [1, 0, -3])
+def test_canonical_wavelengths_single_sample(max_samples):
+    wave = canonical_wavelengths(1.7, 2.3, 2000, max_samples)
+    assert wave.size == 1
+    assert np.isclose(wave[0], np.sqrt(1.7 * 2.3), rtol=1e-3)
+    assert canonical_wavelengths(1.0001, 1.0002, 2000, max_samples).size == 1
+
+
+class FakeInstrument(object):
+    def __init__(self):
+        self.options = {}
+        self.state = []
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    from jwst_pancake import engine, psf_cache
+    from jwst_pancake.pandeia_subclasses import CoronagraphyPSFLibrary
+
+    calls = []
+
+    def calculate_psf(wave, instrument, aperture_name, oversample, source_offset):
+        calls.append((wave, tuple(source_offset)))
+        return {'int': np.full((3, 3), wave), 'wave': wave, 'pix_scl': 0.01, 'diff_limit': 0.1, 'upsamp': oversample,
+                'instrument': instrument, 'aperture_name': aperture_name, 'source_offset': source_offset,
+                'pupil_throughput': 0.5}
+    monkeypatch.setattr(CoronagraphyPSFLibrary, '_calculate_psf', staticmethod(calculate_psf))
+    monkeypatch.setattr(psf_cache, 'ram_cache', psf_cache.PSFCache())
+    monkeypatch.setattr('jwst_pancake.pandeia_subclasses.ram_cache', psf_cache.ram_cache)
+    with engine.private_options() as options:
+        options.current_config = {'configuration': {'instrument': {'filter': 'f210m'}}}
+        options.cache = 'ram'
+        library = CoronagraphyPSFLibrary.__new__(CoronagraphyPSFLibrary)
+        library._options = options
+        library._cache_path = str(tmp_path)
+        library.calls = calls
+        yield library
+
+
+def test_prefetch_psfs_fills_the_cache_once(library):
+    from jwst_pancake import pandeia_subclasses
+    library._options.psf_prefetch = 'thread'
+    library._options.psf_prefetch_workers = 2
+    waves = [2.0, 2.1, 2.2]
+    offsets = [(0., 0.), (0.5, 90.)]
+    library.prefetch_psfs(waves, 'nircam', 'mask210r', offsets)
+    assert sorted(library.calls) == sorted((wave, offset) for wave in waves for offset in offsets)
+    assert len(pandeia_subclasses.ram_cache) == 6
+    pool = pandeia_subclasses._prefetch_pool('thread', 2)
+
+    # Everything is cached now, and a new offset reuses the same pool
+    library.prefetch_psfs(waves, 'nircam', 'mask210r', offsets + [(1., 0.)])
+    assert len(library.calls) == 9
+    assert pandeia_subclasses._prefetch_pool('thread', 2) is pool
+    # The PSFs get_psf asks for later are the prefetched ones
+    psf = library.get_psf(2.1, 'nircam', 'mask210r', source_offset=(0.5, 90.))
+    assert len(library.calls) == 9 and np.all(psf['int'] == 2.1)
+
+
+def test_prefetch_psfs_does_nothing_without_a_cache(library):
+    library._options.psf_prefetch = 'thread'
+    library._options.cache = 'none'
+    library.prefetch_psfs([2.0], 'nircam', 'mask210r', [(0., 0.)])
+    assert library.calls == []
+
+
+def test_each_thread_has_its_own_instrument(monkeypatch):
+    import threading
+    from jwst_pancake import engine
+    from jwst_pancake.pandeia_subclasses import CoronagraphyPSFLibrary
+
+    built = []
+
+    def build_instrument(instrument, aperture_name):
+        built.append(FakeInstrument())
+        return built[-1]
+    optics = {'ins': FakeInstrument(), 'key': 'key', 'pupil_sf': 1., 'pupil_throughput': 0.5}
+    monkeypatch.setattr(CoronagraphyPSFLibrary, '_build_instrument', staticmethod(build_instrument))
+    monkeypatch.setattr(CoronagraphyPSFLibrary, '_instrument_optics', staticmethod(lambda *args: optics))
+    monkeypatch.setattr(CoronagraphyPSFLibrary, '_thread_instruments', threading.local())
+
+    states = {}
+
+    def get_instruments(name):
+        with engine.private_options() as options:
+            options.current_config = {'scene': [], 'strategy': {'psf_subtraction_source': {}}}
+            first = CoronagraphyPSFLibrary._get_instrument('nircam', 'mask210r', (0.1, 10.))
+            second = CoronagraphyPSFLibrary._get_instrument('nircam', 'mask210r', (0.2, 20.))
+        states[name] = (first, second)
+    threads = [threading.Thread(target=get_instruments, args=(name,)) for name in 'ab']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(built) == 2
+    for first, second in states.values():
+        # Calls in one thread share its instrument, with their own options
+        assert first.state is second.state
+        assert first.options['source_offset_r'] == 0.1 and second.options['source_offset_r'] == 0.2
+    assert states['a'][0].state is not states['b'][0].state
+    assert all(state is not optics['ins'].state for state in [states['a'][0].state, states['b'][0].state])
+
+
+@pytest.fixture
+def offset_library(library, monkeypatch):
+    from jwst_pancake.pandeia_subclasses import CoronagraphyPSFLibrary
+
+    # Stands in for calc_psf: a Gaussian left wherever rolling the PSF back to the centre by a whole
+    # number of detector pixels leaves it (webbpsf puts positive azimuths at negative x).
+    def calculate_psf(wave, instrument, aperture_name, oversample, source_offset):
+        library.calls.append(tuple(source_offset))
+        dx = source_offset[0] * np.sin(np.deg2rad(source_offset[1])) / 0.063
+        dy = source_offset[0] * np.cos(np.deg2rad(source_offset[1])) / 0.063
+        y, x = np.indices((41, 41))
+        x0, y0 = 20 - (dx - np.rint(dx)) * oversample, 20 + (dy - np.rint(dy)) * oversample
+        return {'int': np.exp(-((x - x0)**2 + (y - y0)**2) / 8.), 'wave': wave, 'pix_scl': 0.063 / oversample,
+                'diff_limit': 0.1, 'upsamp': oversample, 'instrument': instrument, 'aperture_name': aperture_name,
+                'source_offset': source_offset, 'pupil_throughput': 0.5}
+    monkeypatch.setattr(CoronagraphyPSFLibrary, '_calculate_psf', staticmethod(calculate_psf))
+    library._options.cache = 'none'
+    library._options.psf_offset_grid = 0.05
+    library._options.psf_offset_tolerance = 0.03
+    return library
+
+
+def test_get_psf_snaps_within_the_tolerance(offset_library):
+    offset_library._options.psf_offset_mode = 'snap'
+    offset = (0.51, 100.)
+    grid_offset = offset_library._grid_offset(offset)
+    assert grid_offset != offset and grid_offset[0] == 0.5
+    psf = offset_library.get_psf(2.1, 'nircam', 'mask335r', oversample=2, source_offset=offset)
+    assert offset_library.calls == [grid_offset]
+    assert psf['source_offset'] == offset
+    assert np.array_equal(psf['int'], offset_library._calculate_psf(2.1, 'nircam', 'mask335r', 2, grid_offset)['int'])
+
+
+def test_get_psf_interpolates_towards_the_offset(offset_library):
+    offset_library._options.psf_offset_mode = 'interpolate'
+    offset = (0.51, 100.)
+    grid_offset = offset_library._grid_offset(offset)
+    psf = offset_library.get_psf(2.1, 'nircam', 'mask335r', oversample=2, source_offset=offset)
+    assert offset_library.calls == [grid_offset]
+    exact = offset_library._calculate_psf(2.1, 'nircam', 'mask335r', 2, offset)['int']
+    grid = offset_library._calculate_psf(2.1, 'nircam', 'mask335r', 2, grid_offset)['int']
+    # The grid PSF is a good part of a pixel away, and the shifted one lands on the exact PSF
+    assert np.max(np.abs(grid - exact)) > 0.1
+    assert np.allclose(psf['int'], exact, atol=1e-6)
+
+
+@pytest.mark.parametrize('mode', ['exact', 'snap', 'interpolate'])
+def test_get_psf_beyond_the_tolerance_is_exact(offset_library, mode):
+    offset_library._options.psf_offset_mode = mode
+    offset_library._options.psf_offset_tolerance = 0.005
+    offset = (0.51, 100.)
+    assert offset_library._grid_offset(offset) == offset
+    psf = offset_library.get_psf(2.1, 'nircam', 'mask335r', oversample=2, source_offset=offset)
+    assert offset_library.calls == [offset]
+    assert psf['source_offset'] == offset
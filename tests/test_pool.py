@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+
+import pytest
+
+pytest.importorskip('pandeia.engine')
+
+from jwst_pancake import engine
+from jwst_pancake.pool import EnginePool
+from jwst_pancake.rng import noise_seed, seed_sequence
+
+
+def calculation(calcfile):
+    # Stands in for a pandeia calculation, reporting the options it ran with
+    options = engine.get_options()
+    return {'n': calcfile['n'], 'noise_seed': options.noise_seed, 'wave_sampling': options.wave_sampling}
+
+
+@pytest.fixture
+def calculations(monkeypatch):
+    # The workers are forked once this is in place, so they run the stand-in too
+    monkeypatch.setattr(engine, 'perform_calculation', calculation)
+    return [{'n': n} for n in range(7)]
+
+
+@pytest.mark.parametrize('chunksize', [1, 3])
+def test_imap_yields_every_calculation(calculations, chunksize):
+    ncompleted = []
+    with EnginePool(2, warm=False) as pool:
+        results = list(pool.imap(calculations, chunksize=chunksize,
+                                 callback=lambda index, result, count: ncompleted.append((index, count))))
+        assert pool.map(calculations, chunksize=chunksize) == [calculation(calcfile) for calcfile in calculations]
+    assert sorted(index for index, result in results) == list(range(7))
+    assert all(result['n'] == index for index, result in results)
+    # The callback sees each result as it's yielded, with a running count
+    assert ncompleted == [(index, count) for count, (index, result) in enumerate(results, 1)]
+
+
+def test_imap_seeds_and_skip(calculations):
+    with EnginePool(2, warm=False) as pool:
+        seeded = dict(pool.imap(calculations, seed=5))
+        skipped = dict(pool.imap(calculations, seed=5, skip={1, 4}))
+    seeds = seed_sequence(5).spawn(7)
+    assert [seeded[n]['noise_seed'] for n in range(7)] == [noise_seed(seed) for seed in seeds]
+    # Skipping calculations doesn't change the seeds of the others
+    assert sorted(skipped) == [0, 2, 3, 5, 6]
+    assert all(skipped[n] == seeded[n] for n in skipped)
+
+
+@pytest.mark.parametrize('max_in_flight', [1, 2, 5])
+def test_imap_bounds_calculations_in_flight(calculations, max_in_flight):
+    consumed = []
+
+    def calcfiles():
+        for calcfile in calculations:
+            consumed.append(calcfile['n'])
+            yield calcfile
+    with EnginePool(2, warm=False) as pool:
+        nyielded = 0
+        for index, result in pool.imap(calcfiles(), max_in_flight=max_in_flight):
+            # Calculations are only taken from calcfiles as earlier ones finish
+            assert len(consumed) - nyielded <= max_in_flight
+            nyielded += 1
+    assert nyielded == 7 and consumed == list(range(7))
+
+
+def test_workers_get_the_options_of_each_batch(calculations):
+    with EnginePool(1, warm=False) as pool:
+        # The options are changed after the worker started
+        with engine.private_options() as options:
+            options.wave_sampling = 10
+            options.noise_seed = 3
+            changed = pool.map(calculations[:2])
+        # and only apply to the batch they were sent with
+        unchanged = pool.map(calculations[:2])
+        seeded = pool.map(calculations[:2], seed=5)
+    assert all(result['wave_sampling'] == 10 and result['noise_seed'] == 3 for result in changed)
+    defaults = engine.get_options()
+    assert all(result['wave_sampling'] == defaults.wave_sampling and result['noise_seed'] == defaults.noise_seed
+               for result in unchanged)
+    assert [result['noise_seed'] for result in seeded] == [noise_seed(seed) for seed in seed_sequence(5).spawn(2)]
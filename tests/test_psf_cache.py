@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pandeia.engine')
+
+from jwst_pancake import psf_cache
+from jwst_pancake.psf_cache import PSFStore, opd_key, psf_key
+
+
+@pytest.fixture
+def spec():
+    return {'wave': 2.1, 'instrument': 'nircam', 'aperture': 'mask210r', 'offset': [0.1, 0.], 'oversample': 3,
+            'opd': None}
+
+
+def test_psf_key_depends_only_on_contents(spec):
+    assert psf_key(spec) == psf_key(dict(reversed(list(spec.items()))))
+    assert psf_key(spec) != psf_key(dict(spec, wave=2.2))
+    assert psf_key(dict(spec, wave=np.float64(2.1))) == psf_key(spec)
+    assert psf_key(dict(spec, opd=np.ones(4))) == psf_key(dict(spec, opd=np.ones(4)))
+    assert psf_key(dict(spec, opd=np.ones(4))) != psf_key(dict(spec, opd=np.zeros(4)))
+    with pytest.raises(TypeError):
+        psf_key(dict(spec, opd=object()))
+
+
+def test_opd_key_hashes_contents():
+    assert opd_key(None) is None
+    assert opd_key(('OPD_RevW_ote_for_NIRCam_predicted.fits', 0)) == ['OPD_RevW_ote_for_NIRCam_predicted.fits', 0]
+    opd = np.arange(16.).reshape(4, 4)
+    assert opd_key(opd) == opd_key(opd.copy())
+    assert opd_key(opd) != opd_key(opd * 2)
+    with pytest.raises(TypeError):
+        opd_key(object())
+
+
+def test_opd_key_of_hdus():
+    class HDU(object):
+        def __init__(self, data):
+            self.data = data
+            self.header = {}
+    data = np.arange(16.).reshape(4, 4)
+    assert opd_key(HDU(data)) == opd_key(data)
+    assert opd_key([HDU(None), HDU(data)]) == [None, opd_key(data)]
+
+
+def test_store_round_trip(tmp_path):
+    store = PSFStore(str(tmp_path))
+    image = np.arange(12.).reshape(3, 4)
+    assert store.get('a') is None
+    assert store.put('a', image, {'pix_scl': 0.01})
+    stored, meta = store.get('a')
+    assert np.array_equal(stored, image)
+    assert stored.dtype == np.float32
+    assert not stored.flags.writeable
+    assert meta == {'pix_scl': 0.01}
+    assert 'a' in store and len(store) == 1
+
+
+def test_store_is_shared_through_the_index(tmp_path):
+    writer = PSFStore(str(tmp_path))
+    reader = PSFStore(str(tmp_path))
+    writer.put('a', np.ones((2, 2)), {})
+    # The reader picks up records appended after it read the index
+    assert 'a' in reader
+    assert np.array_equal(reader.get('a')[0], np.ones((2, 2)))
+    writer.close()
+    assert len(PSFStore(str(tmp_path))) == 1
+
+
+def test_store_ignores_partial_index_records(tmp_path):
+    store = PSFStore(str(tmp_path))
+    store.put('a', np.ones((2, 2)), {})
+    with open(store._index_file, 'ab') as outf:
+        outf.write(b'{"key": "b", "sha')
+    assert len(PSFStore(str(tmp_path))) == 1
+
+
+def test_get_store_returns_one_store_per_path(tmp_path):
+    assert psf_cache.get_store(str(tmp_path)) is psf_cache.get_store(str(tmp_path / '.'))
+
+
+def _psf(nbytes):
+    return {'int': np.ones(nbytes // 8), 'pix_scl': 0.01}
+
+
+def test_cache_is_bounded_by_bytes():
+    cache = psf_cache.PSFCache(max_bytes=3 * 800)
+    for key in 'abc':
+        cache.put(key, _psf(800))
+    assert cache.get('a') is not None
+    cache.put('d', _psf(800))
+    # 'b' was the least recently used
+    assert 'b' not in cache
+    assert sorted(cache._entries) == ['a', 'c', 'd']
+    stats = cache.stats()
+    assert stats['entries'] == 3 and stats['bytes'] == 2400 and stats['evictions'] == 1
+    assert stats['hits'] == 1
+
+    cache.put('big', _psf(3200))
+    assert 'big' not in cache and len(cache) == 3
+    cache.resize(800)
+    assert len(cache) == 1 and cache.nbytes == 800
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_cache_shares_read_only_images():
+    cache = psf_cache.PSFCache()
+    psf = cache.put('a', _psf(80))
+    assert not psf['int'].flags.writeable
+    assert cache.get('a')['int'] is psf['int']
+    copied = cache.get('a', copy=True)['int']
+    assert copied.flags.writeable
+    copied[0] = 2.
+    assert cache.get('a')['int'][0] == 1.
+    assert cache.get('missing') is None and cache.misses == 1
+
+
+def test_store_budget_and_dtype(tmp_path):
+    store = PSFStore(str(tmp_path), dtype=np.float64, max_bytes=2 * 32)
+    image = np.linspace(0., 1., 4) / 3.
+    assert store.put('a', image, {})
+    assert store.put('b', image, {})
+    assert not store.put('c', image, {})
+    assert store.put('a', image, {})
+    assert 'c' not in store and store.nbytes == 64
+    stored = store.get('a')[0]
+    assert stored.dtype == np.float64 and np.array_equal(stored, image)
+    # Another store on the same directory counts the images already there, whatever their dtype
+    other = PSFStore(str(tmp_path), max_bytes=2 * 32)
+    assert other.nbytes == 64
+    assert not other.put('c', image, {})
+    assert other.get('b')[0].dtype == np.float64
+
+
+def test_arena_is_float64_and_bounded(tmp_path):
+    try:
+        psf_cache.attach_arena(str(tmp_path), 64)
+        arena = psf_cache.get_arena()
+        assert arena.dtype == np.float64 and arena.max_bytes == 64
+    finally:
+        psf_cache.attach_arena(None)
+    assert psf_cache.get_arena() is None
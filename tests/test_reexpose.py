@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+
+from copy import deepcopy
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pandeia.engine')
+
+from jwst_pancake.reexpose import ExposureScan, noise_realizations
+
+needs_engine = pytest.mark.skipif('pandeia_refdata' not in os.environ, reason="pandeia_refdata is not set")
+
+
+@pytest.fixture
+def detector():
+    signal = np.linspace(1., 2., 12).reshape(3, 4)
+    noise = np.full((3, 4), 0.5)
+    saturation = np.zeros((3, 4), dtype=int)
+    saturation[0, 1] = 1
+    saturation[2, 3] = 2
+    return signal, noise, saturation
+
+
+def test_noise_realizations_shape_and_saturation(detector):
+    signal, noise, saturation = detector
+    images = noise_realizations(signal, noise, 5, saturation=saturation, seed=1)
+    assert images.shape == (5, 3, 4)
+    assert np.all(np.isnan(images[:, 2, 3]))
+    assert np.isnan(images).sum() == 5
+    # Partially saturated pixels still get noise
+    assert np.all(np.isfinite(images[:, 0, 1]))
+    # The input noise is left alone
+    assert not np.isnan(noise).any()
+
+
+def test_noise_realizations_are_reproducible(detector):
+    signal, noise, saturation = detector
+    first = noise_realizations(signal, noise, 3, saturation=saturation, seed=7)
+    assert np.array_equal(first, noise_realizations(signal, noise, 3, saturation=saturation, seed=7), equal_nan=True)
+    assert not np.allclose(noise_realizations(signal, noise, 3, seed=8), noise_realizations(signal, noise, 3, seed=7))
+    assert not np.allclose(noise_realizations(signal, noise, 3)[0], noise_realizations(signal, noise, 3)[0])
+
+
+def test_noise_realizations_statistics(detector):
+    signal, noise, _ = detector
+    images = noise_realizations(signal, noise, 20000, seed=2)
+    assert np.allclose(images.mean(axis=0), signal, atol=0.02)
+    assert np.allclose(images.std(axis=0), noise, rtol=0.03)
+
+
+@pytest.fixture
+def calculation():
+    pytest.importorskip('webbpsf')
+    from jwst_pancake import engine
+    return engine, engine.load_calculation(engine.get_template('nircam_coronagraphy_template.json'))
+
+
+@needs_engine
+def test_exposure_scan_matches_perform_calculation(calculation):
+    engine, config = calculation
+    with engine.private_options() as options:
+        options.on_the_fly_PSFs = True
+        options.wave_sampling = 3
+        scan = ExposureScan(config)
+        for ngroup in [None, 4]:
+            exposure = None if ngroup is None else {'ngroup': ngroup}
+            calcfile = deepcopy(config)
+            if ngroup is not None:
+                calcfile['configuration']['detector']['ngroup'] = ngroup
+            options.noise_seed = 5
+            expected = engine.perform_calculation(calcfile)
+            report = scan.report(exposure, noise_seed=5)
+            assert np.allclose(report['2d']['detector'], expected['2d']['detector'], equal_nan=True)
+            assert np.array_equal(report['2d']['saturation'], expected['2d']['saturation'])
+            assert np.isclose(report['scalar']['sn'], expected['scalar']['sn'])
@@ -0,0 +1,39 @@
+from __future__ import absolute_import
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pandeia.engine')
+
+from jwst_pancake import rng
+
+
+def test_seed_sequence_is_copied():
+    seed = rng.seed_sequence(5)
+    children = [child.spawn_key for child in seed.spawn(3)]
+    # Spawning from a copy gives the same children, however many the original has spawned
+    again = rng.seed_sequence(seed)
+    assert [child.spawn_key for child in again.spawn(3)] == children
+    assert seed.n_children_spawned == 3
+    assert rng.noise_seed(again) == rng.noise_seed(seed)
+
+
+def test_streams_are_reproducible():
+    assert rng.noise_seed(5) == rng.noise_seed(5)
+    assert rng.noise_seed(5) != rng.noise_seed(6)
+    assert np.array_equal(rng.generator(5).normal(size=4), rng.generator(5).normal(size=4))
+    first, second = rng.seed_sequence(5).spawn(2)
+    assert rng.noise_seed(first) != rng.noise_seed(second)
+    assert rng.seed_sequence(None).entropy != rng.seed_sequence(None).entropy
+
+
+def test_fallback_seed_sequence():
+    seed = rng._SeedSequence(5)
+    first, second = seed.spawn(2)
+    assert first.spawn_key == (0,) and second.spawn_key == (1,)
+    assert seed.spawn(1)[0].spawn_key == (2,)
+    assert np.array_equal(first.generate_state(4), rng._SeedSequence(5, (0,)).generate_state(4))
+    assert not np.array_equal(first.generate_state(4), second.generate_state(4))
+    copied = rng.seed_sequence(first)
+    assert isinstance(copied, rng._SeedSequence) and copied.spawn_key == (0,)
+    assert copied.n_children_spawned == 0
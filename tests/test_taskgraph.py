@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+
+import pytest
+
+pytest.importorskip('pandeia.engine')
+
+from jwst_pancake import engine
+from jwst_pancake.taskgraph import CalculationGraph, calculation_key
+
+
+def one():
+    return 1
+
+def two():
+    return 2
+
+def add(*values):
+    return sum(values)
+
+def fail(value):
+    raise ValueError("bad value {}".format(value))
+
+
+@pytest.fixture
+def graph():
+    graph = CalculationGraph()
+    graph.add_function('a', one)
+    graph.add_function('b', two)
+    graph.add_function('sum', add, 'a', 'b')
+    graph.add_function('total', add, 'sum', 'a')
+    return graph
+
+
+def test_calculations_are_merged():
+    config = {'scene': [{'id': 1}], 'instrument': {'instrument': 'nircam'}}
+    graph = CalculationGraph()
+    first = graph.add_calculation(config)
+    assert graph.add_calculation(dict(config)) == first
+    assert graph.add_calculation(config, realization=1) != first
+    with engine.private_options() as options:
+        options.verbose = not options.verbose
+        assert graph.add_calculation(config) != first
+    assert graph.calculations == 3 and graph.requested == 4
+    assert first == calculation_key(config, engine.get_options().current_options)
+
+
+def test_function_nodes_need_their_dependencies(graph):
+    with pytest.raises(ValueError):
+        graph.add_function('c', add, 'missing')
+    with pytest.raises(ValueError):
+        graph.add_function('a', one)
+
+
+@pytest.mark.parametrize('parallel', [None, 'thread'])
+def test_run(graph, parallel):
+    assert graph.run(parallel=parallel, nprocesses=2) == {'a': 1, 'b': 2, 'sum': 3, 'total': 4}
+
+
+def test_run_skips_known_results(graph):
+    results = graph.run(results={'a': 10, 'b': 20})
+    assert results == {'a': 10, 'b': 20, 'sum': 30, 'total': 40}
+
+
+@pytest.mark.parametrize('parallel', [None, 'thread'])
+def test_iterate_yields_each_node_once(graph, parallel):
+    yielded = list(graph.iterate(parallel=parallel, nprocesses=2))
+    assert sorted(yielded) == [('a', 1), ('b', 2), ('sum', 3), ('total', 4)]
+    order = [key for key, result in yielded]
+    assert order.index('sum') > max(order.index('a'), order.index('b'))
+    assert order.index('total') > order.index('sum')
+
+
+def test_iterate_drops_used_results(graph):
+    held = []
+    release = graph._release
+
+    def record(node, available, users):
+        release(node, available, users)
+        held.append(sorted(available))
+    graph._release = record
+    list(graph.iterate())
+    # Results held after each node started: 'b' is dropped once 'sum' has started, 'a' once 'total' has
+    assert held == [[], ['a'], ['a'], []]
+
+
+def test_iterate_stops_when_closed(graph):
+    iterator = graph.iterate()
+    assert next(iterator) == ('a', 1)
+    iterator.close()
+    with pytest.raises(StopIteration):
+        next(iterator)
+
+
+@pytest.mark.parametrize('parallel', [None, 'thread'])
+def test_failures_are_raised(parallel):
+    graph = CalculationGraph()
+    graph.add_function('a', one)
+    graph.add_function('bad', fail, 'a')
+    with pytest.raises(RuntimeError, match='bad value 1'):
+        graph.run(parallel=parallel, nprocesses=2)
@@ -0,0 +1,54 @@
+from __future__ import absolute_import
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pandeia.engine')
+
+from jwst_pancake.transformations import FourierAligner, fourier_imshift
+
+
+@pytest.fixture
+def reference():
+    rng = np.random.RandomState(1)
+    return np.pad(np.outer(np.hanning(16), np.hanning(16)), 8, mode='constant') + 0.01 * rng.normal(size=(32, 32))
+
+
+@pytest.fixture
+def targets(reference):
+    rng = np.random.RandomState(2)
+    return np.array([beta * fourier_imshift(reference, xshift, yshift) + 0.001 * rng.normal(size=reference.shape)
+                     for xshift, yshift, beta in [(0.3, 0.2, 1.1), (1.4, -0.7, 0.9)]])
+
+
+def test_shift_matches_fourier_imshift(reference):
+    aligner = FourierAligner(reference)
+    assert np.allclose(aligner.shift(0.3, -1.2), fourier_imshift(reference, 0.3, -1.2))
+    stack = aligner.shift_stack([0.3, 2.], [-1.2, 0.5])
+    assert np.allclose(stack[1], fourier_imshift(reference, 2., 0.5))
+
+
+def test_fit_stack_matches_fit(reference, targets):
+    aligner = FourierAligner(reference)
+    fits = aligner.fit_stack(targets)
+    assert fits.shape == (2, 3)
+    for target, fit in zip(targets, fits):
+        assert np.allclose(fit, aligner.fit(target), atol=1e-6)
+    assert np.allclose(fits, [[0.3, 0.2, 1.1], [1.4, -0.7, 0.9]], atol=0.01)
+
+
+def test_fit_stack_zero_frame(reference, targets):
+    # A frame with nothing in it fits exactly at (0, 0, 0), as it does with leastsq, and must not
+    # stop the rest of the stack from being fitted
+    stack = np.array([targets[0], np.zeros_like(reference), targets[1]])
+    aligner = FourierAligner(reference)
+    fits = aligner.fit_stack(stack)
+    assert np.array_equal(fits[1], [0., 0., 0.])
+    assert np.allclose(fits[[0, 2]], aligner.fit_stack(targets))
+
+
+def test_fit_stack_fully_masked(reference, targets):
+    aligner = FourierAligner(reference, np.zeros_like(reference))
+    fits = aligner.fit_stack(targets)
+    assert np.all(np.isfinite(fits))
+    assert np.allclose(fits, [aligner.initial_guess(target) for target in targets])